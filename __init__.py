@@ -10,5 +10,11 @@ __all__ = ['register', 'routes']
 def register():
     Pool.register(
         imap.IMAPServer,
+        imap.IMAPServerFolder,
+        imap.IMAPServerMessage,
+        imap.IMAPServerOversized,
+        imap.IMAPServerSyncLog,
+        imap.IMAPServerSyncStatistics,
+        imap.Cron,
         imap.OauthCredentials,
         module='imap', type_='model')
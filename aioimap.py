@@ -0,0 +1,309 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+import asyncio
+import base64
+import re
+import ssl as ssl_
+import time
+from imaplib import IMAP4
+
+_LITERAL = re.compile(rb'\{(\d+)\}$')
+_UNTAGGED_STATUS = re.compile(rb'^(\d+) ([A-Z-]+)(?: (.*))?$', re.DOTALL)
+_UNTAGGED_RESPONSE = re.compile(rb'^([A-Z-]+)(?: (.*))?$', re.DOTALL)
+_RESPONSE_CODE = re.compile(rb'^\[([A-Z-]+)(?: ([^\]]*))?\]')
+_ATOM_SPECIALS = re.compile(r'[\s(){%*"\\\]]')
+
+
+def quote(value):
+    'Return value as an IMAP quoted string if it is not a valid atom'
+    if value and not _ATOM_SPECIALS.search(value):
+        return value
+    return '"%s"' % value.replace('\\', '\\\\').replace('"', '\\"')
+
+
+class AsyncIMAP4(object):
+    '''
+    asyncio IMAP4rev1 client.
+
+    The coroutines mirror the methods of imaplib.IMAP4 and return the same
+    (type, data) tuples, so the responses can be parsed with the same
+    helpers. The errors raised are also the ones of imaplib.
+    '''
+    error = IMAP4.error
+    abort = IMAP4.abort
+    readonly = IMAP4.readonly
+
+    def __init__(self, reader, writer, timeout=None):
+        self.reader = reader
+        self.writer = writer
+        self.timeout = timeout
+        self.capabilities = ()
+        self.state = 'NONAUTH'
+        self.untagged_responses = {}
+        self._tag = 0
+        self._lock = asyncio.Lock()
+
+    @classmethod
+    async def open(cls, host, port, ssl=False, ssl_context=None,
+            timeout=None):
+        '''
+        Connect to the server and return an AsyncIMAP4 instance once the
+        greeting and the capabilities are read.
+        '''
+        if ssl and ssl_context is None:
+            ssl_context = ssl_.create_default_context()
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(str(host), int(port),
+                ssl=ssl_context if ssl else None),
+            timeout)
+        imapper = cls(reader, writer, timeout)
+        greeting = await imapper._readline()
+        if greeting.startswith(b'* PREAUTH'):
+            imapper.state = 'AUTH'
+        elif not greeting.startswith(b'* OK'):
+            writer.close()
+            raise cls.error(greeting)
+        await imapper.capability()
+        return imapper
+
+    @property
+    def tagnum(self):
+        'Number of commands sent like imaplib.IMAP4.tagnum'
+        return self._tag
+
+    async def _readline(self):
+        try:
+            line = await asyncio.wait_for(self.reader.readline(),
+                self.timeout)
+        except (asyncio.TimeoutError, ConnectionError) as e:
+            raise self.abort('socket error: %s' % e)
+        if not line:
+            raise self.abort('socket error: EOF')
+        return line.rstrip(b'\r\n')
+
+    async def _readexactly(self, size):
+        try:
+            return await asyncio.wait_for(self.reader.readexactly(size),
+                self.timeout)
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError,
+                ConnectionError) as e:
+            raise self.abort('socket error: %s' % e)
+
+    async def send(self, data):
+        try:
+            self.writer.write(data)
+            await self.writer.drain()
+        except ConnectionError as e:
+            raise self.abort('socket error: %s' % e)
+
+    def _append_untagged(self, typ, data):
+        self.untagged_responses.setdefault(typ, []).append(data)
+
+    async def _read_untagged(self, line):
+        'Store the untagged response of line (without "* ")'
+        match = _UNTAGGED_STATUS.match(line)
+        if match:
+            typ = match.group(2).decode()
+            data = match.group(1)
+            if match.group(3):
+                data += b' ' + match.group(3)
+        else:
+            match = _UNTAGGED_RESPONSE.match(line)
+            if not match:
+                raise self.abort('unexpected response: %r' % line)
+            typ = match.group(1).decode()
+            data = match.group(2) or b''
+        if typ in ('OK', 'NO', 'BAD'):
+            code = _RESPONSE_CODE.match(data)
+            if code:
+                self._append_untagged(code.group(1).decode(),
+                    code.group(2) or b'')
+        while True:
+            literal = _LITERAL.search(data)
+            if not literal:
+                break
+            value = await self._readexactly(int(literal.group(1)))
+            self._append_untagged(typ, (data, value))
+            data = await self._readline()
+        self._append_untagged(typ, data)
+
+    async def _command(self, name, *args, continuation=None):
+        '''
+        Send a command and read the responses until its completion.
+        Return the status and the text of the tagged response.
+        '''
+        async with self._lock:
+            self._tag += 1
+            tag = b'A%03d' % self._tag
+            command = ' '.join([name] + [a for a in args if a is not None])
+            await self.send(tag + b' ' + command.encode() + b'\r\n')
+            while True:
+                line = await self._readline()
+                if line.startswith(b'* '):
+                    await self._read_untagged(line[2:])
+                elif line.startswith(b'+'):
+                    if continuation is None:
+                        raise self.abort('unexpected continuation')
+                    await self.send(continuation(line[2:]) + b'\r\n')
+                elif line.startswith(tag + b' '):
+                    status, _, text = line[len(tag) + 1:].partition(b' ')
+                    status = status.decode().upper()
+                    if status == 'BAD':
+                        raise self.error('%s command error: %s %s'
+                            % (name, status, text))
+                    return status, text
+                else:
+                    raise self.abort('unexpected response: %r' % line)
+
+    def _untagged_response(self, status, text, name):
+        if status == 'NO':
+            return status, [text]
+        return status, self.untagged_responses.pop(name, [None])
+
+    async def _simple_command(self, name, *args):
+        status, text = await self._command(name, *args)
+        return status, [text]
+
+    def response(self, code):
+        return code, self.untagged_responses.pop(code.upper(), [None])
+
+    async def capability(self):
+        status, text = await self._command('CAPABILITY')
+        status, data = self._untagged_response(status, text, 'CAPABILITY')
+        if status == 'OK' and data[-1]:
+            self.capabilities = tuple(
+                data[-1].decode('ascii', 'replace').upper().split())
+        return status, data
+
+    async def login(self, user, password):
+        status, text = await self._command('LOGIN', quote(user),
+            quote(password))
+        if status != 'OK':
+            raise self.error(text.decode('utf-8', 'replace'))
+        self.state = 'AUTH'
+        return status, [text]
+
+    async def authenticate(self, mechanism, authobject):
+        '''
+        Authenticate with a SASL mechanism. authobject is called with the
+        server challenge and returns the (not encoded) response.
+        '''
+        def continuation(challenge):
+            response = authobject(base64.b64decode(challenge))
+            if isinstance(response, str):
+                response = response.encode()
+            return base64.b64encode(response or b'')
+        status, text = await self._command('AUTHENTICATE', mechanism.upper(),
+            continuation=continuation)
+        if status != 'OK':
+            raise self.error(text.decode('utf-8', 'replace'))
+        self.state = 'AUTH'
+        return status, [text]
+
+    async def select(self, mailbox='INBOX', readonly=False):
+        self.untagged_responses = {}
+        status, text = await self._command(
+            'EXAMINE' if readonly else 'SELECT', quote(mailbox))
+        if status != 'OK':
+            self.state = 'AUTH'
+            return status, [text]
+        self.state = 'SELECTED'
+        return status, self.untagged_responses.get('EXISTS', [None])
+
+    async def status(self, mailbox, names):
+        status, text = await self._command('STATUS', quote(mailbox), names)
+        return self._untagged_response(status, text, 'STATUS')
+
+    async def search(self, charset, *criteria):
+        args = (['CHARSET', charset] if charset else []) + list(criteria)
+        status, text = await self._command('SEARCH', *args)
+        return self._untagged_response(status, text, 'SEARCH')
+
+    async def fetch(self, message_set, message_parts):
+        status, text = await self._command('FETCH', message_set,
+            message_parts)
+        return self._untagged_response(status, text, 'FETCH')
+
+    async def store(self, message_set, command, flags):
+        if not flags.startswith('('):
+            flags = '(%s)' % flags
+        status, text = await self._command('STORE', message_set, command,
+            flags)
+        return self._untagged_response(status, text, 'FETCH')
+
+    async def copy(self, message_set, new_mailbox):
+        return await self._simple_command('COPY', message_set,
+            quote(new_mailbox))
+
+    async def expunge(self):
+        status, text = await self._command('EXPUNGE')
+        return self._untagged_response(status, text, 'EXPUNGE')
+
+    async def uid(self, command, *args):
+        command = command.upper()
+        if command in ('COPY', 'MOVE') and args:
+            args = args[:-1] + (quote(args[-1]),)
+        elif command == 'STORE' and len(args) == 3:
+            flags = args[2]
+            if not flags.startswith('('):
+                flags = '(%s)' % flags
+            args = args[:2] + (flags,)
+        status, text = await self._command('UID', command, *args)
+        name = 'FETCH' if command in ('FETCH', 'STORE') else command
+        return self._untagged_response(status, text, name)
+
+    async def noop(self):
+        return await self._simple_command('NOOP')
+
+    async def idle(self, timeout):
+        '''
+        Send IDLE (RFC 2177) and wait until the server sends an untagged
+        response or the timeout expires.
+        Return the list of untagged responses received.
+        '''
+        async with self._lock:
+            self._tag += 1
+            tag = b'A%03d' % self._tag
+            await self.send(tag + b' IDLE\r\n')
+            line = await self._readline()
+            if not line.startswith(b'+'):
+                raise self.error('IDLE command error: %r' % line)
+            responses = []
+            deadline = time.monotonic() + timeout
+            while not responses:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    line = await asyncio.wait_for(self.reader.readline(),
+                        remaining)
+                except asyncio.TimeoutError:
+                    break
+                if not line:
+                    raise self.abort('socket error: EOF')
+                responses.append(line.rstrip(b'\r\n'))
+            await self.send(b'DONE\r\n')
+            while True:
+                line = await self._readline()
+                if line.startswith(tag + b' '):
+                    break
+                responses.append(line)
+            return responses
+
+    async def close(self):
+        status, text = await self._command('CLOSE')
+        self.state = 'AUTH'
+        return status, [text]
+
+    async def logout(self):
+        self.state = 'LOGOUT'
+        try:
+            status, text = await self._command('LOGOUT')
+        except (self.error, self.abort):
+            status, text = 'NO', b''
+        self.writer.close()
+        try:
+            await self.writer.wait_closed()
+        except (ConnectionError, ssl_.SSLError):
+            pass
+        return status, self.untagged_responses.pop('BYE', [text])
@@ -0,0 +1,138 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+import logging
+import mmap
+import os
+import tempfile
+import threading
+from urllib.parse import quote
+
+from trytond.config import config
+
+logger = logging.getLogger(__name__)
+
+CACHE_PATH = config.get('imap', 'cache_path',
+    default=os.path.join(config.get('database', 'path'), 'imap'))
+# Maximum size in bytes of all the cached messages
+CACHE_SIZE = config.getint('imap', 'cache_size', default=512 * 1024 * 1024)
+
+
+def _component(value):
+    'Return value as a file name that can not leave its directory'
+    value = quote(str(value), safe='')
+    if value.startswith('.'):
+        value = '%2E' + value[1:]
+    return value
+
+
+class MessageCache(object):
+    '''
+    Store of raw RFC822 messages on disk, one file per message (like
+    Maildir) under path/<key>.eml, with the least recently used messages
+    removed once the total size exceeds max_size bytes.
+    '''
+
+    def __init__(self, path=CACHE_PATH, max_size=CACHE_SIZE):
+        self.path = path
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._size = None
+
+    def _filename(self, key):
+        return os.path.join(self.path, *map(_component, key)) + '.eml'
+
+    def _files(self):
+        'Return the list of (last access, size, filename) of the messages'
+        files = []
+        for dirpath, _, filenames in os.walk(self.path):
+            for filename in filenames:
+                if not filename.endswith('.eml'):
+                    continue
+                filename = os.path.join(dirpath, filename)
+                try:
+                    stat = os.stat(filename)
+                except FileNotFoundError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, filename))
+        return files
+
+    def get(self, key):
+        '''
+        Return a read-only memoryview of the memory-mapped message of key or
+        None if it is not cached.
+        '''
+        filename = self._filename(key)
+        try:
+            fd = os.open(filename, os.O_RDONLY)
+        except FileNotFoundError:
+            return
+        try:
+            if not os.fstat(fd).st_size:
+                return memoryview(b'')
+            content = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+        finally:
+            os.close(fd)
+        try:
+            # The modification time keeps the order of the last access
+            os.utime(filename)
+        except OSError:
+            pass
+        return memoryview(content)
+
+    def put(self, key, content):
+        '''
+        Store the raw message content as key
+        '''
+        if not self.max_size or len(content) > self.max_size:
+            return
+        filename = self._filename(key)
+        dirname = os.path.dirname(filename)
+        try:
+            os.makedirs(dirname, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=dirname, suffix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                f.write(content)
+            os.replace(tmp, filename)
+        except OSError as e:
+            logger.warning('Could not cache IMAP message %s: %s', key, e)
+            return
+        with self._lock:
+            if self._size is None:
+                self._size = sum(f[1] for f in self._files())
+            else:
+                self._size += len(content)
+            if self._size > self.max_size:
+                self._evict()
+
+    def _evict(self):
+        'Remove the least recently used messages'
+        files = sorted(self._files())
+        size = sum(f[1] for f in files)
+        # Free some room to not evict on every put
+        limit = self.max_size * 0.9
+        for _, file_size, filename in files:
+            if size <= limit:
+                break
+            try:
+                os.remove(filename)
+            except FileNotFoundError:
+                pass
+            size -= file_size
+        self._size = size
+
+    def clear(self, *prefix):
+        '''
+        Remove all the messages whose key starts with prefix
+        '''
+        path = os.path.join(self.path, *map(_component, prefix))
+        with self._lock:
+            for dirpath, _, filenames in os.walk(path, topdown=False):
+                for filename in filenames:
+                    try:
+                        os.remove(os.path.join(dirpath, filename))
+                    except FileNotFoundError:
+                        pass
+            self._size = None
+
+
+cache = MessageCache()
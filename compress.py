@@ -0,0 +1,108 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+import imaplib
+import zlib
+
+_CHUNK = 64 * 1024
+
+# imaplib refuses to send the commands it does not know
+imaplib.Commands.setdefault('COMPRESS', ('AUTH', 'SELECTED'))
+
+
+class DeflateFile(object):
+    '''
+    Read-only file object that inflates the raw DEFLATE data read from file.
+    It implements the methods imaplib uses on its file.
+    '''
+
+    def __init__(self, file):
+        self.file = file
+        self._decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        self._buffer = bytearray()
+
+    def _fill(self):
+        'Inflate more data into the buffer and return False at EOF'
+        while True:
+            tail = self._decompressor.unconsumed_tail
+            if not tail:
+                # read1 also returns the data already buffered by file
+                tail = self.file.read1(_CHUNK)
+                if not tail:
+                    return False
+            data = self._decompressor.decompress(tail, _CHUNK)
+            if data:
+                self._buffer += data
+                return True
+
+    def read(self, size):
+        while len(self._buffer) < size and self._fill():
+            pass
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+    def readline(self, limit=-1):
+        start = 0
+        while True:
+            index = self._buffer.find(b'\n', start)
+            if index >= 0:
+                end = index + 1
+                break
+            start = len(self._buffer)
+            if 0 <= limit <= start or not self._fill():
+                end = start
+                break
+        if limit >= 0:
+            end = min(end, limit)
+        data = bytes(self._buffer[:end])
+        del self._buffer[:end]
+        return data
+
+    def pending(self):
+        'Whether some data can be read without waiting for the socket'
+        return bool(self._buffer or self._decompressor.unconsumed_tail)
+
+    def close(self):
+        self.file.close()
+
+
+class DeflateSocket(object):
+    '''
+    Socket that deflates the data sent and delegates everything else to
+    sock.
+    '''
+
+    def __init__(self, sock, file, level=zlib.Z_DEFAULT_COMPRESSION):
+        self._sock = sock
+        self._file = file
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED,
+            -zlib.MAX_WBITS)
+
+    def sendall(self, data):
+        # Each command must be flushed to be read by the server
+        self._sock.sendall(self._compressor.compress(data)
+            + self._compressor.flush(zlib.Z_SYNC_FLUSH))
+
+    def pending(self):
+        pending = getattr(self._sock, 'pending', None)
+        return self._file.pending() or bool(pending and pending())
+
+    def __getattr__(self, name):
+        return getattr(self._sock, name)
+
+
+def compress(imapper, level=zlib.Z_DEFAULT_COMPRESSION):
+    '''
+    Negotiate COMPRESS=DEFLATE (RFC 4978) on an authenticated imaplib
+    connection and replace its socket and file by the ones that deflate and
+    inflate the data, so every command is compressed transparently.
+    Return whether the compression is active.
+    '''
+    if isinstance(imapper.sock, DeflateSocket):
+        return True
+    status, _ = imapper._simple_command('COMPRESS', 'DEFLATE')
+    if status != 'OK':
+        return False
+    imapper.file = DeflateFile(imapper.file)
+    imapper.sock = DeflateSocket(imapper.sock, imapper.file, level)
+    return True
@@ -0,0 +1,116 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+import logging
+import socket
+import threading
+import time
+from imaplib import IMAP4
+
+from trytond.config import config
+
+logger = logging.getLogger(__name__)
+
+# Number of idle connections kept for each server
+POOL_SIZE = config.getint('imap', 'pool_size', default=2)
+# Seconds an idle connection is kept before logging out
+POOL_TTL = config.getint('imap', 'pool_ttl', default=300)
+
+
+def logout(imapper):
+    try:
+        imapper.logout()
+    except (IMAP4.error, IMAP4.abort, IMAP4.readonly, socket.error):
+        pass
+
+
+class ConnectionPool(object):
+    '''
+    Thread-safe pool of authenticated IMAP connections.
+
+    Connections are stored by key (e.g. database and server id) together
+    with a fingerprint of the settings used to open them, so connections
+    opened with outdated settings (host, credentials...) are discarded.
+    '''
+
+    def __init__(self, size=POOL_SIZE, ttl=POOL_TTL):
+        self.size = size
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._idle = {}
+
+    def _evict(self, key=None, fingerprint=None):
+        '''
+        Remove the expired connections of all the keys and the ones of key
+        opened with another fingerprint, and return them.
+        '''
+        expired = []
+        limit = time.monotonic() - self.ttl
+        for key_ in list(self._idle.keys()):
+            connections = self._idle[key_]
+            keep = []
+            for connection in connections:
+                fingerprint_, _, last_used = connection
+                if (last_used < limit
+                        or (key_ == key and fingerprint is not None
+                            and fingerprint_ != fingerprint)):
+                    expired.append(connection[1])
+                else:
+                    keep.append(connection)
+            if keep:
+                self._idle[key_] = keep
+            else:
+                self._idle.pop(key_, None)
+        return expired
+
+    def get(self, key, fingerprint):
+        '''
+        Return an idle connection that answers to NOOP or None.
+        '''
+        while True:
+            with self._lock:
+                expired = self._evict(key, fingerprint)
+                connections = self._idle.get(key)
+                imapper = connections.pop()[1] if connections else None
+            for expired_imapper in expired:
+                logout(expired_imapper)
+            if imapper is None:
+                return
+            try:
+                status, _ = imapper.noop()
+            except (IMAP4.error, IMAP4.abort, IMAP4.readonly,
+                    socket.error):
+                status = 'KO'
+            if status == 'OK':
+                return imapper
+            logger.debug('Discard broken IMAP connection for %s', key)
+            logout(imapper)
+
+    def put(self, key, fingerprint, imapper):
+        '''
+        Store imapper as an idle connection of key.
+        '''
+        with self._lock:
+            expired = self._evict(key, fingerprint)
+            connections = self._idle.setdefault(key, [])
+            if len(connections) < self.size:
+                connections.append((fingerprint, imapper, time.monotonic()))
+            else:
+                expired.append(imapper)
+        for expired_imapper in expired:
+            logout(expired_imapper)
+
+    def clear(self, key=None):
+        '''
+        Logout all the idle connections of key or of all the keys.
+        '''
+        with self._lock:
+            if key is None:
+                idle = [c for cs in self._idle.values() for c in cs]
+                self._idle.clear()
+            else:
+                idle = self._idle.pop(key, [])
+        for _, imapper, _ in idle:
+            logout(imapper)
+
+
+connections = ConnectionPool()
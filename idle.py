@@ -0,0 +1,172 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+import logging
+import re
+import select
+import socket
+import threading
+import time
+from imaplib import IMAP4
+
+from trytond.config import config
+from trytond.exceptions import UserError
+from trytond.pool import Pool
+from trytond.transaction import Transaction
+
+logger = logging.getLogger(__name__)
+
+# Servers may drop connections idle for more than 30 minutes (RFC 2177), so
+# IDLE is restarted before
+IDLE_TIMEOUT = config.getint('imap', 'idle_timeout', default=25 * 60)
+# Seconds between NOOP polls on servers without the IDLE capability
+POLL_INTERVAL = config.getint('imap', 'poll_interval', default=60)
+# Seconds to wait before connecting again after the connection is lost
+RETRY_INTERVAL = config.getint('imap', 'retry_interval', default=60)
+
+_NEW_MESSAGES = re.compile(rb'^\* \d+ (EXISTS|RECENT)\b', re.IGNORECASE)
+
+
+def has_new_messages(responses):
+    "Return whether any of the untagged responses announces new e-mails"
+    return any(_NEW_MESSAGES.match(r) for r in responses)
+
+
+def idle(imapper, timeout, stop_event=None):
+    '''
+    Send IDLE (RFC 2177) and wait until the server announces new e-mails,
+    the timeout expires or the stop_event is set.
+    Return the list of untagged responses received.
+    '''
+    tag = imapper._new_tag()
+    imapper.tagged_commands.pop(tag, None)
+    imapper.send(tag + b' IDLE\r\n')
+    line = imapper.readline()
+    if not line.startswith(b'+'):
+        raise IMAP4.error('IDLE command error: %r' % line)
+
+    responses = []
+    sock = imapper.sock
+    deadline = time.monotonic() + timeout
+    while not has_new_messages(responses):
+        remaining = deadline - time.monotonic()
+        if remaining <= 0 or (stop_event and stop_event.is_set()):
+            break
+        # SSL sockets may have already decrypted data not seen by select
+        pending = getattr(sock, 'pending', None)
+        if not (pending and pending()):
+            readable, _, _ = select.select([sock], [], [], min(remaining, 1))
+            if not readable:
+                continue
+        line = imapper.readline()
+        if not line:
+            raise IMAP4.abort('socket error: EOF')
+        responses.append(line.rstrip(b'\r\n'))
+
+    imapper.send(b'DONE\r\n')
+    while True:
+        line = imapper.readline()
+        if not line:
+            raise IMAP4.abort('socket error: EOF')
+        if line.startswith(tag):
+            break
+        responses.append(line.rstrip(b'\r\n'))
+    if not line[len(tag):].lstrip().upper().startswith(b'OK'):
+        raise IMAP4.error('IDLE command error: %r' % line)
+    return responses
+
+
+class IdleListener(threading.Thread):
+    '''
+    Thread that waits for new e-mails on the folder of an imap.server and
+    hands their IDs to callback.
+
+    The callback is called as callback(server, emailids) inside a
+    transaction that is committed afterwards. A queue (any object with a
+    put() method) may be used instead and receives (server id, emailids)
+    tuples. The server must be on incremental mode, whose last UID is stored
+    once the callback returns, so each e-mail is handed over once.
+    '''
+
+    def __init__(self, database_name, server_id, callback, user=0,
+            context=None):
+        super().__init__(daemon=True,
+            name='imap-idle-%s-%s' % (database_name, server_id))
+        self.database_name = database_name
+        self.server_id = server_id
+        self.callback = callback
+        self.user = user
+        self.context = context or {}
+        self.stop_event = threading.Event()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def run(self):
+        imapper = None
+        changed = True
+        while not self.stop_event.is_set():
+            try:
+                if imapper is None:
+                    imapper = self.process(None)
+                    changed = False
+                elif changed:
+                    self.process(imapper)
+                changed = self.wait(imapper)
+            except Exception as e:
+                # The errors of the callback or of the database must not end
+                # the thread either
+                logger.warning('IMAP listener of server %s failed: %s',
+                    self.server_id, e, exc_info=not isinstance(e,
+                        (UserError, IMAP4.error, IMAP4.abort, socket.error)))
+                if imapper is not None:
+                    self.logout(imapper)
+                imapper = None
+                self.stop_event.wait(RETRY_INTERVAL)
+        if imapper is not None:
+            self.logout(imapper)
+
+    def logout(self, imapper):
+        try:
+            imapper.logout()
+        except (IMAP4.error, IMAP4.abort, socket.error):
+            pass
+
+    def process(self, imapper):
+        '''
+        Search the new e-mails and hand them to the callback.
+        A new connection is opened when imapper is None and returned.
+        '''
+        with Transaction(new=True).start(self.database_name, self.user,
+                context=self.context) as transaction:
+            IMAPServer = Pool().get('imap.server')
+            server = IMAPServer(self.server_id)
+            server.check_listen()
+            if imapper is None:
+                imapper = IMAPServer.connect(server)
+                if imapper is None:
+                    raise IMAP4.error('Could not connect to %s'
+                        % server.rec_name)
+            emailids = server.fetch_ids(imapper)
+            if emailids:
+                if hasattr(self.callback, 'put'):
+                    self.callback.put((server.id, emailids))
+                else:
+                    self.callback(server, emailids)
+                server.set_last_uid(emailids)
+            transaction.commit()
+        return imapper
+
+    def wait(self, imapper):
+        '''
+        Wait for changes on the selected folder with IDLE or NOOP polling.
+        Return whether new e-mails may be available.
+        '''
+        if 'IDLE' in getattr(imapper, 'capabilities', ()):
+            return has_new_messages(
+                idle(imapper, IDLE_TIMEOUT, self.stop_event))
+        if self.stop_event.wait(POLL_INTERVAL):
+            return False
+        status, data = imapper.noop()
+        if status != 'OK':
+            raise IMAP4.error('NOOP command error: %s' % data)
+        return True
@@ -1,23 +1,65 @@
 # The COPYRIGHT file at the top level of this repository contains the full
 # copyright notices and license terms.
+import asyncio
 import datetime
+import email
+import hashlib
 import json
 import logging
+import re
+import os
+import random
 import socket
+import tempfile
+import threading
+import time
+import types
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from imaplib import IMAP4, IMAP4_SSL
+from itertools import groupby, islice
+
+from sql import Literal, Null
+from sql.aggregate import Avg, Count, Max, Sum
+from sql.conditionals import Case
 
-from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import Flow
-from google.auth.transport.requests import Request
 
-from trytond.model import ModelSQL, ModelView, fields, DictSchemaMixin
+from trytond import backend
+from trytond.model import ModelSQL, ModelView, fields, DictSchemaMixin, Index
 from trytond.config import config
-from trytond.pool import Pool
-from trytond.pyson import Bool, Eval
+from trytond.pool import Pool, PoolMeta
+from trytond.pyson import Bool, Eval, If
 from trytond.exceptions import UserError
 from trytond.i18n import gettext
+from trytond.transaction import Transaction
+
+from .aioimap import AsyncIMAP4
+from .cache import cache
+from .compress import compress
+from .connection import connections
+from .exceptions import IMAPConnectionError
+from .idle import IdleListener
+from .message import LazyMessage, RawMessage, get_literal, parse_response
+from .metrics import collect, instrument, metrics
+from .oauth import refresh_google_credentials, tokens
 
 _IMAP_DATE_FORMAT = "%d-%b-%Y"
+_HEADERS = ('FROM', 'TO', 'CC', 'SUBJECT', 'DATE', 'MESSAGE-ID',
+    'IN-REPLY-TO', 'REFERENCES')
+# Keep the commands sent over a sequence set below the line length limits
+# of the servers
+_MAX_SET_IDS = 1000
+_ESEARCH_ALL = re.compile(rb'\bALL ([\d:,]+)')
+_FETCH_RESPONSE = re.compile(rb'^(\d+) \(')
+_FETCH_UID = re.compile(rb'[( ]UID (\d+)')
+# FETCH of the whole message that can be answered from the local cache
+_FETCH_FULL = re.compile(
+    r'^\(?(?:UID )?(RFC822|BODY(?:\.PEEK)?\[\])(?: UID)?\)?$', re.I)
+# Data items that set the \Seen flag implicitly (RFC 3501 section 6.4.5)
+_FETCH_SETS_SEEN = re.compile(
+    r'\b(RFC822(?!\.(HEADER|SIZE))|BODY\[|BINARY\[)', re.IGNORECASE)
 
 logger = logging.getLogger(__name__)
 PRODUCTION_ENV = config.getboolean('database', 'production', default=False)
@@ -35,6 +77,176 @@ GOOGLE_REDIRECT_URI = config.get('oauth', 'google_redirect_uri')
 
 OUTLOOK_URL = config.get('oauth', 'outlook_uri')
 
+# Days the processed messages are remembered to skip duplicates
+DEDUP_RETENTION = config.getint('imap', 'dedup_retention', default=90)
+
+# Number of servers synchronized at the same time by IMAPServer.sync()
+SYNC_WORKERS = config.getint('imap', 'sync_workers', default=4)
+# Number of servers of the same host synchronized at the same time
+SYNC_HOST_WORKERS = config.getint('imap', 'sync_host_workers', default=2)
+# Days the statistics of the synchronization runs are kept
+SYNC_LOG_RETENTION = config.getint('imap', 'sync_log_retention', default=30)
+# Reconnections allowed per synchronization run when the connection is lost
+SYNC_RETRIES = config.getint('imap', 'sync_retries', default=3)
+# Seconds to wait before the first reconnection, doubled on each one
+SYNC_BACKOFF = config.getfloat('imap', 'sync_backoff', default=1)
+SYNC_BACKOFF_MAX = config.getfloat('imap', 'sync_backoff_max', default=60)
+# Bytes downloaded by each FETCH of the e-mails spooled to a temporary file
+SPOOL_CHUNK_SIZE = config.getint('imap', 'spool_chunk_size',
+    default=1024 * 1024)
+
+
+# Fields of imap.server that track the synchronization of a folder
+_CHECKPOINT_FIELDS = ['uid_validity', 'last_uid', 'highest_modseq',
+    'last_retrieve_date']
+_STATUS_ITEMS = ['uid_next', 'messages', 'unseen']
+# Operations whose metrics count the e-mails downloaded
+_FETCH_OPERATIONS = ['fetch_one', 'fetch_batch', 'fetch_spooled']
+
+
+def sequence_set(emailids):
+    '''
+    Compress a list of e-mail IDs into an IMAP sequence set.
+    For example [1, 2, 3, 5] is returned as '1:3,5'.
+    '''
+    ranges = []
+    for number in sorted({int(i) for i in emailids}):
+        if ranges and ranges[-1][1] == number - 1:
+            ranges[-1][1] = number
+        else:
+            ranges.append([number, number])
+    return ','.join(str(start) if start == end else '%s:%s' % (start, end)
+        for start, end in ranges)
+
+
+def iter_sequence_set(value):
+    '''
+    Yield the numbers of an IMAP sequence set without expanding it in
+    memory.
+    '''
+    if isinstance(value, bytes):
+        value = value.decode()
+    for part in value.split(','):
+        if not part.strip():
+            continue
+        start, _, end = part.partition(':')
+        start, end = int(start), int(end or start)
+        yield from range(min(start, end), max(start, end) + 1)
+
+
+def parse_sequence_set(value):
+    '''
+    Return the list of numbers of an IMAP sequence set.
+    For example '1:3,5' is returned as [1, 2, 3, 5].
+    '''
+    return list(iter_sequence_set(value))
+
+
+def _response_line(item):
+    line = item[0] if isinstance(item, tuple) else item
+    if isinstance(line, str):
+        line = line.encode()
+    return line or b''
+
+
+def split_fetch_response(data, uid=False):
+    '''
+    Split the response of a FETCH command over several messages into a list
+    of (number, data) tuples, where data has the same structure imaplib
+    returns when a single message is fetched.
+    If uid is True, the number is the UID of the message instead of its
+    sequence number and responses without UID are discarded.
+    '''
+    result = []
+    for item in data:
+        match = _FETCH_RESPONSE.match(_response_line(item))
+        if match:
+            result.append((int(match.group(1)), [item]))
+        elif result:
+            result[-1][1].append(item)
+    if uid:
+        messages = []
+        for number, message in result:
+            for item in message:
+                match = _FETCH_UID.search(_response_line(item))
+                if match:
+                    messages.append((int(match.group(1)), message))
+                    break
+        result = messages
+    return result
+
+
+def _count_ids(emailids):
+    'Return the number of messages and bytes of the result of fetch_ids'
+    return len(emailids or []), None
+
+
+def _count_fetched(result):
+    'Return the number of messages and bytes of the result of a fetch'
+    size = 0
+    for data in result.values():
+        for item in data:
+            if isinstance(item, tuple):
+                size += len(item[1])
+    return len(result), size
+
+
+def _count_spooled(spool):
+    'Return the number of messages and bytes of a spooled e-mail'
+    size = spool.seek(0, os.SEEK_END)
+    spool.seek(0)
+    return 1, size
+
+
+def command_error(data, message):
+    '''
+    Return the exception to raise with message when an IMAP command fails,
+    data being its response or the exception raised. It is an
+    IMAPConnectionError when the connection is lost, so the synchronization
+    can reconnect and resume.
+    '''
+    if isinstance(data, (IMAP4.abort, socket.error)):
+        return IMAPConnectionError(message)
+    return UserError(message)
+
+
+def backoff(retry, base=SYNC_BACKOFF, maximum=SYNC_BACKOFF_MAX):
+    '''
+    Return the seconds to wait before the retry number retry (starting at
+    1): exponential with jitter, so the workers that lost the connection to
+    the same server do not reconnect at the same time.
+    '''
+    delay = min(maximum, base * 2 ** (retry - 1))
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+@types.coroutine
+def own_transactions(coroutine):
+    '''
+    Await coroutine with its own stack of transactions, swapped with the
+    one of the thread on each step, so each task of an event loop can start
+    its own transaction like a thread does.
+    '''
+    local = Transaction._local
+    transactions = []
+    value, error = None, None
+    while True:
+        current, local.transactions = local.transactions, transactions
+        try:
+            if error is None:
+                result = coroutine.send(value)
+            else:
+                result = coroutine.throw(error)
+        except StopIteration as e:
+            return e.value
+        finally:
+            local.transactions = current
+        value, error = None, None
+        try:
+            value = yield result
+        except BaseException as e:
+            error = e
+
 
 class IMAPServer(ModelSQL, ModelView):
     'IMAP Server'
@@ -107,6 +319,7 @@ class IMAPServer(ModelSQL, ModelView):
     search_mode = fields.Selection([
             ('unseen', 'Unseen'),
             ('interval', 'Time Interval'),
+            ('incremental', 'Incremental'),
             ('custom', 'Custom')
             ], 'Search Mode',
         states={
@@ -114,8 +327,9 @@ class IMAPServer(ModelSQL, ModelView):
             }, depends=['state', 'search_mode'],
         help='The criteria to filter when download messages. By '
         'default is only take the unread mesages, but it is possible '
-        'to take a time interval or a custom selection')
-    last_retrieve_date = fields.Date('Last Retrieve Date',
+        'to take a time interval or a custom selection. The incremental '
+        'mode only takes the messages received since the last fetch.')
+    last_retrieve_date = fields.DateTime('Last Retrieve Date',
         states={
             'invisible': Bool(Eval('search_mode') != 'interval'),
             'readonly': (Eval('state') != 'draft'),
@@ -126,8 +340,95 @@ class IMAPServer(ModelSQL, ModelView):
             'invisible': Bool(Eval('search_mode') != 'interval'),
             'readonly': (Eval('state') != 'draft'),
             }, depends=['state', 'search_mode'], required=True)
+    uid_validity = fields.Integer('UID Validity', readonly=True,
+        states={
+            'invisible': Bool(Eval('search_mode') != 'incremental'),
+            }, depends=['search_mode'],
+        help='The UIDVALIDITY of the folder when the last UID was fetched.')
+    last_uid = fields.Integer('Last UID', readonly=True,
+        states={
+            'invisible': Bool(Eval('search_mode') != 'incremental'),
+            }, depends=['search_mode'],
+        help='The highest UID already fetched from the folder.')
+    highest_modseq = fields.Char('Highest Mod-Sequence', readonly=True,
+        states={
+            'invisible': Bool(Eval('search_mode') != 'incremental'),
+            }, depends=['search_mode'],
+        help='The HIGHESTMODSEQ of the folder when the changes were last '
+        'fetched.')
+    max_messages = fields.Integer('Max Messages per Run',
+        domain=[
+            ['OR',
+                ('max_messages', '=', None),
+                ('max_messages', '>=', 1),
+                ],
+            If(Eval('search_mode') != 'incremental',
+                ('max_messages', '=', None),
+                ()),
+            ],
+        states={
+            'invisible': Eval('search_mode') != 'incremental',
+            }, depends=['search_mode'],
+        help='The maximum number of messages downloaded on each run, the '
+        'oldest first. Leave empty to download all of them.\n'
+        'Only allowed when the search mode is incremental, the next run '
+        'resumes after the last UID.')
+    spool_threshold = fields.Integer('Spool Threshold',
+        domain=['OR',
+            ('spool_threshold', '=', None),
+            ('spool_threshold', '>=', 1),
+            ],
+        help='Size in bytes above which the whole e-mails are downloaded in '
+        'chunks to a temporary file instead of being kept in memory. '
+        'Leave empty to always keep them in memory.')
+    max_size = fields.Integer('Max Message Size',
+        domain=['OR',
+            ('max_size', '=', None),
+            ('max_size', '>=', 1),
+            ],
+        help='Size in bytes above which the e-mails are not downloaded but '
+        'handled with the oversize action. Leave empty to download all of '
+        'them.')
+    oversize_action = fields.Selection([
+            ('skip', 'Skip'),
+            ('defer', 'Defer'),
+            ('quarantine', 'Move to quarantine folder'),
+            ], 'Oversize Action',
+        domain=[
+            If(Eval('search_mode') != 'incremental',
+                ('oversize_action', '=', 'skip'),
+                ()),
+            ],
+        states={
+            'invisible': ~Eval('max_size'),
+            'required': Bool(Eval('max_size')),
+            }, depends=['max_size', 'search_mode'],
+        help='Skip: never download them.\n'
+        'Defer: download them later with the "Fetch Deferred IMAP Messages" '
+        'scheduled task.\n'
+        'Move to quarantine folder: move them on the server.\n'
+        'Only skip is allowed when the search mode is not incremental.')
+    quarantine_folder = fields.Char('Quarantine Folder',
+        states={
+            'invisible': Eval('oversize_action') != 'quarantine',
+            'required': Eval('oversize_action') == 'quarantine',
+            }, depends=['oversize_action'],
+        help='The folder name where to move the oversized e-mails to.')
+    fetch_batch_size = fields.Integer('Fetch Batch Size', required=True,
+        domain=[('fetch_batch_size', '>=', 1)],
+        help='Number of messages downloaded with a single FETCH command. '
+        'Use 1 to download each message individually.')
     mark_seen = fields.Boolean('Mark as seen',
         help='Mark emails as seen on fetch.')
+    skip_duplicates = fields.Boolean('Skip Duplicates',
+        help='Remember the Message-ID of the processed emails to not '
+        'download them again.')
+    use_cache = fields.Boolean('Cache Messages',
+        states={
+            'invisible': Bool(Eval('search_mode') != 'incremental'),
+            }, depends=['search_mode'],
+        help='Keep a local copy of the downloaded emails to not fetch them '
+        'again from the server.')
     action_after_read = fields.Selection([
             ('nothing', 'Nothing'),
             ('move', 'Move to a folder'),
@@ -145,6 +446,29 @@ class IMAPServer(ModelSQL, ModelView):
             }, depends=['state', 'action_after_read'],
         help='The folder name where to move to on the server.'
         ' Absolut path')
+    backend = fields.Selection([
+            ('imaplib', 'Blocking'),
+            ('asyncio', 'Asynchronous'),
+            ], 'Backend', required=True,
+        domain=[
+            If(Bool(Eval('max_size')) | Bool(Eval('spool_threshold'))
+                | Bool(Eval('skip_duplicates')) | Bool(Eval('use_cache')),
+                ('backend', '=', 'imaplib'),
+                ()),
+            ],
+        states={
+            'readonly': (Eval('state') != 'draft'),
+            }, depends=['state', 'max_size', 'spool_threshold',
+            'skip_duplicates', 'use_cache'],
+        help='The asynchronous backend allows to synchronize many servers '
+        'at the same time without a thread for each one.\n'
+        'It does not support the max message size, the spool threshold, '
+        'skipping the duplicates nor caching the messages.')
+    folders = fields.One2Many('imap.server.folder', 'server', 'Other Folders',
+        help='Other folders to read from with the same connection.')
+    compression = fields.Boolean('Compression',
+        help='Compress the data exchanged with the server when it supports '
+        'the COMPRESS=DEFLATE extension.')
     session_id = fields.Char('Session ID',
         states={
             'invisible': Bool(Eval('types') == 'generic'),
@@ -183,6 +507,14 @@ class IMAPServer(ModelSQL, ModelView):
     def default_offset():
         return 1
 
+    @staticmethod
+    def default_backend():
+        return 'imaplib'
+
+    @staticmethod
+    def default_fetch_batch_size():
+        return 1
+
     @staticmethod
     def default_port():
         return 993
@@ -211,10 +543,26 @@ class IMAPServer(ModelSQL, ModelView):
     def default_mark_seen():
         return True
 
+    @staticmethod
+    def default_skip_duplicates():
+        return False
+
+    @staticmethod
+    def default_use_cache():
+        return False
+
+    @staticmethod
+    def default_compression():
+        return False
+
     @staticmethod
     def default_action_after_read():
         return 'nothing'
 
+    @staticmethod
+    def default_oversize_action():
+        return 'skip'
+
     @fields.depends('ssl', 'types')
     def on_change_with_port(self):
         if not self.types or self.types == 'generic':
@@ -251,8 +599,47 @@ class IMAPServer(ModelSQL, ModelView):
             return '(SINCE "%s")' % date_with_offset.strftime(_IMAP_DATE_FORMAT)
         elif self.search_mode == 'unseen':
             return 'UNSEEN'
+        elif self.search_mode == 'incremental':
+            return 'UID %s:*' % ((self.last_uid or 0) + 1)
         return self.criterion
 
+    @property
+    def use_uid(self):
+        'Whether the e-mail IDs are UIDs instead of sequence numbers'
+        return self.search_mode == 'incremental'
+
+    def _command(self, imapper, command, *args):
+        '''
+        Run command with the UID variant when the e-mail IDs are UIDs.
+        '''
+        if self.use_uid:
+            return imapper.uid(command, *args)
+        method = getattr(imapper, command.lower(), None)
+        if method is None:
+            # imaplib does not have a method for every extension (e.g. MOVE)
+            return imapper._simple_command(command, *args)
+        return method(*args)
+
+    @staticmethod
+    def has_capability(imapper, capability):
+        '''
+        Return whether the server advertises capability.
+        '''
+        return capability.upper() in getattr(imapper, 'capabilities', ())
+
+    @staticmethod
+    def enable(imapper, capability):
+        '''
+        Enable the extension capability (RFC 5161) once per connection.
+        '''
+        enabled = getattr(imapper, '_enabled', set())
+        if capability.upper() not in enabled:
+            status, data = imapper.enable(capability)
+            if status != 'OK':
+                raise IMAP4.error(data)
+            enabled.add(capability.upper())
+            imapper._enabled = enabled
+
     @classmethod
     @ModelView.button
     def draft(cls, servers):
@@ -284,7 +671,6 @@ class IMAPServer(ModelSQL, ModelView):
             raise UserError(gettext('imap.connection_successful',
                     account=server.rec_name))
 
-    # FIXME ConcurrencyException not handled
     @classmethod
     @ModelView.button
     def google(cls, servers):
@@ -336,28 +722,59 @@ class IMAPServer(ModelSQL, ModelView):
                 'url': f'{base_url}',
                 }
 
-    def google_refresh_token(self, credentials=None):
-        if not credentials and not self.oauth_credentials:
-            return
-        creds = (Credentials(**self.oauth_credentials)
-            if not credentials else credentials)
-        if not creds or not creds.refresh_token:
+    def get_oauth_credentials(self, force=False):
+        '''
+        Return the OAuth credentials with an access token refreshed shortly
+        before it expires. The tokens are shared by all the threads and the
+        new credentials are stored in a separate transaction, so a refresh
+        does not conflict with the transaction of the caller. The row is
+        locked without waiting, so a refresh is not stored over the one of
+        another process.
+        With force the token is refreshed even if it does not seem expired.
+        '''
+        if not self.oauth_credentials:
             return
-        creds.refresh(Request())
-        # Even only change the token value, the other values are
-        # uncommon changed, it's possible that Google chate them,
-        # special the refresh_token. So save all again.
-        self.oauth_credentials = {
-            'token': creds.token,
-            'refresh_token': creds.refresh_token,
-            'token_uri': creds.token_uri,
-            'client_id': creds.client_id,
-            'client_secret': creds.client_secret,
-            'scopes': creds.scopes,
-            }
-        self.save()
+        pool = Pool()
+        transaction = Transaction()
+        database_name = transaction.database.name
+        user = transaction.user
+        context = transaction.context
+        server_id = self.id
+        name = self.__name__
+
+        def refresh(credentials):
+            credentials, expiry = refresh_google_credentials(credentials)
+            Server = pool.get(name)
+            try:
+                with Transaction(new=True).start(database_name, user,
+                        context=context, _lock_records={
+                            Server._table: [server_id],
+                            }):
+                    server = Server(server_id)
+                    Server.lock([server])
+                    Server.write([server], {
+                            'oauth_credentials': credentials,
+                            })
+            except backend.DatabaseOperationalError:
+                logger.info('The OAuth credentials of IMAP server %s are '
+                    'not stored because they are locked', server_id)
+            except Exception:
+                logger.warning('Could not store the OAuth credentials of '
+                    'IMAP server %s', server_id, exc_info=True)
+            return credentials, expiry
+
+        key = (database_name, server_id,
+            self.oauth_credentials.get('refresh_token'))
+        return tokens.get(key, self.oauth_credentials, refresh, force=force)
+
+    def google_refresh_token(self):
+        '''
+        Refresh the access token now and return the new credentials
+        '''
+        return self.get_oauth_credentials(force=True)
 
     @classmethod
+    @instrument('connect', server=1)
     def connect(cls, server, ssl_context=None, debug=0):
         if not PRODUCTION_ENV and not Pool().test:
             logger.warning('Production mode is not enabled.')
@@ -365,33 +782,114 @@ class IMAPServer(ModelSQL, ModelView):
 
         imapper = cls.get_server(server.host, server.port, server.ssl,
             ssl_context, debug, server.timeout)
+        user, password, auth = server.get_credentials()
+        if user and password:
+            return cls.login(server, imapper, user, password, auth)
+        return
+
+    def get_credentials(self):
+        '''
+        Return the user, the password and whether the SASL authentication
+        must be used instead of LOGIN.
+        '''
         user = None
         password = None
         auth = False
-        if server.types == 'google':
-            if server.oauth_credentials is None:
+        if self.types == 'google':
+            if self.oauth_credentials is None:
                 raise UserError(gettext('imap.msg_oauth_missing'))
             else:
-                # Check if credentials has expired and refresh and refresh if it's
-                # necessary
-                creds = Credentials(**server.oauth_credentials)
-                # This is True if the credentials have a token and the token
-                # is not expired.
-                if not creds.valid:
-                    server.google_refresh_token(creds)
+                # The token is refreshed if it is about to expire
+                credentials = self.get_oauth_credentials()
                 user = 'XOAUTH2'
                 password = 'user={}\x01auth=Bearer {}\x01\x01'.format(
-                    server.email, server.oauth_credentials['token'])
+                    self.email, credentials['token'])
                 auth = True
-        elif server.types == 'outlook':
+        elif self.types == 'outlook':
             pass
         else:
-            user =  server.user
-            password =  server.password
+            user = self.user
+            password = self.password
+        return user, password, auth
 
-        if user and password:
-            return cls.login(server, imapper, user, password, auth)
-        return
+    def get_connection_fingerprint(self):
+        '''
+        Return the settings a pooled connection of the server depends on.
+        '''
+        return (self.types, self.host, self.port, self.ssl, self.timeout,
+            self.user, self.password, self.email, self.folder,
+            (self.oauth_credentials or {}).get('refresh_token'),
+            self.compression)
+
+    @classmethod
+    def acquire(cls, server):
+        '''
+        Return an authenticated connection with the folder selected, reusing
+        an idle connection of the process-wide pool when possible.
+        '''
+        key = (Transaction().database.name, server.id)
+        imapper = connections.get(key, server.get_connection_fingerprint())
+        if imapper is None:
+            imapper = cls.connect(server)
+            if imapper is None:
+                return
+            server.select_folder(imapper)
+        return imapper
+
+    @classmethod
+    def release(cls, server, imapper):
+        '''
+        Give back to the pool a connection obtained with acquire()
+        '''
+        if imapper is None or getattr(imapper, 'state', None) == 'LOGOUT':
+            return
+        key = (Transaction().database.name, server.id)
+        connections.put(key, server.get_connection_fingerprint(), imapper)
+
+    @classmethod
+    @contextmanager
+    def connection(cls, server):
+        '''
+        Context manager that acquires a pooled connection and releases it
+        on exit. The connection is closed instead if an exception is raised.
+        '''
+        imapper = cls.acquire(server)
+        try:
+            yield imapper
+        except Exception:
+            if imapper is not None:
+                cls.logout(imapper)
+            raise
+        cls.release(server, imapper)
+
+    @classmethod
+    def listen(cls, servers, callback):
+        '''
+        Start an IdleListener thread for each server, which waits for new
+        e-mails with IDLE and hands their IDs to callback.
+        Return the list of listeners.
+        '''
+        for server in servers:
+            server.check_listen()
+        transaction = Transaction()
+        listeners = []
+        for server in servers:
+            listener = IdleListener(transaction.database.name, server.id,
+                callback, user=transaction.user,
+                context=transaction.context)
+            listener.start()
+            listeners.append(listener)
+        return listeners
+
+    def check_listen(self):
+        '''
+        Raise an error if the server can not be listened to. Only the last
+        UID of the incremental mode prevents handing the same e-mails over
+        on each wake-up.
+        '''
+        if self.search_mode != 'incremental':
+            raise UserError(gettext('imap.msg_listen_incremental',
+                    server=self.rec_name))
 
     @classmethod
     def get_server(cls, host, port, ssl=False, ssl_context=None, debug=0,
@@ -409,11 +907,12 @@ class IMAPServer(ModelSQL, ModelView):
             server.debug = debug
 
         except (IMAP4.error, IMAP4.abort, IMAP4.readonly, socket.error) as e:
-            raise UserError(gettext('imap.general_error', msg=e))
+            raise command_error(e, gettext('imap.general_error', msg=e))
 
         return server
 
     @classmethod
+    @instrument('login', server=1)
     def login(cls, server, imapper, user, password, auth=False):
         '''
         Authenticates an imap connection
@@ -430,10 +929,10 @@ class IMAPServer(ModelSQL, ModelView):
             # but it's not true.
             if ('AUTHENTICATIONFAILED' in data
                     and server.types == 'google'):
-                server.google_refresh_token()
+                credentials = server.get_oauth_credentials(force=True)
                 user = 'XOAUTH2'
                 password = 'user={}\x01auth=Bearer {}\x01\x01'.format(
-                    server.email, server.oauth_credentials['token'])
+                    server.email, credentials['token'])
                 try:
                     status, data = imapper.authenticate(user,
                         lambda x: password)
@@ -446,9 +945,35 @@ class IMAPServer(ModelSQL, ModelView):
             data = str(e)
         if status != 'OK':
             cls.logout(imapper)
-            raise UserError(gettext('imap.login_error', user=user, msg=data))
+            raise command_error(data, gettext('imap.login_error',
+                    user=user, msg=data))
+        cls.refresh_capabilities(imapper)
+        if (server.compression
+                and cls.has_capability(imapper, 'COMPRESS=DEFLATE')):
+            try:
+                compress(imapper)
+            except (IMAP4.error, IMAP4.abort, socket.error) as e:
+                logger.warning('Could not compress the connection to %s: %s',
+                    server.rec_name, e)
         return imapper
 
+    @classmethod
+    def refresh_capabilities(cls, imapper):
+        '''
+        Update the capabilities of the connection, as most servers only
+        advertise the extensions (e.g. MOVE) once authenticated.
+        '''
+        try:
+            status, data = imapper.capability()
+        except (IMAP4.error, IMAP4.abort, IMAP4.readonly, socket.error):
+            return
+        if status != 'OK' or not data or not data[-1]:
+            return
+        capabilities = data[-1]
+        if isinstance(capabilities, bytes):
+            capabilities = capabilities.decode('ascii', 'replace')
+        imapper.capabilities = tuple(capabilities.upper().split())
+
     @classmethod
     def logout(cls, imapper):
         try:
@@ -457,71 +982,268 @@ class IMAPServer(ModelSQL, ModelView):
         except:
             pass
 
-    def select_folder(self, imapper):
+    @instrument('select_folder')
+    def select_folder(self, imapper, modifiers=None):
         '''
         Select the IMAP folder where to interact.
+        modifiers are the select parameters like (CONDSTORE).
         '''
         status = None
         try:
             readonly = (True if self.action_after_read == 'nothing'
                         and not self.mark_seen else False)
-            status, data = imapper.select(self.folder, readonly)
+            mailbox = self.folder
+            if modifiers:
+                mailbox = '%s %s' % (mailbox, modifiers)
+            status, data = imapper.select(mailbox, readonly)
         except (IMAP4.error, IMAP4.abort, IMAP4.readonly, socket.error) as e:
             status = 'NO'
             data = e
         if status != 'OK':
             self.logout(imapper)
-            raise UserError(
+            raise command_error(data,
                 gettext('imap.select_error', folder=self.folder, msg=data))
+        if self.use_uid or modifiers:
+            self.check_uid_validity(imapper)
 
-    def fetch_ids(self, imapper):
+    def check_uid_validity(self, imapper):
+        '''
+        Restart the incremental sync from the first UID when the UIDVALIDITY
+        of the selected folder is not the one the last UID belongs to.
+        '''
+        _, data = imapper.response('UIDVALIDITY')
+        if not data or not data[-1]:
+            return
+        uid_validity = int(data[-1])
+        if uid_validity != self.uid_validity:
+            if self.uid_validity is not None:
+                logger.info('UIDVALIDITY of "%s" changed on %s, '
+                    'fetching all the messages again.',
+                    self.folder, self.rec_name)
+                cache.clear(Transaction().database.name, self.id,
+                    self.folder, self.uid_validity)
+            self.uid_validity = uid_validity
+            self.last_uid = None
+            self.highest_modseq = None
+            self.save_checkpoint()
+
+    @instrument('fetch_ids', count=_count_ids)
+    def fetch_ids(self, imapper, complete=None):
         '''
         Obtain the next set of e-mail IDs according to the configuration
         defined on the server object.
+        Whether they are all the e-mails found (i.e. not cut by max_messages)
+        is appended to complete, if it is a list.
         '''
         self.select_folder(imapper)
         status = None
+        criterion = self.get_criterion_used()
+        # The messages received while searching are in the next interval
+        now = datetime.datetime.now()
+        args = self.get_search_args(imapper, criterion)
         try:
-            status, data = imapper.search(None, self.criterion_used)
-            self.last_retrieve_date = datetime.date.today()
-            self.save()
+            if self.use_uid:
+                status, data = imapper.uid('SEARCH', *args)
+            else:
+                status, data = imapper.search(None, *args)
         except (IMAP4.error, IMAP4.abort, IMAP4.readonly, socket.error) as e:
             status = 'NO'
             data = e
         if status != 'OK':
             self.logout(imapper)
-            raise UserError(
+            raise command_error(data,
                 gettext('imap.search_error',
-                        criteria=self.criterion_used,
+                        criteria=criterion,
                         msg=data))
-        return data[0].split()
+        emailids, found_all = self.get_search_ids(imapper, data)
+        if complete is not None:
+            complete.append(found_all)
+        if self.search_mode == 'interval' and found_all:
+            self.last_retrieve_date = now
+            self.save_checkpoint()
+        return emailids
+
+    def get_search_args(self, imapper, criterion):
+        '''
+        Return the arguments of the SEARCH command for criterion, which
+        returns a compact sequence set if the server supports ESEARCH.
+        '''
+        if self.has_capability(imapper, 'ESEARCH'):
+            return ('RETURN', '(MIN MAX COUNT ALL)', criterion)
+        return (criterion,)
+
+    def get_search_ids(self, imapper, data):
+        '''
+        Return the e-mail IDs of the result of a SEARCH command, the oldest
+        max_messages only on incremental mode, and whether all of them are
+        returned.
+        '''
+        if self.has_capability(imapper, 'ESEARCH'):
+            _, data = imapper.response('ESEARCH')
+            match = _ESEARCH_ALL.search(data[-1] or b'')
+            emailids = (str(n).encode()
+                for n in iter_sequence_set(match.group(1) if match else b''))
+        else:
+            emailids = iter((data[0] or b'').split())
+        if self.use_uid:
+            # "n:*" always includes the last message even if its UID is
+            # lower than n
+            last_uid = self.last_uid or 0
+            emailids = (e for e in emailids if int(e) > last_uid)
+        # Only the last UID resumes after the e-mails left out (the search
+        # mode of a folder may not be the one of the server)
+        if not self.max_messages or not self.use_uid:
+            return list(emailids), True
+        # The IDs are sorted by arrival, so the first are the oldest
+        result = list(islice(emailids, self.max_messages))
+        complete = next(emailids, None) is None
+        if not complete:
+            logger.info('Only %s e-mails of %s are fetched on this run.',
+                self.max_messages, self.rec_name)
+        return result, complete
+
+    def fetch_changes(self, imapper, uids=None):
+        '''
+        Select the folder and return the flags of the e-mails changed since
+        the last call, as a dictionary by UID, and the list of UIDs of the
+        e-mails expunged since then. Only the e-mails of uids are checked
+        when it is given.
+        With QRESYNC (RFC 7162) the SELECT command returns the changes
+        itself, with CONDSTORE only the flags changed are fetched and,
+        otherwise, the flags of all the e-mails are fetched and the
+        expunged e-mails are searched.
+        The HIGHESTMODSEQ of the folder is stored for the next call.
+        '''
+        uid_validity = self.uid_validity
+        highest_modseq = self.highest_modseq
+        qresync = (self.has_capability(imapper, 'QRESYNC')
+            and self.has_capability(imapper, 'ENABLE'))
+        condstore = qresync or self.has_capability(imapper, 'CONDSTORE')
+        message_set = sequence_set(uids) if uids else '1:*'
+        modifiers = None
+        status = 'OK'
+        try:
+            if qresync:
+                self.enable(imapper, 'QRESYNC')
+            if qresync and uid_validity and highest_modseq:
+                modifiers = '(QRESYNC (%s %s%s))' % (uid_validity,
+                    highest_modseq, ' ' + message_set if uids else '')
+            elif condstore:
+                modifiers = '(CONDSTORE)'
+        except (IMAP4.error, IMAP4.abort, IMAP4.readonly, socket.error) as e:
+            status = 'NO'
+            data = e
+        if status != 'OK':
+            self.logout(imapper)
+            raise command_error(data, gettext('imap.select_error',
+                    folder=self.folder, msg=data))
+        self.select_folder(imapper, modifiers)
+        changes = []
+        vanished = []
+        _, data = imapper.response('HIGHESTMODSEQ')
+        modseq = data[-1].decode() if data and data[-1] else None
+        if uid_validity is not None and self.uid_validity != uid_validity:
+            # The UIDs are not valid anymore
+            vanished = [int(u) for u in uids or []]
+        elif modifiers and modifiers.startswith('(QRESYNC'):
+            _, data = imapper.response('VANISHED')
+            for value in data:
+                if value:
+                    vanished.extend(parse_sequence_set(
+                            value.replace(b'(EARLIER)', b'')))
+            _, changes = imapper.response('FETCH')
+        else:
+            try:
+                args = []
+                if condstore and highest_modseq:
+                    args.append('(CHANGEDSINCE %s)' % highest_modseq)
+                status, changes = imapper.uid('FETCH', message_set,
+                    '(UID FLAGS)', *args)
+                if status == 'OK' and uids:
+                    status, data = imapper.uid('SEARCH', 'UID', message_set)
+                    found = {int(u) for u in data[0].split()}
+                    vanished = [int(u) for u in uids if int(u) not in found]
+            except (IMAP4.error, IMAP4.abort, IMAP4.readonly,
+                    socket.error) as e:
+                status = 'NO'
+                changes = e
+            if status != 'OK':
+                self.logout(imapper)
+                raise command_error(changes, gettext('imap.fetch_error',
+                        email=message_set, msg=changes))
+        if uids:
+            known = {int(u) for u in uids}
+            vanished = [u for u in vanished if u in known]
+        flags = {}
+        for change in changes:
+            if not change:
+                continue
+            values = parse_response([change])
+            if 'UID' in values:
+                flags[int(values['UID'])] = [
+                    f.decode() for f in values.get('FLAGS') or []]
+        if modseq != self.highest_modseq:
+            self.highest_modseq = modseq
+            self.save_checkpoint()
+        return flags, vanished
 
+    @instrument('fetch_one', count=_count_fetched)
     def fetch_one(self, imapper, emailid, parts='(UID RFC822)'):
         '''
         Fetch the content of a single e-mail ID obtained using fetch_ids()
         '''
         result = {}
         try:
-            status, data = imapper.fetch(emailid, parts)
+            status, data = self._command(imapper, 'FETCH', emailid, parts)
         except (IMAP4.error, IMAP4.abort, IMAP4.readonly, socket.error) as e:
             status = 'KO'
             data = e
         if status != 'OK':
             self.logout(imapper)
-            raise UserError(gettext('imap.fetch_error', email=emailid,
-                                    msg=data))
+            raise command_error(data, gettext('imap.fetch_error',
+                    email=emailid, msg=data))
         result[emailid] = data
         return result
 
+    @instrument('fetch_batch', count=_count_fetched)
+    def fetch_batch(self, imapper, emailids, parts='(UID RFC822)'):
+        '''
+        Fetch the content of several e-mail IDs obtained using fetch_ids()
+        with a single FETCH command over a compressed sequence set.
+        '''
+        result = {}
+        if not emailids:
+            return result
+        numbers = {int(emailid): emailid for emailid in emailids}
+        message_set = sequence_set(emailids)
+        try:
+            status, data = self._command(imapper, 'FETCH', message_set,
+                parts)
+        except (IMAP4.error, IMAP4.abort, IMAP4.readonly, socket.error) as e:
+            status = 'KO'
+            data = e
+        if status != 'OK':
+            self.logout(imapper)
+            raise command_error(data, gettext('imap.fetch_error',
+                    email=message_set, msg=data))
+        for number, message in split_fetch_response(data, self.use_uid):
+            # Skip unsolicited FETCH responses of other messages
+            if number in numbers:
+                result.setdefault(numbers[number], []).extend(message)
+        return result
+
+    @instrument('set_flag_seen')
     def set_flag_seen(self, imapper, emailid):
         '''
-        Mark email as seen if the flag is set to True
+        Mark email as seen if the flag is set to True.
+        The emailid may also be a sequence set of several e-mails.
         '''
         if not imapper or not emailid:
             return
         try:
             if self.mark_seen:
-                status, data = imapper.store(emailid, '+FLAGS', '\\Seen')
+                status, data = self._command(imapper, 'STORE', emailid,
+                    '+FLAGS', '\\Seen')
             else:
                 status = 'OK'
         except (IMAP4.error, IMAP4.abort, IMAP4.readonly, socket.error) as e:
@@ -529,56 +1251,654 @@ class IMAPServer(ModelSQL, ModelView):
             data = e
         if status != 'OK':
             self.logout(imapper)
-            raise UserError(gettext('imap.fetch_error', email=emailid,
-                                    msg=data))
+            raise command_error(data, gettext('imap.fetch_error',
+                    email=emailid, msg=data))
 
-    def fetch(self, imapper, parts='(UID RFC822)'):
+    def iter_fetch(self, imapper, parts='(UID RFC822)', batch_size=None,
+            skipped=None, complete=None, buffers=False):
         '''
         Fetch the next set of e-mails according to the configuration defined
-        on the server object. It equivalent to calling fetch_ids() and calling
-        fetch_one() for each e-mail ID.
+        on the server object and yield an (e-mail ID, data) tuple for each
+        one as soon as it is downloaded.
+        Only one batch of e-mails is kept in memory at a time, so callers
+        may process (and commit) each e-mail before the next is fetched.
+        On incremental mode, the last UID is moved once the caller has
+        processed each batch but stored with a single write once all of
+        them are processed (a caller that stops before must call
+        save_checkpoint()).
+        The e-mails are marked as seen with a single STORE per batch, or
+        none at all when parts already sets the flag (e.g. RFC822).
+        When skip_duplicates is set, the e-mails already processed are not
+        downloaded (or not yielded if they do not have a Message-ID) but
+        marked as seen and appended to skipped, if it is a list, so the
+        caller can run the action after read on them.
+        complete is given to fetch_ids().
+        When use_cache is set, the whole e-mails (RFC822 or BODY[]) found
+        on the local cache are not downloaded again. Their literal is bytes
+        unless buffers is set, then it is a read-only memoryview of the
+        memory-mapped message to not copy it.
+        When spool_threshold is set, the whole e-mails bigger than it are
+        downloaded in chunks to a temporary file, which is the literal of
+        their data instead of bytes.
+        When max_size is set, the e-mails bigger than it are never yielded
+        but handled with handle_oversized().
+        '''
+        if batch_size is None:
+            batch_size = self.fetch_batch_size or 1
+        sets_seen = bool(_FETCH_SETS_SEEN.search(parts))
+        store_seen = self.mark_seen and not sets_seen
+        full = _FETCH_FULL.match(parts)
+        cache_item = None
+        if self.use_cache and self.use_uid and full:
+            cache_item = full.group(1).upper().replace('.PEEK', '')
+        spool = bool(self.spool_threshold and full)
+        emailids = self.fetch_ids(imapper, complete=complete)
+        last_uid = self.last_uid
+        for i in range(0, len(emailids), batch_size):
+            batch = emailids[i:i + batch_size]
+            pending = batch
+            sizes = {}
+            if self.max_size or spool:
+                sizes = self.get_sizes(imapper, batch)
+            if self.max_size:
+                oversized = [e for e in batch
+                    if sizes.get(e, (None, 0))[1] > self.max_size]
+                if oversized:
+                    self.handle_oversized(imapper, oversized, sizes)
+                    pending = [e for e in batch if e not in oversized]
+            duplicates = []
+            if self.skip_duplicates:
+                message_ids = self.get_message_ids(imapper, pending)
+                unprocessed = self.filter_processed(pending, message_ids)
+                duplicates = [e for e in pending if e not in unprocessed]
+                if duplicates and self.mark_seen:
+                    # They are not fetched so nothing sets the flag
+                    self.set_flag_seen(imapper, sequence_set(duplicates))
+                pending = unprocessed
+            cached = {}
+            if cache_item:
+                cached = self.get_cached(pending, cache_item,
+                    buffers=buffers)
+            to_fetch = [e for e in pending if e not in cached]
+            spooled = {}
+            if spool and to_fetch:
+                for emailid in to_fetch:
+                    _, size = sizes.get(emailid, (None, 0))
+                    if size > self.spool_threshold:
+                        spooled[emailid] = self.get_spooled_response(
+                            emailid, self.fetch_spooled(imapper, emailid,
+                                size, seen=sets_seen))
+                if spooled:
+                    to_fetch = [e for e in to_fetch if e not in spooled]
+                    if store_seen:
+                        self.set_flag_seen(imapper, sequence_set(spooled))
+            if to_fetch and batch_size > 1:
+                result = self.fetch_batch(imapper, to_fetch, parts)
+                if store_seen:
+                    self.set_flag_seen(imapper, sequence_set(to_fetch))
+            elif to_fetch:
+                result = self.fetch_one(imapper, to_fetch[0], parts)
+                if store_seen:
+                    self.set_flag_seen(imapper, to_fetch[0])
+            else:
+                result = {}
+            if cache_item:
+                self.set_cached(result)
+                if self.mark_seen and cached:
+                    # No FETCH has set the flag of the cached e-mails
+                    self.set_flag_seen(imapper, sequence_set(cached))
+                result.update(cached)
+            result.update(spooled)
+            if self.skip_duplicates:
+                fetched = set(result)
+                body_hashes = self.filter_processed_contents(result)
+                duplicates.extend(e for e in pending
+                    if e in fetched and e not in result)
+            processed = []
+            for emailid in pending:
+                if emailid in result:
+                    yield emailid, result.pop(emailid)
+                    processed.append(emailid)
+            if self.skip_duplicates:
+                self.set_processed(processed, message_ids, body_hashes)
+            if skipped is not None:
+                skipped.extend(duplicates)
+            self.set_last_uid(batch, save=False)
+        if self.last_uid != last_uid:
+            self.save_checkpoint()
+
+    def iter_messages(self, imapper, parts='(UID RFC822)', batch_size=None):
+        '''
+        Like iter_fetch() but yield a RawMessage for each e-mail, which
+        parses the headers and the body only when they are accessed.
+        parts must fetch the whole e-mail (RFC822 or BODY[]) and may also
+        fetch FLAGS, RFC822.SIZE and INTERNALDATE.
+        '''
+        for emailid, data in self.iter_fetch(imapper, parts, batch_size,
+                buffers=True):
+            yield RawMessage.from_response(emailid, data)
+
+    def get_message_ids(self, imapper, emailids):
+        '''
+        Return a dictionary with the Message-ID header of emailids
+        '''
+        result = self.fetch_batch(imapper, emailids,
+            '(UID BODY.PEEK[HEADER.FIELDS (MESSAGE-ID)])')
+        message_ids = {}
+        for emailid, data in result.items():
+            for name, value in parse_response(data).items():
+                if name.startswith('BODY[') and isinstance(value, bytes):
+                    message_id = email.message_from_bytes(value).get(
+                        'Message-ID')
+                    if message_id and message_id.strip():
+                        message_ids[emailid] = message_id.strip()
+        return message_ids
+
+    def filter_processed(self, emailids, message_ids):
+        '''
+        Return the emailids whose Message-ID has not been processed yet
+        '''
+        ProcessedMessage = Pool().get('imap.server.message')
+        known = set()
+        values = list(set(message_ids.values()))
+        if values:
+            known = {m.message_id for m in ProcessedMessage.search([
+                        ('server', '=', self.id),
+                        ('message_id', 'in', values),
+                        ])}
+        return [e for e in emailids if message_ids.get(e) not in known]
+
+    def filter_processed_contents(self, result):
+        '''
+        Remove from result the e-mails whose content has been processed and
+        return a dictionary with the hash of the content of the others.
+        '''
+        ProcessedMessage = Pool().get('imap.server.message')
+        body_hashes = {}
+        for emailid, data in result.items():
+            content = get_literal(data)
+            if content is None:
+                continue
+            if isinstance(content, (bytes, memoryview)):
+                body_hash = hashlib.sha256(content)
+            else:
+                body_hash = hashlib.sha256()
+                for chunk in iter(lambda: content.read(SPOOL_CHUNK_SIZE),
+                        b''):
+                    body_hash.update(chunk)
+                content.seek(0)
+            body_hashes[emailid] = body_hash.hexdigest()
+        if body_hashes:
+            known = {m.body_hash for m in ProcessedMessage.search([
+                        ('server', '=', self.id),
+                        ('body_hash', 'in', list(set(body_hashes.values()))),
+                        ])}
+            for emailid, body_hash in list(body_hashes.items()):
+                if body_hash in known:
+                    logger.debug('Skip e-mail %s of %s already processed',
+                        emailid, self.rec_name)
+                    del result[emailid]
+                    del body_hashes[emailid]
+        return body_hashes
+
+    def set_processed(self, emailids, message_ids, body_hashes):
+        '''
+        Remember emailids as processed
+        '''
+        ProcessedMessage = Pool().get('imap.server.message')
+        if emailids:
+            ProcessedMessage.create([{
+                        'server': self.id,
+                        'message_id': message_ids.get(e),
+                        'body_hash': body_hashes.get(e),
+                        } for e in emailids])
+
+    def _cache_key(self, emailid):
+        # The UIDVALIDITY is only unique for a folder
+        return (Transaction().database.name, self.id, self.folder,
+            self.uid_validity, int(emailid))
+
+    def get_cached(self, emailids, item='RFC822', buffers=False):
+        '''
+        Return a dictionary with the FETCH response of the emailids found on
+        the local cache, as if the data item had been fetched. With buffers
+        the literal is the read-only memoryview of the memory-mapped message
+        instead of a copy as bytes.
         '''
-        emailids = self.fetch_ids(imapper)
         result = {}
+        if self.uid_validity is None:
+            return result
         for emailid in emailids:
-            result.update(self.fetch_one(imapper, emailid, parts))
-            self.set_flag_seen(imapper, emailid)
+            content = cache.get(self._cache_key(emailid))
+            if content is None:
+                continue
+            if not buffers:
+                with content:
+                    content = content.tobytes()
+            uid = int(emailid)
+            result[emailid] = [(b'%d (UID %d %s {%d}' % (uid, uid,
+                        item.encode(), len(content)), content), b')']
         return result
 
-    def copy_email_to(self, imapper, emailid):
+    def set_cached(self, result):
+        '''
+        Store on the local cache the whole e-mails of a FETCH result
+        '''
+        if self.uid_validity is None:
+            return
+        for emailid, data in result.items():
+            content = get_literal(data)
+            # The spooled e-mails are too big for the cache
+            if isinstance(content, bytes):
+                cache.put(self._cache_key(emailid), content)
+
+    def get_sizes(self, imapper, emailids):
+        '''
+        Return a dictionary with the UID and the RFC822.SIZE of emailids
+        '''
+        sizes = {}
+        numbers = {int(emailid): emailid for emailid in emailids}
+        for i in range(0, len(emailids), _MAX_SET_IDS):
+            message_set = sequence_set(emailids[i:i + _MAX_SET_IDS])
+            try:
+                status, data = self._command(imapper, 'FETCH', message_set,
+                    '(UID RFC822.SIZE)')
+            except (IMAP4.error, IMAP4.abort, IMAP4.readonly,
+                    socket.error) as e:
+                status = 'KO'
+                data = e
+            if status != 'OK':
+                self.logout(imapper)
+                raise command_error(data, gettext('imap.fetch_error',
+                        email=message_set, msg=data))
+            for number, message in split_fetch_response(data,
+                    self.use_uid):
+                values = parse_response(message)
+                uid, size = values.get('UID'), values.get('RFC822.SIZE')
+                if number in numbers and size is not None:
+                    sizes[numbers[number]] = (
+                        int(uid) if uid is not None else None, int(size))
+        return sizes
+
+    def handle_oversized(self, imapper, emailids, sizes):
+        '''
+        Skip, defer or move to the quarantine folder the emailids bigger
+        than max_size, according to the oversize action, and report them as
+        imap.server.oversized. sizes is the result of get_sizes().
+        '''
+        Oversized = Pool().get('imap.server.oversized')
+        action = self.oversize_action or 'skip'
+        if not self.use_uid:
+            # The sequence numbers change when the e-mails are moved and
+            # can not be fetched later
+            action = 'skip'
+        if action == 'quarantine':
+            self.quarantine(imapper, sequence_set(emailids))
+        # Outside incremental mode the skipped e-mails are found again on
+        # each run
+        known = {o.uid for o in Oversized.search([
+                    ('server', '=', self.id),
+                    ('folder', '=', self.folder),
+                    ('uid_validity', '=', self.uid_validity),
+                    ('uid', 'in', [sizes[e][0] for e in emailids]),
+                    ])}
+        emailids = [e for e in emailids if sizes[e][0] not in known]
+        if not emailids:
+            return
+        uids = [sizes[e][0] for e in emailids]
+        logger.info('%s oversized e-mails of "%s" on %s: %s',
+            {'skip': 'Skip', 'defer': 'Defer', 'quarantine': 'Quarantine'}[
+                action], self.folder, self.rec_name,
+            ', '.join(map(str, uids)))
+        metrics.increment('oversized.messages', len(emailids),
+            server=self.id)
+        Oversized.create([{
+                    'server': self.id,
+                    'folder': self.folder,
+                    'uid_validity': self.uid_validity,
+                    'uid': sizes[e][0],
+                    'size': sizes[e][1],
+                    'state': {
+                        'skip': 'skipped',
+                        'defer': 'deferred',
+                        'quarantine': 'quarantined',
+                        }[action],
+                    } for e in emailids])
+
+    def quarantine(self, imapper, emailid):
+        '''
+        Move the emailid to the quarantine folder with a single command.
+        The emailid may also be a sequence set of several e-mails.
+        '''
+        if self.has_capability(imapper, 'MOVE'):
+            self.move_email_to(imapper, emailid, self.quarantine_folder)
+            return
+        self.copy_email_to(imapper, emailid, self.quarantine_folder)
+        self.delete_email(imapper, emailid)
+        if self.use_uid and self.has_capability(imapper, 'UIDPLUS'):
+            self.expunge_email(imapper, emailid)
+        else:
+            self.expunge_email(imapper)
+
+    def process_deferred(self):
+        '''
+        Download with fetch_spooled() the e-mails deferred because of their
+        size, process each one with process_email() and run the action after
+        read on them.
+        Return the number of e-mails processed.
+        '''
+        Oversized = Pool().get('imap.server.oversized')
+        deferred = Oversized.search([
+                ('server', '=', self.id),
+                ('state', '=', 'deferred'),
+                ], order=[('folder', 'ASC'), ('uid', 'ASC')])
+        if not deferred:
+            return 0
+        servers = {self.folder: self}
+        for folder in self.folders:
+            servers[folder.name] = self.get_folder_server(folder)
+        count = 0
+        with self.connection(self) as imapper:
+            if imapper is None:
+                return 0
+            for folder, records in groupby(deferred, lambda r: r.folder):
+                server = servers.get(folder)
+                if server is None:
+                    continue
+                server.select_folder(imapper)
+                emailids = []
+                for record in records:
+                    if record.uid_validity != server.uid_validity:
+                        # The UID is not the one of the e-mail anymore
+                        record.state = 'skipped'
+                        continue
+                    emailid = str(record.uid).encode()
+                    spool = server.fetch_spooled(imapper, emailid,
+                        record.size, seen=server.mark_seen)
+                    server.process_email(emailid,
+                        server.get_spooled_response(emailid, spool))
+                    record.state = 'fetched'
+                    emailids.append(emailid)
+                # The last UID is already after them
+                if emailids and server.action_after_read != 'nothing':
+                    server.action_after(imapper, emailids)
+                server.flush_checkpoint()
+                count += len(emailids)
+        Oversized.save(deferred)
+        return count
+
+    @classmethod
+    def fetch_deferred(cls, servers=None):
+        '''
+        Process the deferred e-mails of the servers, all the ones with
+        deferred e-mails by default. To be run by a scheduled task.
+        '''
+        Oversized = Pool().get('imap.server.oversized')
+        if servers is None:
+            servers = list({o.server for o in Oversized.search([
+                            ('state', '=', 'deferred'),
+                            ])})
+        for server in servers:
+            try:
+                server.process_deferred()
+            except UserError as e:
+                logger.warning('Could not fetch the deferred e-mails of %s: '
+                    '%s', server.rec_name, e)
+
+    @instrument('fetch_spooled', count=_count_spooled)
+    def fetch_spooled(self, imapper, emailid, size, seen=False):
+        '''
+        Download the whole content of a single e-mail of size bytes with a
+        partial FETCH for each chunk of SPOOL_CHUNK_SIZE bytes and return it
+        as a temporary file, so it is never held in memory.
+        The e-mail is marked as seen only if seen is set.
+        '''
+        item = 'BODY[]' if seen else 'BODY.PEEK[]'
+        spool = tempfile.SpooledTemporaryFile(
+            max_size=self.spool_threshold or 0)
+        offset = 0
+        while offset < size:
+            try:
+                status, data = self._command(imapper, 'FETCH', emailid,
+                    '(%s<%d.%d>)' % (item, offset, SPOOL_CHUNK_SIZE))
+            except (IMAP4.error, IMAP4.abort, IMAP4.readonly,
+                    socket.error) as e:
+                status = 'KO'
+                data = e
+            if status != 'OK':
+                spool.close()
+                self.logout(imapper)
+                raise command_error(data, gettext('imap.fetch_error',
+                        email=emailid, msg=data))
+            chunk = None
+            for _, message in split_fetch_response(data):
+                chunk = parse_response(message).get('BODY[]')
+                if chunk is not None:
+                    break
+            if not chunk:
+                # The e-mail is smaller than its RFC822.SIZE
+                break
+            spool.write(chunk)
+            offset += len(chunk)
+        spool.seek(0)
+        return spool
+
+    def get_spooled_response(self, emailid, spool):
+        '''
+        Return the FETCH response of a spooled e-mail as if its whole
+        content had been fetched, with spool as literal.
+        '''
+        size = spool.seek(0, os.SEEK_END)
+        spool.seek(0)
+        number = int(emailid)
+        if self.use_uid:
+            line = b'%d (UID %d BODY[] {%d}' % (number, number, size)
+        else:
+            line = b'%d (BODY[] {%d}' % (number, size)
+        return [(line, spool), b')']
+
+    def iter_fetch_headers(self, imapper, headers=_HEADERS, batch_size=None,
+            max_part_size=None):
+        '''
+        Fetch the envelope, the structure and the headers of the next set
+        of e-mails and yield a LazyMessage for each one, which downloads
+        the MIME parts only when they are requested. The parts bigger than
+        max_part_size bytes are never downloaded.
+        The e-mails are not marked as seen, as their content is not read.
+        The last UID is stored like iter_fetch() does.
+        '''
+        if batch_size is None:
+            batch_size = self.fetch_batch_size or 1
+        parts = ('(UID FLAGS RFC822.SIZE ENVELOPE BODYSTRUCTURE '
+            'BODY.PEEK[HEADER.FIELDS (%s)])' % ' '.join(headers))
+        emailids = self.fetch_ids(imapper)
+        last_uid = self.last_uid
+        for i in range(0, len(emailids), batch_size):
+            batch = emailids[i:i + batch_size]
+            result = self.fetch_batch(imapper, batch, parts)
+            for emailid in batch:
+                if emailid in result:
+                    yield LazyMessage(self, imapper, emailid,
+                        result.pop(emailid), max_part_size=max_part_size)
+            self.set_last_uid(batch, save=False)
+        if self.last_uid != last_uid:
+            self.save_checkpoint()
+
+    def fetch_headers(self, imapper, headers=_HEADERS, batch_size=None,
+            max_part_size=None):
+        '''
+        Return the list of LazyMessage of the next set of e-mails.
+        See iter_fetch_headers().
+        '''
+        return list(self.iter_fetch_headers(imapper, headers, batch_size,
+                max_part_size))
+
+    def fetch_part(self, imapper, emailid, number):
+        '''
+        Fetch the content of the MIME part number of a single e-mail
+        without marking it as seen.
+        '''
+        result = self.fetch_batch(imapper, [emailid],
+            '(BODY.PEEK[%s])' % number)
+        return result.get(emailid, [])
+
+    def set_last_uid(self, emailids, save=True):
+        '''
+        Store the highest UID of emailids as the last UID fetched when
+        working on incremental mode. Without save it is only set, to be
+        stored by the next save_checkpoint().
+        '''
+        if not self.use_uid or not emailids:
+            return
+        last_uid = max(int(e) for e in emailids)
+        if last_uid > (self.last_uid or 0):
+            self.last_uid = last_uid
+            if save:
+                self.save_checkpoint()
+
+    def save_checkpoint(self):
+        '''
+        Store the fields that track the synchronization of the folder,
+        unless the server has been returned by get_folder_server(), which
+        stores them only once the run succeeds with flush_checkpoint().
+        '''
+        if not self._context.get('imap_checkpoint'):
+            self.flush_checkpoint()
+
+    def flush_checkpoint(self):
+        '''
+        Store the fields that track the synchronization of the folder, on
+        the folder record when working on one of the other folders.
+        '''
+        folder_id = self._context.get('imap_folder')
+        if folder_id is None:
+            # Only the modified fields are written
+            self.save()
+            return
+        Folder = Pool().get('imap.server.folder')
+        folder = Folder(folder_id)
+        values = {name: getattr(self, name) for name in _CHECKPOINT_FIELDS
+            if getattr(self, name) != getattr(folder, name)}
+        if values:
+            Folder.write([folder], values)
+
+    def get_folder_server(self, folder=None):
+        '''
+        Return the server to synchronize one of its other folders, with the
+        folder, the settings and the synchronization state of it, or its own
+        folder if folder is None.
+        The synchronization state is stored by flush_checkpoint() only.
+        '''
+        values = {}
+        context = {'imap_checkpoint': True}
+        if folder is not None:
+            values['folder'] = folder.name
+            for name in ['search_mode', 'criterion', 'action_after_read',
+                    'destination_folder']:
+                if getattr(folder, name):
+                    values[name] = getattr(folder, name)
+            for name in _CHECKPOINT_FIELDS:
+                values[name] = getattr(folder, name)
+            context['imap_folder'] = folder.id
+        with Transaction().set_context(**context):
+            return self.__class__(self.id, **values)
+
+    def fetch(self, imapper, parts='(UID RFC822)', batch_size=None):
+        '''
+        Fetch the next set of e-mails according to the configuration defined
+        on the server object. It equivalent to calling fetch_ids() and calling
+        fetch_one() for each e-mail ID, or fetch_batch() for each chunk of
+        batch_size e-mail IDs when the batch size is greater than 1.
+        Use iter_fetch() to avoid holding all the e-mails in memory.
+        '''
+        return dict(self.iter_fetch(imapper, parts, batch_size))
+
+    def copy_email_to(self, imapper, emailid, folder=None):
         '''
         Copy the email to the destionation folder deffined in the configuration
-        server.
+        server or to folder. The emailid may also be a sequence set of
+        several e-mails.
+        '''
+        try:
+            status, data = self._command(imapper, 'COPY', emailid,
+                folder or self.destination_folder)
+        except (IMAP4.error, IMAP4.abort, IMAP4.readonly, socket.error) as e:
+            status = 'KO'
+            data = e
+        if status != 'OK':
+            self.logout(imapper)
+            raise command_error(data, gettext('imap.fetch_error',
+                    email=emailid, msg=data))
+
+    def move_email_to(self, imapper, emailid, folder=None):
+        '''
+        Move the email to the destination folder deffined in the configuration
+        server or to folder using the MOVE extension (RFC 6851). The emailid
+        may also be a sequence set of several e-mails.
         '''
         try:
-            status, data = imapper.copy(emailid, self.destination_folder)
+            status, data = self._command(imapper, 'MOVE', emailid,
+                folder or self.destination_folder)
         except (IMAP4.error, IMAP4.abort, IMAP4.readonly, socket.error) as e:
             status = 'KO'
             data = e
         if status != 'OK':
             self.logout(imapper)
-            raise UserError(gettext('imap.fetch_error', email=emailid,
-                                    msg=data))
+            raise command_error(data, gettext('imap.fetch_error',
+                    email=emailid, msg=data))
 
     def delete_email(self, imapper, emailid):
         '''
         Delete the email from the main folder deffined in the configuration
-        server.
+        server. The emailid may also be a sequence set of several e-mails.
+        '''
+        try:
+            status, data = self._command(imapper, 'STORE', emailid,
+                '+FLAGS', '\\Deleted')
+        except (IMAP4.error, IMAP4.abort, IMAP4.readonly, socket.error) as e:
+            status = 'KO'
+            data = e
+        if status != 'OK':
+            self.logout(imapper)
+            raise command_error(data, gettext('imap.fetch_error',
+                    email=emailid, msg=data))
+
+    def expunge_email(self, imapper, emailid=None):
+        '''
+        Remove the e-mails flagged as deleted from the folder, only the
+        emailid (a sequence set of UIDs) when it is given, with UID EXPUNGE
+        (UIDPLUS, RFC 4315).
         '''
         try:
-            status, data = imapper.store(emailid, '+FLAGS', '\\Deleted')
+            if emailid is not None:
+                status, data = imapper.uid('EXPUNGE', emailid)
+            else:
+                status, data = imapper.expunge()
         except (IMAP4.error, IMAP4.abort, IMAP4.readonly, socket.error) as e:
             status = 'KO'
             data = e
         if status != 'OK':
             self.logout(imapper)
-            raise UserError(gettext('imap.fetch_error', email=emailid,
-                                    msg=data))
+            raise command_error(data, gettext('imap.fetch_error',
+                    email=emailid, msg=data))
 
+    def get_message_sets(self, emailids):
+        '''
+        Return the sequence sets of at most _MAX_SET_IDS e-mails each of
+        emailids. When they are sequence numbers, the highest come first as
+        the e-mails expunged (e.g. by MOVE) renumber the following ones.
+        '''
+        emailids = sorted(emailids, key=int, reverse=not self.use_uid)
+        return [sequence_set(emailids[i:i + _MAX_SET_IDS])
+            for i in range(0, len(emailids), _MAX_SET_IDS)]
+
+    @instrument('action_after')
     def action_after(self, imapper, emailids=None):
         '''
         With specific IDs or the same filter deffined for the fetch,
         do some extra actions on this emails in IMAP server.
+        On incremental mode the IDs are required, as fetch() has already
+        stored the last UID so the same filter finds none of them.
         '''
         # select IMAP folder before act on any email of this folder
         self.select_folder(imapper)
@@ -586,16 +1906,794 @@ class IMAPServer(ModelSQL, ModelView):
         status = None
         if ((self.action_after_read == 'move' and self.destination_folder)
                 or self.action_after_read == 'delete'):
-            if not emailids:
+            if emailids is None and self.use_uid:
+                raise UserError(gettext('imap.msg_action_after_ids',
+                        server=self.rec_name))
+            if not emailids and not self.use_uid:
                 emailids = self.fetch_ids(imapper)
-            for emailid in emailids:
-                if self.action_after_read == 'move':
-                    self.copy_email_to(imapper, emailid)
-                self.delete_email(imapper, emailid)
-            if emailids:
-                imapper.expunge()
+            move = self.action_after_read == 'move'
+            use_move = move and self.has_capability(imapper, 'MOVE')
+            use_uid_expunge = (self.use_uid
+                and self.has_capability(imapper, 'UIDPLUS'))
+            for message_set in self.get_message_sets(emailids):
+                if use_move:
+                    self.move_email_to(imapper, message_set)
+                    continue
+                if move:
+                    self.copy_email_to(imapper, message_set)
+                self.delete_email(imapper, message_set)
+                if use_uid_expunge:
+                    # Only expunge the messages deleted here
+                    self.expunge_email(imapper, message_set)
+            if emailids and not use_move and not use_uid_expunge:
+                self.expunge_email(imapper)
         return status
 
+    def process_email(self, emailid, data):
+        '''
+        Process an e-mail downloaded by sync_emails().
+        To be extended by the modules that consume the e-mails.
+        '''
+        pass
+
+    def sync_emails(self):
+        '''
+        Fetch the next set of e-mails with a pooled connection, process each
+        one with process_email() and run the action after read on them.
+        The other folders are synchronized with the same connection, the
+        ones whose STATUS has not changed since the last time are skipped.
+        process_email() is called on the server returned by
+        get_folder_server() for each folder, so the synchronization state
+        is stored once per folder at the end of the run.
+        When the connection is lost, it is opened again after backoff()
+        seconds, at most SYNC_RETRIES times, and the synchronization resumes
+        after the last e-mail processed on incremental mode. On the other
+        modes it only resumes if no e-mail of the folder has been processed
+        yet.
+        Return the number of e-mails processed.
+        '''
+        # The state of the folders is kept between the connections
+        servers = {}
+        statuses = {}
+        processed = defaultdict(list)
+        skipped = defaultdict(list)
+        retries = defaultdict(int)
+        done = set()
+        count = 0
+        retry = 0
+        current = None
+        while True:
+            try:
+                with self.connection(self) as imapper:
+                    if imapper is None:
+                        return count
+                    for folder in [None] + list(self.folders):
+                        current = folder.id if folder else None
+                        if current in done:
+                            continue
+                        if folder and current not in servers:
+                            status = statuses[current] = folder.get_status(
+                                imapper)
+                            if not folder.has_changed(status):
+                                logger.debug('Skip folder "%s" of %s '
+                                    'without changes',
+                                    folder.name, self.rec_name)
+                                done.add(current)
+                                continue
+                        if current not in servers:
+                            servers[current] = self.get_folder_server(
+                                folder)
+                        synced, complete = servers[current].sync_folder(
+                            imapper, processed[current],
+                            retries.pop(current, 0), skipped[current])
+                        if folder:
+                            status = statuses[current]
+                            if not complete:
+                                # The e-mails left out must be found by the
+                                # next run
+                                status = {}
+                            elif synced or skipped[current]:
+                                # The action after read has changed the
+                                # folder
+                                status = folder.get_status(imapper)
+                            folder.set_status(status)
+                        count += synced
+                        done.add(current)
+                return count
+            except IMAPConnectionError as e:
+                server = servers.get(current)
+                retry += 1
+                if (retry > SYNC_RETRIES
+                        or (processed[current]
+                            and not (server and server.use_uid))):
+                    raise
+                delay = backoff(retry)
+                logger.warning('Lost the connection to %s, retrying in '
+                    '%.1f seconds: %s', self.rec_name, delay, e)
+                retries[current] += 1
+                time.sleep(delay)
+
+    def sync_folder(self, imapper, emailids=None, retries=0, skipped=None):
+        '''
+        Process the next set of e-mails of the folder, run the action after
+        read on them and store the synchronization state.
+        emailids are the e-mails already processed by a previous attempt
+        lost with its connection, to which the ones processed are added,
+        and retries is the number of those attempts. skipped are likewise
+        the duplicates skipped, on which the action after read is also run
+        (e.g. when a previous run failed before it).
+        Return the number of e-mails processed and whether they are all the
+        e-mails found.
+        '''
+        if emailids is None:
+            emailids = []
+        if skipped is None:
+            skipped = []
+        complete = []
+        with self.sync_log(imapper, 'fetch'):
+            metrics.increment('retries', retries, server=self.id)
+            for emailid, data in self.iter_fetch(imapper, skipped=skipped,
+                    complete=complete):
+                self.process_email(emailid, data)
+                emailids.append(emailid)
+        if ((emailids or skipped)
+                and self.action_after_read != 'nothing'):
+            with self.sync_log(imapper, 'action_after'):
+                self.action_after(imapper, emailids + skipped)
+        self.flush_checkpoint()
+        return len(emailids), all(complete)
+
+    @contextmanager
+    def sync_log(self, imapper, operation):
+        '''
+        Context manager that stores the statistics of the operation run
+        with imapper as an imap.server.sync_log, even if it fails.
+        '''
+        SyncLog = Pool().get('imap.server.sync_log')
+        start = datetime.datetime.now()
+        tagnum = imapper.tagnum
+        error = None
+        with collect() as run:
+            try:
+                yield run
+            except Exception as e:
+                error = str(e)
+                raise
+            finally:
+                SyncLog.log(self, operation, start, run,
+                    imapper.tagnum - tagnum, error)
+
+    @classmethod
+    def sync(cls, servers, max_workers=None, max_host_workers=None):
+        '''
+        Run sync_emails() on servers concurrently, each one in its own
+        thread and transaction, with at most max_host_workers servers of the
+        same host at the same time. The servers of the asyncio backend share
+        a thread but each one also has its own transaction.
+        Return a dictionary with the number of e-mails processed or the
+        exception raised for each server id.
+        '''
+        transaction = Transaction()
+        database_name = transaction.database.name
+        user = transaction.user
+        context = transaction.context
+        if max_host_workers is None:
+            max_host_workers = SYNC_HOST_WORKERS
+
+        def sync_server(server_id, semaphore):
+            with semaphore, Transaction().start(database_name, user,
+                    context=context):
+                server = cls(server_id)
+                return server.sync_emails()
+
+        def async_sync_servers(async_tasks):
+            async def sync_server(server_id, semaphore):
+                async with semaphore:
+                    with Transaction().start(database_name, user,
+                            context=context):
+                        server = cls(server_id)
+                        return await server.async_sync_emails()
+
+            async def sync_servers():
+                semaphores = {host: asyncio.Semaphore(max_host_workers)
+                    for _, host in async_tasks}
+                return await asyncio.gather(
+                    *(own_transactions(sync_server(server_id,
+                                semaphores[host]))
+                        for server_id, host in async_tasks),
+                    return_exceptions=True)
+            return dict(zip((server_id for server_id, _ in async_tasks),
+                    asyncio.run(sync_servers())))
+
+        # Interleave the hosts so a slow host does not hold all the workers
+        by_host = defaultdict(list)
+        async_tasks = []
+        for server in servers:
+            if server.backend == 'asyncio':
+                async_tasks.append((server.id, server.host))
+                continue
+            by_host[server.host].append(server.id)
+        tasks = []
+        while by_host:
+            for host in list(by_host):
+                tasks.append((by_host[host].pop(0), host))
+                if not by_host[host]:
+                    del by_host[host]
+        semaphores = {host: threading.BoundedSemaphore(max_host_workers)
+            for _, host in tasks}
+
+        results = {}
+        with ThreadPoolExecutor(
+                max_workers=max_workers or SYNC_WORKERS) as executor:
+            # All the servers of the asyncio backend share a single thread
+            if async_tasks:
+                async_future = executor.submit(async_sync_servers,
+                    async_tasks)
+            futures = {
+                executor.submit(sync_server, server_id, semaphores[host]):
+                server_id for server_id, host in tasks}
+            for future, server_id in futures.items():
+                try:
+                    results[server_id] = future.result()
+                except Exception as e:
+                    results[server_id] = e
+            if async_tasks:
+                try:
+                    results.update(async_future.result())
+                except Exception as e:
+                    results.update((i, e) for i, _ in async_tasks)
+        for server_id, result in results.items():
+            if isinstance(result, Exception):
+                logger.warning('Could not sync IMAP server %s: %s',
+                    server_id, result, exc_info=result)
+        return results
+
+    @classmethod
+    async def async_connect(cls, server, ssl_context=None):
+        '''
+        Coroutine version of connect() that returns an AsyncIMAP4
+        connection.
+        '''
+        if not PRODUCTION_ENV and not Pool().test:
+            logger.warning('Production mode is not enabled.')
+            return
+
+        try:
+            imapper = await AsyncIMAP4.open(server.host, server.port,
+                server.ssl, ssl_context, server.timeout)
+        except (IMAP4.error, IMAP4.abort, IMAP4.readonly, socket.error) as e:
+            raise command_error(e, gettext('imap.general_error', msg=e))
+        user, password, auth = server.get_credentials()
+        if not user or not password:
+            await cls.async_logout(imapper)
+            return
+        try:
+            if not auth:
+                status, data = await imapper.login(user, password)
+            else:
+                status, data = await imapper.authenticate(user,
+                    lambda x: password)
+        except (IMAP4.error, IMAP4.abort, IMAP4.readonly, socket.error) as e:
+            status = 'KO'
+            data = str(e)
+        if status != 'OK':
+            await cls.async_logout(imapper)
+            raise command_error(data, gettext('imap.login_error',
+                    user=user, msg=data))
+        try:
+            await imapper.capability()
+        except (IMAP4.error, IMAP4.abort, IMAP4.readonly, socket.error):
+            pass
+        return imapper
+
+    @classmethod
+    async def async_logout(cls, imapper):
+        try:
+            if imapper.state == 'SELECTED':
+                await imapper.close()
+            await imapper.logout()
+        except (IMAP4.error, IMAP4.abort, IMAP4.readonly, socket.error):
+            pass
+
+    @instrument('select_folder')
+    async def async_select_folder(self, imapper):
+        '''
+        Coroutine version of select_folder()
+        '''
+        try:
+            readonly = (True if self.action_after_read == 'nothing'
+                        and not self.mark_seen else False)
+            status, data = await imapper.select(self.folder, readonly)
+        except (IMAP4.error, IMAP4.abort, IMAP4.readonly, socket.error) as e:
+            status = 'NO'
+            data = e
+        if status != 'OK':
+            await self.async_logout(imapper)
+            raise command_error(data,
+                gettext('imap.select_error', folder=self.folder, msg=data))
+        if self.use_uid:
+            self.check_uid_validity(imapper)
+
+    @instrument('fetch_ids', count=_count_ids)
+    async def async_fetch_ids(self, imapper, complete=None):
+        '''
+        Coroutine version of fetch_ids()
+        '''
+        await self.async_select_folder(imapper)
+        criterion = self.get_criterion_used()
+        now = datetime.datetime.now()
+        args = self.get_search_args(imapper, criterion)
+        try:
+            if self.use_uid:
+                status, data = await imapper.uid('SEARCH', *args)
+            else:
+                status, data = await imapper.search(None, *args)
+        except (IMAP4.error, IMAP4.abort, IMAP4.readonly, socket.error) as e:
+            status = 'NO'
+            data = e
+        if status != 'OK':
+            await self.async_logout(imapper)
+            raise command_error(data,
+                gettext('imap.search_error',
+                        criteria=criterion,
+                        msg=data))
+        emailids, found_all = self.get_search_ids(imapper, data)
+        if complete is not None:
+            complete.append(found_all)
+        if self.search_mode == 'interval' and found_all:
+            self.last_retrieve_date = now
+            self.save_checkpoint()
+        return emailids
+
+    async def _async_command(self, imapper, command, *args, emailid=None):
+        '''
+        Run command on the asyncio connection and raise the fetch error if
+        it fails.
+        '''
+        try:
+            status, data = await self._command(imapper, command, *args)
+        except (IMAP4.error, IMAP4.abort, IMAP4.readonly, socket.error) as e:
+            status = 'KO'
+            data = e
+        if status != 'OK':
+            await self.async_logout(imapper)
+            raise command_error(data, gettext('imap.fetch_error',
+                    email=emailid or args[0], msg=data))
+        return data
+
+    async def async_expunge_email(self, imapper, emailid=None):
+        '''
+        Coroutine version of expunge_email()
+        '''
+        try:
+            if emailid is not None:
+                status, data = await imapper.uid('EXPUNGE', emailid)
+            else:
+                status, data = await imapper.expunge()
+        except (IMAP4.error, IMAP4.abort, IMAP4.readonly, socket.error) as e:
+            status = 'KO'
+            data = e
+        if status != 'OK':
+            await self.async_logout(imapper)
+            raise command_error(data, gettext('imap.fetch_error',
+                    email=emailid, msg=data))
+
+    async def async_iter_fetch(self, imapper, parts='(UID RFC822)',
+            batch_size=None, complete=None):
+        '''
+        Coroutine version of iter_fetch(): asynchronous generator of
+        (e-mail ID, data) tuples. The max_size, spool_threshold,
+        skip_duplicates and use_cache options are not supported, the domain
+        of backend forbids them.
+        '''
+        if batch_size is None:
+            batch_size = self.fetch_batch_size or 1
+        store_seen = self.mark_seen and not _FETCH_SETS_SEEN.search(parts)
+        emailids = await self.async_fetch_ids(imapper, complete=complete)
+        last_uid = self.last_uid
+        for i in range(0, len(emailids), batch_size):
+            batch = emailids[i:i + batch_size]
+            numbers = {int(emailid): emailid for emailid in batch}
+            message_set = sequence_set(batch)
+            data = await self._async_command(imapper, 'FETCH', message_set,
+                parts)
+            result = {}
+            for number, message in split_fetch_response(data, self.use_uid):
+                if number in numbers:
+                    result.setdefault(numbers[number], []).extend(message)
+            if metrics.enabled:
+                messages, size = _count_fetched(result)
+                metrics.increment('fetch_batch.messages', messages,
+                    server=self.id)
+                metrics.increment('fetch_batch.bytes', size, server=self.id)
+            if store_seen:
+                await self._async_command(imapper, 'STORE', message_set,
+                    '+FLAGS', '\\Seen')
+            for emailid in batch:
+                if emailid in result:
+                    yield emailid, result.pop(emailid)
+            self.set_last_uid(batch, save=False)
+        if self.last_uid != last_uid:
+            self.save_checkpoint()
+
+    async def async_fetch(self, imapper, parts='(UID RFC822)',
+            batch_size=None):
+        '''
+        Coroutine version of fetch()
+        '''
+        return {emailid: data async for emailid, data in
+            self.async_iter_fetch(imapper, parts, batch_size)}
+
+    @instrument('action_after')
+    async def async_action_after(self, imapper, emailids=None):
+        '''
+        Coroutine version of action_after()
+        '''
+        await self.async_select_folder(imapper)
+        if ((self.action_after_read == 'move' and self.destination_folder)
+                or self.action_after_read == 'delete'):
+            if emailids is None and self.use_uid:
+                raise UserError(gettext('imap.msg_action_after_ids',
+                        server=self.rec_name))
+            if not emailids and not self.use_uid:
+                emailids = await self.async_fetch_ids(imapper)
+            move = self.action_after_read == 'move'
+            use_move = move and self.has_capability(imapper, 'MOVE')
+            use_uid_expunge = (self.use_uid
+                and self.has_capability(imapper, 'UIDPLUS'))
+            for message_set in self.get_message_sets(emailids):
+                if use_move:
+                    await self._async_command(imapper, 'MOVE', message_set,
+                        self.destination_folder)
+                    continue
+                if move:
+                    await self._async_command(imapper, 'COPY', message_set,
+                        self.destination_folder)
+                await self._async_command(imapper, 'STORE', message_set,
+                    '+FLAGS', '\\Deleted')
+                if use_uid_expunge:
+                    await self.async_expunge_email(imapper, message_set)
+            if emailids and not use_move and not use_uid_expunge:
+                await self.async_expunge_email(imapper)
+
+    async def async_sync_emails(self):
+        '''
+        Coroutine version of sync_emails() using a new connection.
+        '''
+        imapper = await self.async_connect(self)
+        if imapper is None:
+            return 0
+        try:
+            count, _ = await self.get_folder_server().async_sync_folder(
+                imapper)
+            for folder in self.folders:
+                status = await folder.async_get_status(imapper)
+                if not folder.has_changed(status):
+                    continue
+                processed, complete = await self.get_folder_server(
+                    folder).async_sync_folder(imapper)
+                if not complete:
+                    # The e-mails left out must be found by the next run
+                    status = {}
+                elif processed:
+                    status = await folder.async_get_status(imapper)
+                folder.set_status(status)
+                count += processed
+        finally:
+            await self.async_logout(imapper)
+        return count
+
+    async def async_sync_folder(self, imapper):
+        '''
+        Coroutine version of sync_folder()
+        '''
+        emailids = []
+        complete = []
+        with self.sync_log(imapper, 'fetch'):
+            async for emailid, data in self.async_iter_fetch(imapper,
+                    complete=complete):
+                self.process_email(emailid, data)
+                emailids.append(emailid)
+        if emailids and self.action_after_read != 'nothing':
+            with self.sync_log(imapper, 'action_after'):
+                await self.async_action_after(imapper, emailids)
+        self.flush_checkpoint()
+        return len(emailids), all(complete)
+
+
+class IMAPServerFolder(ModelSQL, ModelView):
+    'IMAP Server Folder'
+    __name__ = 'imap.server.folder'
+    server = fields.Many2One('imap.server', 'Server', required=True,
+        ondelete='CASCADE')
+    name = fields.Char('Folder', required=True,
+        help='The folder name where to read from on the server.')
+    search_mode = fields.Selection([
+            (None, ''),
+            ('unseen', 'Unseen'),
+            ('interval', 'Time Interval'),
+            ('incremental', 'Incremental'),
+            ('custom', 'Custom')
+            ], 'Search Mode',
+        help='Leave empty to use the search mode of the server.')
+    criterion = fields.Char('Criterion',
+        states={
+            'invisible': Bool(Eval('search_mode') != 'custom'),
+            'required': Bool(Eval('search_mode') == 'custom'),
+            }, depends=['search_mode'])
+    action_after_read = fields.Selection([
+            (None, ''),
+            ('nothing', 'Nothing'),
+            ('move', 'Move to a folder'),
+            ('delete', 'Delete messages'),
+            ], 'Action after read',
+        help='Leave empty to use the action after read of the server.')
+    destination_folder = fields.Char('Move Folder',
+        states={
+            'invisible': Bool(Eval('action_after_read') != 'move'),
+            'required': Bool(Eval('action_after_read') == 'move'),
+            }, depends=['action_after_read'],
+        help='The folder name where to move to on the server.'
+        ' Absolut path')
+    last_retrieve_date = fields.DateTime('Last Retrieve Date',
+        readonly=True)
+    uid_validity = fields.Integer('UID Validity', readonly=True)
+    last_uid = fields.Integer('Last UID', readonly=True)
+    highest_modseq = fields.Char('Highest Mod-Sequence', readonly=True)
+    uid_next = fields.Integer('UID Next', readonly=True,
+        help='The UIDNEXT of the folder after the last synchronization.')
+    messages = fields.Integer('Messages', readonly=True,
+        help='The number of messages of the folder after the last '
+        'synchronization.')
+    unseen = fields.Integer('Unseen', readonly=True,
+        help='The number of unseen messages of the folder after the last '
+        'synchronization.')
+
+    def _status_command(self):
+        return self.name, '(UIDNEXT MESSAGES UNSEEN)'
+
+    def _parse_status(self, status, data):
+        if status != 'OK' or not data or not data[-1]:
+            raise command_error(data, gettext('imap.select_error',
+                    folder=self.name, msg=data))
+        items = re.search(rb'\(([^()]*)\)\s*$', data[-1])
+        values = (items.group(1).split() if items else [])
+        values = dict(zip(values[0::2], values[1::2]))
+        return {name: int(values[name.replace('_', '').upper().encode()])
+            for name in _STATUS_ITEMS
+            if name.replace('_', '').upper().encode() in values}
+
+    def get_status(self, imapper):
+        '''
+        Return a dictionary with the UIDNEXT, MESSAGES and UNSEEN of the
+        folder without selecting it.
+        '''
+        try:
+            status, data = imapper.status(*self._status_command())
+        except (IMAP4.error, IMAP4.abort, IMAP4.readonly, socket.error) as e:
+            status, data = 'NO', e
+        return self._parse_status(status, data)
+
+    async def async_get_status(self, imapper):
+        '''
+        Coroutine version of get_status()
+        '''
+        try:
+            status, data = await imapper.status(*self._status_command())
+        except (IMAP4.error, IMAP4.abort, IMAP4.readonly, socket.error) as e:
+            status, data = 'NO', e
+        return self._parse_status(status, data)
+
+    def has_changed(self, status):
+        'Whether the folder has changed since the last synchronization'
+        return any(getattr(self, name) != status.get(name)
+            for name in _STATUS_ITEMS)
+
+    def set_status(self, status):
+        'Store the STATUS of the folder after its synchronization'
+        self.write([self], {name: status.get(name) for name in _STATUS_ITEMS})
+
+
+class IMAPServerMessage(ModelSQL, ModelView):
+    'IMAP Server Processed Message'
+    __name__ = 'imap.server.message'
+    server = fields.Many2One('imap.server', 'Server', required=True,
+        ondelete='CASCADE')
+    message_id = fields.Char('Message-ID', readonly=True)
+    body_hash = fields.Char('Body Hash', readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        t = cls.__table__()
+        cls._sql_indexes.update({
+                Index(t,
+                    (t.server, Index.Equality()),
+                    (t.message_id, Index.Equality())),
+                Index(t,
+                    (t.server, Index.Equality()),
+                    (t.body_hash, Index.Equality())),
+                Index(t, (t.create_date, Index.Range())),
+                })
+
+    @classmethod
+    def prune(cls, days=None):
+        '''
+        Forget the messages processed more than days ago
+        '''
+        if days is None:
+            days = DEDUP_RETENTION
+        limit = datetime.datetime.now() - datetime.timedelta(days=days)
+        cls.delete(cls.search([
+                    ('create_date', '<', limit),
+                    ]))
+
+
+class IMAPServerOversized(ModelSQL, ModelView):
+    'IMAP Server Oversized Message'
+    __name__ = 'imap.server.oversized'
+    server = fields.Many2One('imap.server', 'Server', required=True,
+        ondelete='CASCADE')
+    folder = fields.Char('Folder', readonly=True)
+    uid_validity = fields.Integer('UID Validity', readonly=True)
+    uid = fields.Integer('UID', readonly=True)
+    size = fields.Integer('Size', readonly=True)
+    state = fields.Selection([
+            ('skipped', 'Skipped'),
+            ('deferred', 'Deferred'),
+            ('quarantined', 'Quarantined'),
+            ('fetched', 'Fetched'),
+            ], 'State', readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        t = cls.__table__()
+        cls._sql_indexes.update({
+                Index(t,
+                    (t.server, Index.Equality()),
+                    (t.state, Index.Equality())),
+                Index(t,
+                    (t.server, Index.Equality()),
+                    (t.folder, Index.Equality()),
+                    (t.uid, Index.Equality())),
+                })
+        cls._order.insert(0, ('create_date', 'DESC'))
+
+
+class IMAPServerSyncLog(ModelSQL, ModelView):
+    'IMAP Server Synchronization Log'
+    __name__ = 'imap.server.sync_log'
+    server = fields.Many2One('imap.server', 'Server', required=True,
+        ondelete='CASCADE')
+    folder = fields.Char('Folder', readonly=True)
+    operation = fields.Selection([
+            ('fetch', 'Fetch'),
+            ('action_after', 'Action after read'),
+            ], 'Operation', readonly=True)
+    start = fields.DateTime('Start', readonly=True)
+    end = fields.DateTime('End', readonly=True)
+    duration = fields.Float('Duration', digits=(16, 3), readonly=True,
+        help='In seconds.')
+    ids_searched = fields.Integer('IDs Searched', readonly=True)
+    messages = fields.Integer('Messages Fetched', readonly=True)
+    bytes = fields.Integer('Bytes', readonly=True)
+    round_trips = fields.Integer('Round Trips', readonly=True)
+    retries = fields.Integer('Retries', readonly=True)
+    error = fields.Text('Error', readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        t = cls.__table__()
+        cls._sql_indexes.update({
+                Index(t,
+                    (t.server, Index.Equality()),
+                    (t.start, Index.Range())),
+                Index(t, (t.start, Index.Range())),
+                })
+        cls._order.insert(0, ('start', 'DESC'))
+
+    @classmethod
+    def log(cls, server, operation, start, run, round_trips, error=None):
+        '''
+        Store the statistics of the run of operation on server in a new
+        transaction, so they are kept when the synchronization fails.
+        '''
+        end = datetime.datetime.now()
+        values = {
+            'server': server.id,
+            'folder': server.folder,
+            'operation': operation,
+            'start': start,
+            'end': end,
+            'duration': round((end - start).total_seconds(), 3),
+            'ids_searched': run.get('fetch_ids.messages'),
+            'messages': sum(run.get(o + '.messages')
+                for o in _FETCH_OPERATIONS),
+            'bytes': sum(run.get(o + '.bytes') for o in _FETCH_OPERATIONS),
+            'round_trips': round_trips,
+            'retries': run.get('retries'),
+            'error': error,
+            }
+        transaction = Transaction()
+        try:
+            with Transaction(new=True).start(transaction.database.name,
+                    transaction.user, context=transaction.context):
+                cls.create([values])
+        except Exception:
+            logger.warning('Could not log the synchronization of %s',
+                server.rec_name, exc_info=True)
+
+    @classmethod
+    def prune(cls, days=None):
+        '''
+        Remove the logs of the runs started more than days ago
+        '''
+        if days is None:
+            days = SYNC_LOG_RETENTION
+        limit = datetime.datetime.now() - datetime.timedelta(days=days)
+        cls.delete(cls.search([
+                    ('start', '<', limit),
+                    ]))
+
+
+class IMAPServerSyncStatistics(ModelSQL, ModelView):
+    'IMAP Server Synchronization Statistics'
+    __name__ = 'imap.server.sync_statistics'
+    server = fields.Many2One('imap.server', 'Server', readonly=True)
+    runs = fields.Integer('Runs', readonly=True)
+    errors = fields.Integer('Errors', readonly=True)
+    ids_searched = fields.Integer('IDs Searched', readonly=True)
+    messages = fields.Integer('Messages Fetched', readonly=True)
+    bytes = fields.Integer('Bytes', readonly=True)
+    round_trips = fields.Integer('Round Trips', readonly=True)
+    retries = fields.Integer('Retries', readonly=True)
+    average_duration = fields.Float('Average Duration', digits=(16, 3),
+        readonly=True, help='In seconds.')
+    max_duration = fields.Float('Maximum Duration', digits=(16, 3),
+        readonly=True, help='In seconds.')
+    last_run = fields.DateTime('Last Run', readonly=True)
+
+    @classmethod
+    def table_query(cls):
+        SyncLog = Pool().get('imap.server.sync_log')
+        log = SyncLog.__table__()
+        return log.select(
+            log.server.as_('id'),
+            Literal(0).as_('create_uid'),
+            Max(log.create_date).as_('create_date'),
+            Literal(None).as_('write_uid'),
+            Literal(None).as_('write_date'),
+            log.server.as_('server'),
+            Count(Literal('*')).as_('runs'),
+            Sum(Case((log.error != Null, 1), else_=0)).as_('errors'),
+            Sum(log.ids_searched).as_('ids_searched'),
+            Sum(log.messages).as_('messages'),
+            Sum(log.bytes).as_('bytes'),
+            Sum(log.round_trips).as_('round_trips'),
+            Sum(log.retries).as_('retries'),
+            Avg(log.duration).as_('average_duration'),
+            Max(log.duration).as_('max_duration'),
+            Max(log.start).as_('last_run'),
+            group_by=[log.server])
+
+
+class Cron(metaclass=PoolMeta):
+    __name__ = 'ir.cron'
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        cls.method.selection.extend([
+                ('imap.server.message|prune',
+                    "Prune IMAP Processed Messages"),
+                ('imap.server.sync_log|prune',
+                    "Prune IMAP Synchronization Logs"),
+                ('imap.server|fetch_deferred',
+                    "Fetch Deferred IMAP Messages"),
+                ])
+
 
 class OauthCredentials(DictSchemaMixin, ModelSQL, ModelView):
     "Oauth Credentials"
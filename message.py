@@ -0,0 +1,360 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+import base64
+import datetime
+import email
+import email.parser
+import email.policy
+import mmap
+import os
+import quopri
+import re
+from collections import namedtuple
+
+_TOKEN = re.compile(rb'\s*(?:(\()|(\))|"((?:[^"\\]|\\.)*)"|\{(\d+)\}$'
+    rb'|([^\s()"\[]+(?:\[[^\]]*\](?:<\d+>)?)?))')
+
+# End of the header of a message
+_HEADER_END = re.compile(rb'\r?\n\r?\n')
+_CHUNK = 64 * 1024
+
+MessagePart = namedtuple('MessagePart', ['number', 'content_type',
+        'params', 'encoding', 'size', 'filename'])
+Address = namedtuple('Address', ['name', 'mailbox', 'host'])
+
+
+def _tokens(message):
+    '''
+    Yield the tokens of the response of a single message as returned by
+    imaplib: '(' and ')' as strings, atoms and strings as bytes and NIL as
+    None.
+    '''
+    for item in message:
+        if isinstance(item, tuple):
+            text, literal = item
+        else:
+            text, literal = item, None
+        if isinstance(text, str):
+            text = text.encode()
+        position = 0
+        text = text.rstrip()
+        while position < len(text):
+            match = _TOKEN.match(text, position)
+            if not match or match.end() == position:
+                raise ValueError('Could not parse %r' % text[position:])
+            position = match.end()
+            open_, close, quoted, size, atom = match.groups()
+            if open_:
+                yield '('
+            elif close:
+                yield ')'
+            elif quoted is not None:
+                yield re.sub(rb'\\(.)', rb'\1', quoted)
+            elif size is not None:
+                yield literal
+            elif atom.upper() == b'NIL':
+                yield None
+            elif atom:
+                yield atom
+
+
+def parse_response(message):
+    '''
+    Parse the response of a FETCH command for a single message into a
+    dictionary of data item names and values. Parenthesized lists are
+    returned as python lists.
+    '''
+    stack = [[]]
+    for token in _tokens(message):
+        if token == '(':
+            stack[-1].append([])
+            stack.append(stack[-1][-1])
+        elif token == ')':
+            if len(stack) > 1:
+                stack.pop()
+        else:
+            stack[-1].append(token)
+    items = stack[0]
+    # The first token is the sequence number of the message
+    values = []
+    if len(items) > 1 and isinstance(items[1], list):
+        values = items[1]
+    result = {}
+    for i in range(0, len(values) - 1, 2):
+        name = values[i].decode('ascii', 'replace').upper()
+        # Sections and partial ranges are not part of the name
+        name = re.sub(r'<\d+>$', '', name)
+        result[name] = values[i + 1]
+    return result
+
+
+def get_literal(message):
+    '''
+    Return the first literal of the response of a single message (e.g. the
+    content of RFC822) or None.
+    '''
+    for item in message:
+        if isinstance(item, tuple):
+            return item[1]
+
+
+def as_buffer(content):
+    '''
+    Return a memoryview of the bytes or of the file content (e.g. a spooled
+    e-mail), which is memory-mapped instead of read when it is on disk.
+    '''
+    if isinstance(content, memoryview):
+        return content
+    if not hasattr(content, 'read'):
+        return memoryview(content)
+    try:
+        fileno = content.fileno()
+    except (AttributeError, OSError):
+        content.seek(0)
+        return memoryview(content.read())
+    content.flush()
+    if not os.fstat(fileno).st_size:
+        return memoryview(b'')
+    return memoryview(mmap.mmap(fileno, 0, access=mmap.ACCESS_READ))
+
+
+def _text(value):
+    if value is None:
+        return None
+    if isinstance(value, bytes):
+        return value.decode('utf-8', 'replace')
+    return value
+
+
+def _params(value):
+    if not isinstance(value, list):
+        return {}
+    return {_text(k).lower(): _text(v)
+        for k, v in zip(value[0::2], value[1::2])}
+
+
+def parse_envelope(envelope):
+    '''
+    Return a dictionary with the fields of an ENVELOPE
+    '''
+    names = ['date', 'subject', 'from', 'sender', 'reply_to', 'to', 'cc',
+        'bcc', 'in_reply_to', 'message_id']
+    result = {}
+    for name, value in zip(names, envelope or []):
+        if isinstance(value, list):
+            result[name] = [Address(_text(a[0]), _text(a[2]), _text(a[3]))
+                for a in value if isinstance(a, list) and len(a) >= 4]
+        else:
+            result[name] = _text(value)
+    return result
+
+
+def parse_bodystructure(structure, prefix=''):
+    '''
+    Return the list of MessagePart of the leaves of a BODYSTRUCTURE
+    '''
+    if not isinstance(structure, list) or not structure:
+        return []
+    if isinstance(structure[0], list):
+        parts = []
+        number = 1
+        for child in structure:
+            if not isinstance(child, list):
+                break
+            parts.extend(parse_bodystructure(child,
+                    '%s%s.' % (prefix, number)))
+            number += 1
+        return parts
+    type_, subtype, params, _, _, encoding, size = (
+        list(structure) + [None] * 7)[:7]
+    content_type = ('%s/%s' % (_text(type_), _text(subtype))).lower()
+    params = _params(params)
+    # The extension data starts after the lines of text parts and after
+    # the envelope, body and lines of message/rfc822 parts
+    if content_type.startswith('text/'):
+        extension = structure[8:]
+    elif content_type == 'message/rfc822':
+        extension = structure[10:]
+    else:
+        extension = structure[7:]
+    filename = params.get('name')
+    disposition = extension[1] if len(extension) > 1 else None
+    if isinstance(disposition, list) and len(disposition) > 1:
+        filename = _params(disposition[1]).get('filename', filename)
+    return [MessagePart(prefix.rstrip('.') or '1', content_type, params,
+            (_text(encoding) or '7bit').lower(),
+            int(size) if size is not None else None, filename)]
+
+
+def decode_part(content, encoding):
+    'Decode the content of a part with its Content-Transfer-Encoding'
+    if encoding == 'base64':
+        return base64.b64decode(content)
+    elif encoding == 'quoted-printable':
+        return quopri.decodestring(content)
+    return content
+
+
+class RawMessage(object):
+    '''
+    Whole e-mail fetched from the server, which keeps its raw content as a
+    memoryview of the literal of the response (or of the spooled file), so
+    it is never copied. The headers and the body are only parsed when they
+    are accessed.
+    '''
+    __slots__ = ('emailid', 'uid', 'flags', 'size', 'internal_date', 'raw',
+        '_header_size', '_headers', '_message')
+
+    def __init__(self, emailid, raw, uid=None, flags=None, size=None,
+            internal_date=None):
+        self.emailid = emailid
+        self.raw = as_buffer(raw)
+        self.uid = uid
+        self.flags = flags
+        self.size = size if size is not None else len(self.raw)
+        self.internal_date = internal_date
+        self._header_size = None
+        self._headers = None
+        self._message = None
+
+    @classmethod
+    def from_response(cls, emailid, message):
+        '''
+        Return the RawMessage of the response of a FETCH command for a
+        single message with the whole content (RFC822 or BODY[]) and
+        optionally UID, FLAGS, RFC822.SIZE and INTERNALDATE.
+        '''
+        values = parse_response(message)
+        raw = values.get('RFC822', values.get('BODY[]'))
+        if raw is None:
+            raw = get_literal(message) or b''
+        uid = values.get('UID')
+        flags = values.get('FLAGS')
+        if flags is not None:
+            flags = [_text(f) for f in flags]
+        size = values.get('RFC822.SIZE')
+        internal_date = values.get('INTERNALDATE')
+        if internal_date is not None:
+            internal_date = datetime.datetime.strptime(
+                _text(internal_date).strip(), '%d-%b-%Y %H:%M:%S %z')
+        return cls(emailid, raw,
+            uid=int(uid) if uid is not None else None,
+            flags=flags,
+            size=int(size) if size is not None else None,
+            internal_date=internal_date)
+
+    @property
+    def header_size(self):
+        'Size of the header including the blank line that ends it'
+        if self._header_size is None:
+            match = _HEADER_END.search(self.raw)
+            self._header_size = match.end() if match else len(self.raw)
+        return self._header_size
+
+    @property
+    def header(self):
+        return self.raw[:self.header_size]
+
+    @property
+    def body(self):
+        return self.raw[self.header_size:]
+
+    @property
+    def headers(self):
+        '''
+        The headers parsed on the first access without reading the body
+        '''
+        if self._message is not None:
+            return self._message
+        if self._headers is None:
+            self._headers = email.parser.BytesHeaderParser(
+                policy=email.policy.default).parsebytes(bytes(self.header))
+        return self._headers
+
+    def get(self, name, default=None):
+        'Return the value of the header name'
+        return self.headers.get(name, default)
+
+    @property
+    def message(self):
+        '''
+        The whole message parsed on the first access, feeding the parser
+        with chunks of the raw content
+        '''
+        if self._message is None:
+            parser = email.parser.BytesFeedParser(
+                policy=email.policy.default)
+            for chunk in self.iter_chunks():
+                parser.feed(bytes(chunk))
+            self._message = parser.close()
+            self._headers = None
+        return self._message
+
+    def iter_chunks(self, size=_CHUNK):
+        '''
+        Yield the raw content as memoryviews of at most size bytes, e.g. to
+        write it to a file
+        '''
+        for i in range(0, len(self.raw), size):
+            yield self.raw[i:i + size]
+
+    def __len__(self):
+        return len(self.raw)
+
+    def __bytes__(self):
+        return self.raw.tobytes()
+
+    def __repr__(self):
+        return '<RawMessage %s %r>' % (self.emailid, self.get('Subject'))
+
+
+class LazyMessage(object):
+    '''
+    Message with its envelope, structure and some headers already fetched,
+    which downloads each MIME part only when it is requested.
+    '''
+
+    def __init__(self, server, imapper, emailid, response,
+            max_part_size=None):
+        self.server = server
+        self.imapper = imapper
+        self.emailid = emailid
+        self.max_part_size = max_part_size
+        values = parse_response(response)
+        self.flags = [_text(f) for f in values.get('FLAGS') or []]
+        size = values.get('RFC822.SIZE')
+        self.size = int(size) if size is not None else None
+        self.envelope = parse_envelope(values.get('ENVELOPE'))
+        self.parts = parse_bodystructure(values.get('BODYSTRUCTURE'))
+        header = b''
+        for name, value in values.items():
+            if name.startswith('BODY[HEADER') and isinstance(value, bytes):
+                header += value
+        self.headers = email.message_from_bytes(header,
+            policy=email.policy.default)
+        self._contents = {}
+
+    def get_part(self, number, decode=True):
+        '''
+        Return the content of the part number, downloading it on the first
+        access. Return None if the part is bigger than max_part_size.
+        '''
+        part = next((p for p in self.parts if p.number == number), None)
+        if part is None:
+            raise KeyError(number)
+        if (self.max_part_size and part.size
+                and part.size > self.max_part_size):
+            return None
+        if number not in self._contents:
+            data = self.server.fetch_part(self.imapper, self.emailid,
+                number)
+            self._contents[number] = parse_response(data).get(
+                'BODY[%s]' % number, b'') or b''
+        content = self._contents[number]
+        if decode:
+            content = decode_part(content, part.encoding)
+        return content
+
+    def __repr__(self):
+        return '<LazyMessage %s %r>' % (self.emailid,
+            self.envelope.get('subject'))
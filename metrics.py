@@ -0,0 +1,254 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+import bisect
+import contextvars
+import functools
+import inspect
+import logging
+import socket
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+from trytond.config import config
+
+logger = logging.getLogger(__name__)
+
+# Sink of the metrics: logging, statsd, memory or empty to disable them
+METRICS_SINK = config.get('imap', 'metrics_sink', default='')
+STATSD_HOST = config.get('imap', 'statsd_host', default='localhost')
+STATSD_PORT = config.getint('imap', 'statsd_port', default=8125)
+STATSD_PREFIX = config.get('imap', 'statsd_prefix', default='trytond')
+
+# Upper bounds in seconds of the buckets of the latency histograms
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30,
+    float('inf'))
+
+
+class LoggingSink(object):
+    'Sink that logs each metric with the debug level'
+
+    def increment(self, name, value, tags):
+        logger.debug('%s +%s %s', name, value, tags)
+
+    def timing(self, name, seconds, tags):
+        logger.debug('%s %.3fs %s', name, seconds, tags)
+
+
+class StatsdSink(object):
+    '''
+    Sink that sends the metrics to a statsd server with UDP, the tags being
+    part of the name (e.g. trytond.imap.server.1.fetch_one.duration).
+    '''
+
+    def __init__(self, host=STATSD_HOST, port=STATSD_PORT,
+            prefix=STATSD_PREFIX):
+        self.address = (host, port)
+        self.prefix = prefix
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def _name(self, name, tags):
+        parts = [self.prefix, 'imap'] if self.prefix else ['imap']
+        for key, value in sorted(tags.items()):
+            parts.extend([key, str(value)])
+        parts.append(name)
+        return '.'.join(parts)
+
+    def _send(self, data):
+        try:
+            self.socket.sendto(data.encode(), self.address)
+        except OSError:
+            # Metrics must never break the synchronization
+            pass
+
+    def increment(self, name, value, tags):
+        self._send('%s:%s|c' % (self._name(name, tags), value))
+
+    def timing(self, name, seconds, tags):
+        self._send('%s:%.3f|ms' % (self._name(name, tags), seconds * 1000))
+
+
+class Histogram(object):
+    'Latency histogram with the count of values per bucket'
+    __slots__ = ('counts', 'count', 'sum')
+
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.count = 0
+        self.sum = 0.
+
+    def add(self, value):
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.count += 1
+        self.sum += value
+
+
+class MemorySink(object):
+    '''
+    Sink that keeps the counters and the histograms in memory by name and
+    tags, to be read by the application or the tests.
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = defaultdict(int)
+        self.histograms = defaultdict(Histogram)
+
+    @staticmethod
+    def _key(name, tags):
+        return (name,) + tuple(sorted(tags.items()))
+
+    def increment(self, name, value, tags):
+        with self._lock:
+            self.counters[self._key(name, tags)] += value
+
+    def timing(self, name, seconds, tags):
+        with self._lock:
+            self.histograms[self._key(name, tags)].add(seconds)
+
+    def get_counter(self, name, **tags):
+        return self.counters.get(self._key(name, tags), 0)
+
+    def get_histogram(self, name, **tags):
+        return self.histograms.get(self._key(name, tags))
+
+    def clear(self):
+        with self._lock:
+            self.counters.clear()
+            self.histograms.clear()
+
+
+SINKS = {
+    'logging': LoggingSink,
+    'statsd': StatsdSink,
+    'memory': MemorySink,
+    }
+
+
+class Run(object):
+    '''
+    Totals of the counters of the operations run inside collect(), whatever
+    their tags.
+    '''
+
+    def __init__(self):
+        self.counters = defaultdict(int)
+
+    def increment(self, name, value, tags):
+        self.counters[name] += value
+
+    def timing(self, name, seconds, tags):
+        pass
+
+    def get(self, name):
+        return self.counters.get(name, 0)
+
+
+_run = contextvars.ContextVar('imap_metrics_run', default=None)
+
+
+@contextmanager
+def collect():
+    '''
+    Context manager that returns a Run with the totals of the metrics
+    recorded by the current thread or task until it exits, even if no sink
+    is configured.
+    '''
+    run = Run()
+    token = _run.set(run)
+    try:
+        yield run
+    finally:
+        _run.reset(token)
+
+
+class Metrics(object):
+    '''
+    Entry point of the instrumentation. Nothing is recorded while sink is
+    None and no run is collected, which only costs two lookups.
+    '''
+
+    def __init__(self, sink=None):
+        self.sink = sink
+
+    @property
+    def enabled(self):
+        return self.sink is not None or _run.get() is not None
+
+    def sinks(self):
+        return [s for s in (self.sink, _run.get()) if s is not None]
+
+    def increment(self, name, value=1, **tags):
+        if not value:
+            return
+        for sink in self.sinks():
+            sink.increment(name, value, tags)
+
+    def timing(self, name, seconds, **tags):
+        for sink in self.sinks():
+            sink.timing(name, seconds, tags)
+
+
+metrics = Metrics(SINKS[METRICS_SINK]() if METRICS_SINK else None)
+
+
+def instrument(operation, server=0, count=None):
+    '''
+    Decorator that records the duration, the calls and the errors of
+    operation by server. server is the index of the argument that is the
+    imap.server record and count returns the number of messages and of
+    bytes of the result. Coroutine functions are supported.
+    '''
+    def start(args):
+        sinks = metrics.sinks()
+        tags = {'server': getattr(args[server], 'id', None)}
+        return sinks, tags, time.perf_counter()
+
+    def record(sinks, tags, started, result=None, error=False):
+        duration = time.perf_counter() - started
+        for sink in sinks:
+            sink.timing(operation + '.duration', duration, tags)
+            if error:
+                sink.increment(operation + '.errors', 1, tags)
+                continue
+            sink.increment(operation + '.calls', 1, tags)
+        if error or count is None:
+            return
+        messages, size = count(result)
+        for sink in sinks:
+            if messages:
+                sink.increment(operation + '.messages', messages, tags)
+            if size:
+                sink.increment(operation + '.bytes', size, tags)
+
+    def decorator(func):
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                if metrics.sink is None and _run.get() is None:
+                    return await func(*args, **kwargs)
+                sinks, tags, started = start(args)
+                try:
+                    result = await func(*args, **kwargs)
+                except Exception:
+                    record(sinks, tags, started, error=True)
+                    raise
+                record(sinks, tags, started, result)
+                return result
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if metrics.sink is None and _run.get() is None:
+                return func(*args, **kwargs)
+            sinks, tags, started = start(args)
+            try:
+                result = func(*args, **kwargs)
+            except Exception:
+                record(sinks, tags, started, error=True)
+                raise
+            record(sinks, tags, started, result)
+            return result
+        return wrapper
+    return decorator
@@ -0,0 +1,134 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+import datetime
+import logging
+import threading
+import time
+
+from google.auth.transport.requests import Request
+from google.oauth2.credentials import Credentials
+
+from trytond.config import config
+
+logger = logging.getLogger(__name__)
+
+# Seconds before the expiration when the access token is refreshed
+TOKEN_REFRESH_MARGIN = config.getint('imap', 'token_refresh_margin',
+    default=300)
+
+
+def refresh_google_credentials(credentials):
+    '''
+    Refresh the access token of the Google credentials dictionary and
+    return the new credentials and the expiration of the token, which is
+    also stored as expiry in the credentials.
+    '''
+    creds = Credentials(**credentials)
+    creds.refresh(Request())
+    # Even only change the token value, the other values are
+    # uncommon changed, it's possible that Google chate them,
+    # special the refresh_token. So return all again.
+    return {
+        'token': creds.token,
+        'refresh_token': creds.refresh_token,
+        'token_uri': creds.token_uri,
+        'client_id': creds.client_id,
+        'client_secret': creds.client_secret,
+        'scopes': creds.scopes,
+        'expiry': creds.expiry,
+        }, creds.expiry
+
+
+class TokenCache(object):
+    '''
+    Thread-safe cache of OAuth credentials by key (e.g. database and server
+    id).
+
+    The access tokens are refreshed margin seconds before they expire, in
+    the background while the current token is still valid. A single thread
+    refreshes the token of a key at a time, the others wait for it and use
+    the new token.
+    '''
+
+    def __init__(self, margin=TOKEN_REFRESH_MARGIN):
+        self.margin = margin
+        self._lock = threading.Lock()
+        # key: (credentials, expiry, time of the refresh)
+        self._tokens = {}
+        self._locks = {}
+        self._refreshing = set()
+
+    def _key_lock(self, key):
+        with self._lock:
+            return self._locks.setdefault(key, threading.Lock())
+
+    def get(self, key, credentials, refresh, force=False):
+        '''
+        Return the credentials of key with a valid access token.
+        credentials are the stored credentials, used until key is cached
+        with their expiry if any, and refresh is called with the
+        credentials to refresh and returns the new credentials and their
+        expiry.
+        With force the token is refreshed even if it does not seem expired
+        (e.g. when the server rejected it) unless it has just been done.
+        '''
+        with self._lock:
+            entry = self._tokens.get(key)
+        if force:
+            return self._refresh(key, credentials, refresh, force=True)
+        if entry is None:
+            # The stored credentials of an older refresh may not have it
+            expiry = credentials.get('expiry')
+        else:
+            credentials, expiry, _ = entry
+        now = datetime.datetime.utcnow()
+        margin = datetime.timedelta(seconds=self.margin)
+        if expiry is None or expiry - margin > now:
+            return credentials
+        if expiry > now:
+            self._refresh_background(key, credentials, refresh)
+            return credentials
+        return self._refresh(key, credentials, refresh)
+
+    def _refresh(self, key, credentials, refresh, force=False):
+        with self._key_lock(key):
+            with self._lock:
+                entry = self._tokens.get(key)
+            if entry is not None:
+                # Another thread may have refreshed it while waiting
+                credentials, expiry, refreshed = entry
+                now = datetime.datetime.utcnow()
+                margin = datetime.timedelta(seconds=self.margin)
+                if force:
+                    if refreshed > time.monotonic() - self.margin:
+                        return credentials
+                elif expiry is None or expiry - margin > now:
+                    return credentials
+            credentials, expiry = refresh(credentials)
+            with self._lock:
+                self._tokens[key] = (credentials, expiry, time.monotonic())
+            return credentials
+
+    def _refresh_background(self, key, credentials, refresh):
+        with self._lock:
+            if key in self._refreshing:
+                return
+            self._refreshing.add(key)
+
+        def target():
+            try:
+                self._refresh(key, credentials, refresh)
+            except Exception:
+                logger.warning('Could not refresh the OAuth token of %s',
+                    key, exc_info=True)
+            finally:
+                with self._lock:
+                    self._refreshing.discard(key)
+        threading.Thread(target=target, daemon=True).start()
+
+    def clear(self):
+        with self._lock:
+            self._tokens.clear()
+
+
+tokens = TokenCache()
@@ -41,6 +41,7 @@ def google(request, pool):
         'client_id': creds.client_id,
         'client_secret': creds.client_secret,
         'scopes': creds.scopes,
+        'expiry': creds.expiry,
         }
     imap.session_id = None
     imap.save()
@@ -0,0 +1,266 @@
+# This file is part of Tryton.  The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+'''
+Benchmark of the connection, fetch and action after read strategies against
+the local IMAP stub server, reporting for each one the round trips, the wall
+time, the throughput and the peak of the memory allocated by Python while it
+runs (traced with tracemalloc, which slows down all the strategies alike).
+
+Run it with:
+
+    python -m trytond.modules.imap.tests.benchmark --messages 1000 \
+        --size 20000 --latency 0.005
+'''
+import argparse
+import asyncio
+import math
+import random
+import tempfile
+import time
+import tracemalloc
+from collections import namedtuple
+from contextlib import contextmanager
+from imaplib import IMAP4
+from unittest.mock import patch
+
+from trytond.modules.imap.cache import MessageCache
+from trytond.modules.imap.message import get_literal
+from trytond.pool import Pool
+from trytond.tests.test_tryton import CONTEXT, DB_NAME, USER, activate_module
+from trytond.transaction import Transaction
+
+from .imap_stub import _CAPABILITIES, IMAPStubServer, make_message
+
+Result = namedtuple('Result', ['strategy', 'messages', 'size', 'wall_time',
+        'round_trips', 'bytes_sent', 'peak_memory'])
+
+_COMPRESS = _CAPABILITIES + ('COMPRESS=DEFLATE',)
+_NO_MOVE = tuple(c for c in _CAPABILITIES if c != 'MOVE')
+
+# name: (operation, server values, capabilities of the stub)
+STRATEGIES = {
+    'connect': ('connect', {}, _CAPABILITIES),
+    'fetch-one': ('fetch', {
+            'search_mode': 'custom',
+            'criterion': 'ALL',
+            'fetch_batch_size': 1,
+            }, _CAPABILITIES),
+    'fetch-batch': ('fetch', {
+            'search_mode': 'custom',
+            'criterion': 'ALL',
+            'fetch_batch_size': 50,
+            }, _CAPABILITIES),
+    'fetch-uid': ('fetch', {
+            'search_mode': 'incremental',
+            'fetch_batch_size': 50,
+            }, _CAPABILITIES),
+    'fetch-cached': ('fetch', {
+            'search_mode': 'incremental',
+            'fetch_batch_size': 50,
+            'use_cache': True,
+            }, _CAPABILITIES),
+    'fetch-compressed': ('fetch', {
+            'search_mode': 'incremental',
+            'fetch_batch_size': 50,
+            'compression': True,
+            }, _COMPRESS),
+    'fetch-async': ('async_fetch', {
+            'search_mode': 'incremental',
+            'fetch_batch_size': 50,
+            'backend': 'asyncio',
+            }, _CAPABILITIES),
+    'action-delete': ('action_after', {
+            'search_mode': 'custom',
+            'criterion': 'ALL',
+            'action_after_read': 'delete',
+            }, _CAPABILITIES),
+    'action-move': ('action_after', {
+            'search_mode': 'custom',
+            'criterion': 'ALL',
+            'action_after_read': 'move',
+            'destination_folder': 'Archive',
+            }, _CAPABILITIES),
+    'action-copy': ('action_after', {
+            'search_mode': 'custom',
+            'criterion': 'ALL',
+            'action_after_read': 'move',
+            'destination_folder': 'Archive',
+            }, _NO_MOVE),
+    }
+
+
+def message_sizes(count, size, distribution='lognormal', seed=0):
+    '''
+    Return count message sizes of mean size with the distribution: fixed,
+    uniform (between the half and the double) or lognormal (a few large
+    messages among many small ones, like real mailboxes).
+    '''
+    rng = random.Random(seed)
+    if distribution == 'fixed':
+        return [size] * count
+    elif distribution == 'uniform':
+        return [rng.randint(size // 2, size * 2) for _ in range(count)]
+    elif distribution == 'lognormal':
+        sigma = 1
+        mu = math.log(size) - sigma ** 2 / 2
+        return [int(rng.lognormvariate(mu, sigma)) for _ in range(count)]
+    raise ValueError('Unknown distribution %s' % distribution)
+
+
+@contextmanager
+def trace_memory():
+    '''
+    Yield a function returning the peak in bytes of the memory allocated
+    since the start of the block, so each strategy is measured on its own
+    unlike with the peak RSS of the whole process.
+    '''
+    tracing = tracemalloc.is_tracing()
+    if not tracing:
+        tracemalloc.start()
+    tracemalloc.reset_peak()
+    start, _ = tracemalloc.get_traced_memory()
+    peak = None
+
+    def get_peak():
+        return peak
+
+    try:
+        yield get_peak
+    finally:
+        peak = tracemalloc.get_traced_memory()[1] - start
+        if not tracing:
+            tracemalloc.stop()
+
+
+def fetched_size(result):
+    return sum(len(get_literal(data) or b'') for data in result.values())
+
+
+def run_strategy(name, sizes, latency=0):
+    '''
+    Run the strategy name against a stub server with a mailbox of messages
+    of sizes and return its Result.
+    Must be called inside a transaction of a database with imap activated.
+    '''
+    pool = Pool()
+    IMAPServer = pool.get('imap.server')
+    operation, values, capabilities = STRATEGIES[name]
+    with IMAPStubServer(capabilities=capabilities, latency=latency) as stub, \
+            tempfile.TemporaryDirectory() as path, \
+            patch('trytond.modules.imap.imap.cache', MessageCache(path)):
+        stub.add_mailbox('Archive')
+        for number, size in enumerate(sizes, 1):
+            stub.add_message(make_message(number, size))
+        server = IMAPServer(**dict({
+                    'name': name,
+                    'host': '127.0.0.1',
+                    'port': stub.port,
+                    'ssl': False,
+                    'email': stub.user,
+                    'user': stub.user,
+                    'password': stub.password,
+                    'offset': 1,
+                    'mark_seen': False,
+                    'action_after_read': 'nothing',
+                    }, **values))
+        server.save()
+
+        def connect():
+            imapper = IMAP4('127.0.0.1', stub.port)
+            return IMAPServer.login(server, imapper, server.user,
+                server.password)
+
+        imapper = None
+        if operation in {'fetch', 'action_after'}:
+            imapper = connect()
+        if values.get('use_cache'):
+            # Warm the cache and start again from the first UID
+            server.fetch(imapper)
+            server.last_uid = None
+            server.save()
+            server = IMAPServer(server.id)
+
+        stub.reset_counters()
+        messages = size = 0
+        with trace_memory() as peak_memory:
+            start = time.perf_counter()
+            if operation == 'connect':
+                imapper = connect()
+            elif operation == 'fetch':
+                result = server.fetch(imapper)
+                messages, size = len(result), fetched_size(result)
+            elif operation == 'async_fetch':
+                async def fetch():
+                    imapper = await IMAPServer.async_connect(server)
+                    try:
+                        return await server.async_fetch(imapper)
+                    finally:
+                        await IMAPServer.async_logout(imapper)
+                result = asyncio.run(fetch())
+                messages, size = len(result), fetched_size(result)
+            elif operation == 'action_after':
+                server.action_after(imapper)
+                messages = len(sizes) - len(stub.mailboxes['INBOX'].messages)
+            wall_time = time.perf_counter() - start
+        round_trips, bytes_sent = stub.round_trips, stub.bytes_sent
+        if imapper is not None:
+            IMAPServer.logout(imapper)
+    return Result(name, messages, size, wall_time, round_trips, bytes_sent,
+        peak_memory())
+
+
+def run(strategies=None, messages=100, size=10000, distribution='lognormal',
+        latency=0, seed=0):
+    '''
+    Run the strategies (all by default) on the same mailbox and return the
+    list of Result.
+    '''
+    sizes = message_sizes(messages, size, distribution, seed)
+    return [run_strategy(name, sizes, latency)
+        for name in strategies or STRATEGIES]
+
+
+def format_results(results):
+    lines = ['%-17s %8s %10s %9s %11s %10s %9s %9s' % ('strategy',
+            'messages', 'MB', 'seconds', 'round trips', 'messages/s',
+            'MB/s', 'peak mem')]
+    for result in results:
+        mb = result.size / 1024 / 1024
+        wall_time = result.wall_time or float('nan')
+        lines.append('%-17s %8d %10.2f %9.3f %11d %10.1f %9.2f %8.2fM' % (
+                result.strategy, result.messages, mb, result.wall_time,
+                result.round_trips, result.messages / wall_time,
+                mb / wall_time, result.peak_memory / 1024 / 1024))
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('strategies', nargs='*', metavar='strategy',
+        help='the strategies to run among %s, all by default' % ', '.join(
+            STRATEGIES))
+    parser.add_argument('--messages', type=int, default=100,
+        help='number of messages in the mailbox')
+    parser.add_argument('--size', type=int, default=10000,
+        help='mean size of the messages in bytes')
+    parser.add_argument('--distribution', default='lognormal',
+        choices=['fixed', 'uniform', 'lognormal'],
+        help='distribution of the sizes of the messages')
+    parser.add_argument('--latency', type=float, default=0,
+        help='seconds the server waits before answering each command')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+    for strategy in args.strategies:
+        if strategy not in STRATEGIES:
+            parser.error('unknown strategy %s' % strategy)
+
+    activate_module('imap')
+    with Transaction().start(DB_NAME, USER, context=CONTEXT) as transaction:
+        results = run(args.strategies, args.messages, args.size,
+            args.distribution, args.latency, args.seed)
+        transaction.rollback()
+    print(format_results(results))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,711 @@
+# This file is part of Tryton.  The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+'''
+Local in-process IMAP4rev1 server with the subset of the protocol used by
+the module, to test the IMAP clients against real sockets.
+'''
+import datetime
+import email.utils
+import re
+import select
+import socketserver
+import threading
+import time
+import zlib
+
+_LITERAL = re.compile(rb'\{(\d+)\+?\}\r\n$')
+_TOKEN = re.compile(
+    r'"((?:[^"\\]|\\.)*)"|(\()|(\))|(\[)|(\])|([^\s()\[\]"]+)')
+_CAPABILITIES = ('IMAP4rev1', 'AUTH=PLAIN', 'AUTH=XOAUTH2', 'SASL-IR',
+    'IDLE', 'MOVE', 'UIDPLUS')
+
+
+class StubMessage(object):
+    'Message stored on a StubMailbox'
+
+    def __init__(self, uid, raw, flags=None, internal_date=None, modseq=1):
+        self.uid = uid
+        self.modseq = modseq
+        self.raw = raw
+        self.flags = set(flags or [])
+        self.internal_date = internal_date or datetime.datetime.now(
+            datetime.timezone.utc)
+
+    @property
+    def header(self):
+        index = self.raw.find(b'\r\n\r\n')
+        if index < 0:
+            return self.raw
+        return self.raw[:index + 4]
+
+    @property
+    def text(self):
+        return self.raw[len(self.header):]
+
+
+class StubMailbox(object):
+    'Folder of the stub server'
+
+    def __init__(self, name, uid_validity=1):
+        self.name = name
+        self.uid_validity = uid_validity
+        self.uid_next = 1
+        self.highest_modseq = 1
+        self.messages = []
+        # (UID, mod-sequence) of the expunged messages
+        self.vanished = []
+
+    def append(self, raw, flags=None, internal_date=None):
+        self.highest_modseq += 1
+        message = StubMessage(self.uid_next, raw, flags, internal_date,
+            self.highest_modseq)
+        self.uid_next += 1
+        self.messages.append(message)
+        return message
+
+    def touch(self, message):
+        'Increase the mod-sequence of a changed message'
+        self.highest_modseq += 1
+        message.modseq = self.highest_modseq
+
+    def remove(self, message):
+        self.highest_modseq += 1
+        self.messages.remove(message)
+        self.vanished.append((message.uid, self.highest_modseq))
+
+
+def tokenize(line):
+    '''
+    Parse the arguments of a command into strings and nested lists for the
+    parenthesized (and bracketed) groups.
+    '''
+    stack = [[]]
+    for match in _TOKEN.finditer(line):
+        quoted, open_, close, open_bracket, close_bracket, atom = (
+            match.groups())
+        if open_ or open_bracket:
+            group = []
+            stack[-1].append(group)
+            stack.append(group)
+        elif close or close_bracket:
+            stack.pop()
+        elif quoted is not None:
+            stack[-1].append(re.sub(r'\\(.)', r'\1', quoted))
+        else:
+            stack[-1].append(atom)
+    return stack[0]
+
+
+def parse_set(message_set, maximum):
+    'Return the set of numbers of an IMAP sequence set'
+    numbers = set()
+    for part in message_set.split(','):
+        start, _, end = part.partition(':')
+        start = maximum if start == '*' else int(start)
+        end = start if not end else (maximum if end == '*' else int(end))
+        if start > end:
+            start, end = end, start
+        numbers.update(range(start, end + 1))
+    return numbers
+
+
+def quote(value):
+    return '"%s"' % value.replace('\\', '\\\\').replace('"', '\\"')
+
+
+def nstring(value):
+    return 'NIL' if value is None else quote(str(value))
+
+
+def envelope(message):
+    'Return the ENVELOPE of an email.message.Message'
+    def addresses(name):
+        values = message.get_all(name)
+        if not values:
+            return 'NIL'
+        result = []
+        for name, address in email.utils.getaddresses(values):
+            mailbox, _, host = address.partition('@')
+            result.append('(%s NIL %s %s)' % (nstring(name or None),
+                    nstring(mailbox), nstring(host)))
+        return '(%s)' % ''.join(result)
+    sender = addresses('From')
+    return '(%s %s %s %s %s %s %s %s %s %s)' % (
+        nstring(message.get('Date')), nstring(message.get('Subject')),
+        sender, addresses('Sender') if message.get('Sender') else sender,
+        addresses('Reply-To') if message.get('Reply-To') else sender,
+        addresses('To'), addresses('Cc'), addresses('Bcc'),
+        nstring(message.get('In-Reply-To')),
+        nstring(message.get('Message-ID')))
+
+
+def payload(part):
+    'Return the (transfer encoded) content of a non multipart part'
+    value = part.get_payload()
+    if isinstance(value, str):
+        value = value.encode('utf-8', 'surrogateescape')
+    return value
+
+
+def bodystructure(part):
+    'Return the BODYSTRUCTURE of an email.message.Message'
+    if part.is_multipart():
+        return '(%s %s)' % (
+            ''.join(bodystructure(p) for p in part.get_payload()),
+            quote(part.get_content_subtype()))
+    params = part.get_params() or []
+    params = ' '.join('%s %s' % (quote(k), quote(v)) for k, v in params[1:])
+    content = payload(part)
+    fields = [quote(part.get_content_maintype()),
+        quote(part.get_content_subtype()),
+        '(%s)' % params if params else 'NIL', 'NIL', 'NIL',
+        quote(part.get('Content-Transfer-Encoding', '7bit')),
+        str(len(content))]
+    if part.get_content_maintype() == 'text':
+        fields.append(str(content.count(b'\n')))
+    if part.get_content_disposition():
+        filename = part.get_filename()
+        fields += ['NIL', '(%s %s)' % (quote(part.get_content_disposition()),
+                '("filename" %s)' % quote(filename) if filename else 'NIL')]
+    return '(%s)' % ' '.join(fields)
+
+
+def get_part(message, number):
+    'Return the content of the part number of an email.message.Message'
+    part = message
+    for index in number.split('.'):
+        if part.is_multipart():
+            part = part.get_payload(int(index) - 1)
+        elif index != '1':
+            raise ValueError('Invalid part %s' % number)
+    return payload(part)
+
+
+class IMAPStubHandler(socketserver.StreamRequestHandler):
+    # Each response is written in several parts, Nagle's algorithm would
+    # delay them until the client acknowledges the previous one
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        super().setup()
+        self.mailbox = None
+        self.readonly = False
+        self.authenticated = False
+        self.enabled = set()
+        # COMPRESS=DEFLATE (RFC 4978)
+        self.compress = False
+        self.compressor = None
+        self.decompressor = None
+        self.inflated = bytearray()
+
+    def send(self, data):
+        if isinstance(data, str):
+            data = data.encode()
+        if self.compressor:
+            data = (self.compressor.compress(data)
+                + self.compressor.flush(zlib.Z_SYNC_FLUSH))
+        self.server.bytes_sent += len(data)
+        self.wfile.write(data)
+
+    def _inflate(self):
+        data = self.rfile.read1(4096)
+        self.server.bytes_received += len(data)
+        self.inflated += self.decompressor.decompress(data)
+        return bool(data)
+
+    def readline(self):
+        if not self.decompressor:
+            line = self.rfile.readline()
+            self.server.bytes_received += len(line)
+            return line
+        while b'\n' not in self.inflated and self._inflate():
+            pass
+        end = self.inflated.find(b'\n') + 1 or len(self.inflated)
+        line = bytes(self.inflated[:end])
+        del self.inflated[:end]
+        return line
+
+    def read(self, size):
+        if not self.decompressor:
+            data = self.rfile.read(size)
+            self.server.bytes_received += len(data)
+            return data
+        while len(self.inflated) < size and self._inflate():
+            pass
+        data = bytes(self.inflated[:size])
+        del self.inflated[:size]
+        return data
+
+    def handle(self):
+        self.send('* OK IMAP4rev1 stub ready\r\n')
+        while True:
+            line = self.readline()
+            if not line:
+                break
+            # Read the literals sent by the client
+            while _LITERAL.search(line):
+                size = int(_LITERAL.search(line).group(1))
+                if not line.rstrip().endswith(b'+}'):
+                    self.send('+ Ready\r\n')
+                literal = self.read(size)
+                line = (line[:_LITERAL.search(line).start()]
+                    + quote(literal.decode()).encode() + self.readline())
+            line = line.decode().rstrip('\r\n')
+            tag, _, line = line.partition(' ')
+            command, _, arguments = line.partition(' ')
+            command = command.upper()
+            uid = False
+            if command == 'UID':
+                uid = True
+                command, _, arguments = arguments.partition(' ')
+                command = command.upper()
+            self.server.round_trips += 1
+            if self.server.latency:
+                time.sleep(self.server.latency)
+            method = getattr(self, 'do_%s' % command.lower(), None)
+            if not method:
+                self.send('%s BAD Unknown command\r\n' % tag)
+                continue
+            try:
+                result = method(tag, tokenize(arguments), uid)
+            except Exception as e:
+                self.send('%s BAD %s\r\n' % (tag, e))
+                continue
+            self.send('%s %s\r\n' % (tag, result or 'OK completed'))
+            self.wfile.flush()
+            if command == 'LOGOUT':
+                break
+            if self.compress and not self.compressor:
+                self.compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION,
+                    zlib.DEFLATED, -zlib.MAX_WBITS)
+                self.decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+
+    def messages(self, message_set, uid):
+        'Return the list of (sequence number, message) of message_set'
+        messages = self.mailbox.messages
+        if uid:
+            maximum = messages[-1].uid if messages else 0
+            uids = parse_set(message_set, maximum)
+            return [(i, m) for i, m in enumerate(messages, 1)
+                if m.uid in uids]
+        numbers = parse_set(message_set, len(messages))
+        return [(i, m) for i, m in enumerate(messages, 1) if i in numbers]
+
+    def do_capability(self, tag, args, uid):
+        self.send('* CAPABILITY %s\r\n'
+            % ' '.join(self.server.capabilities))
+
+    def do_noop(self, tag, args, uid):
+        pass
+
+    do_check = do_noop
+
+    def do_enable(self, tag, args, uid):
+        enabled = [a.upper() for a in args
+            if a.upper() in self.server.capabilities]
+        self.enabled.update(enabled)
+        self.send('* ENABLED %s\r\n' % ' '.join(enabled))
+
+    def do_compress(self, tag, args, uid):
+        if ('COMPRESS=DEFLATE' not in self.server.capabilities
+                or args[0].upper() != 'DEFLATE'):
+            return 'NO Unsupported compression'
+        if self.compress:
+            return 'NO [COMPRESSIONACTIVE] Already compressed'
+        # The data is compressed after the tagged response
+        self.compress = True
+        return 'OK DEFLATE active'
+
+    def do_logout(self, tag, args, uid):
+        self.send('* BYE stub logging out\r\n')
+
+    def do_login(self, tag, args, uid):
+        user, password = args
+        if (user, password) != (self.server.user, self.server.password):
+            return 'NO [AUTHENTICATIONFAILED] Invalid credentials'
+        self.authenticated = True
+
+    def do_authenticate(self, tag, args, uid):
+        if len(args) < 2:
+            self.send('+ \r\n')
+            self.readline()
+        self.authenticated = True
+
+    def do_select(self, tag, args, uid, readonly=False):
+        name = args[0]
+        if name.upper() == 'INBOX':
+            name = 'INBOX'
+        if name not in self.server.mailboxes:
+            self.mailbox = None
+            return 'NO Mailbox does not exist'
+        self.mailbox = mailbox = self.server.mailboxes[name]
+        self.readonly = readonly
+        self.send(
+            '* FLAGS (\\Answered \\Flagged \\Deleted \\Seen \\Draft)\r\n'
+            '* %s EXISTS\r\n'
+            '* 0 RECENT\r\n'
+            '* OK [UIDVALIDITY %s] UIDs valid\r\n'
+            '* OK [UIDNEXT %s] Predicted next UID\r\n'
+            % (len(mailbox.messages), mailbox.uid_validity, mailbox.uid_next))
+        modifiers = args[1] if len(args) > 1 else []
+        names = [m.upper() for m in modifiers if not isinstance(m, list)]
+        if 'CONDSTORE' in names or 'QRESYNC' in self.enabled:
+            self.send('* OK [HIGHESTMODSEQ %s] Highest\r\n'
+                % mailbox.highest_modseq)
+        if 'QRESYNC' in names:
+            if 'QRESYNC' not in self.enabled:
+                raise ValueError('QRESYNC is not enabled')
+            self.qresync(*modifiers[names.index('QRESYNC') + 1])
+        return 'OK [%s] completed' % (
+            'READ-ONLY' if readonly else 'READ-WRITE')
+
+    def qresync(self, uid_validity, modseq, known_uids=None):
+        'Send the changes since modseq of the selected mailbox'
+        if int(uid_validity) != self.mailbox.uid_validity:
+            return
+        modseq = int(modseq)
+        maximum = self.mailbox.uid_next - 1
+        known = (parse_set(known_uids, maximum) if known_uids
+            else set(range(1, maximum + 1)))
+        vanished = [str(u) for u, m in self.mailbox.vanished
+            if m > modseq and u in known]
+        if vanished:
+            self.send('* VANISHED (EARLIER) %s\r\n' % ','.join(vanished))
+        for number, message in enumerate(self.mailbox.messages, 1):
+            if message.modseq > modseq and message.uid in known:
+                self.send('* %s FETCH (UID %s FLAGS (%s) MODSEQ (%s))\r\n'
+                    % (number, message.uid, ' '.join(sorted(message.flags)),
+                        message.modseq))
+
+    def do_examine(self, tag, args, uid):
+        return self.do_select(tag, args, uid, readonly=True)
+
+    def do_close(self, tag, args, uid):
+        if self.mailbox and not self.readonly:
+            for message in list(self.mailbox.messages):
+                if '\\Deleted' in message.flags:
+                    self.mailbox.remove(message)
+        self.mailbox = None
+
+    def do_status(self, tag, args, uid):
+        mailbox = self.server.mailboxes[args[0]]
+        values = {
+            'MESSAGES': len(mailbox.messages),
+            'UIDNEXT': mailbox.uid_next,
+            'UIDVALIDITY': mailbox.uid_validity,
+            'UNSEEN': len([m for m in mailbox.messages
+                    if '\\Seen' not in m.flags]),
+            'RECENT': 0,
+            }
+        self.send('* STATUS %s (%s)\r\n' % (quote(mailbox.name),
+                ' '.join('%s %s' % (i.upper(), values[i.upper()])
+                    for i in args[1])))
+
+    def match(self, number, message, criteria):
+        criteria = list(criteria)
+        while criteria:
+            key = criteria.pop(0)
+            if isinstance(key, list):
+                if not self.match(number, message, key):
+                    return False
+                continue
+            key = key.upper()
+            if key == 'ALL':
+                continue
+            elif key in ('SEEN', 'UNSEEN', 'DELETED', 'UNDELETED'):
+                flag = '\\' + key.replace('UN', '').capitalize()
+                if (flag in message.flags) != (not key.startswith('UN')):
+                    return False
+            elif key == 'SINCE':
+                date = datetime.datetime.strptime(criteria.pop(0),
+                    '%d-%b-%Y').date()
+                if message.internal_date.date() < date:
+                    return False
+            elif key in ('LARGER', 'SMALLER'):
+                size = int(criteria.pop(0))
+                if ((key == 'LARGER' and len(message.raw) <= size)
+                        or (key == 'SMALLER' and len(message.raw) >= size)):
+                    return False
+            elif key == 'UID':
+                maximum = (self.mailbox.messages[-1].uid
+                    if self.mailbox.messages else 0)
+                if message.uid not in parse_set(criteria.pop(0), maximum):
+                    return False
+            elif re.match(r'^[\d*:,]+$', key):
+                if number not in parse_set(key, len(self.mailbox.messages)):
+                    return False
+            else:
+                raise ValueError('Unsupported search key %s' % key)
+        return True
+
+    def do_search(self, tag, args, uid):
+        options = None
+        if (args and isinstance(args[0], str)
+                and args[0].upper() == 'RETURN'):
+            options = [o.upper() for o in args[1]] or ['ALL']
+            args = args[2:]
+        if args and isinstance(args[0], str) and args[0].upper() == 'CHARSET':
+            args = args[2:]
+        result = [m.uid if uid else i
+            for i, m in enumerate(self.mailbox.messages, 1)
+            if self.match(i, m, args)]
+        if options is None:
+            self.send('* SEARCH%s\r\n' % ''.join(' %s' % r for r in result))
+            return
+        # ESEARCH (RFC 4731)
+        values = []
+        if result and 'MIN' in options:
+            values.append('MIN %s' % min(result))
+        if result and 'MAX' in options:
+            values.append('MAX %s' % max(result))
+        if 'COUNT' in options:
+            values.append('COUNT %s' % len(result))
+        if result and 'ALL' in options:
+            ranges = []
+            for number in sorted(result):
+                if ranges and ranges[-1][1] == number - 1:
+                    ranges[-1][1] = number
+                else:
+                    ranges.append([number, number])
+            values.append('ALL %s' % ','.join(
+                    str(a) if a == b else '%s:%s' % (a, b)
+                    for a, b in ranges))
+        self.send('* ESEARCH (TAG "%s")%s%s\r\n' % (tag,
+                ' UID' if uid else '', ''.join(' ' + v for v in values)))
+
+    def fetch_item(self, message, item, section, partial):
+        'Return the name and the value of a FETCH data item'
+        name = item.upper()
+        if name == 'UID':
+            return name, str(message.uid)
+        elif name == 'FLAGS':
+            return name, '(%s)' % ' '.join(sorted(message.flags))
+        elif name == 'INTERNALDATE':
+            return name, quote(message.internal_date.strftime(
+                    '%d-%b-%Y %H:%M:%S %z'))
+        elif name == 'MODSEQ':
+            return name, '(%s)' % message.modseq
+        elif name == 'RFC822.SIZE':
+            return name, str(len(message.raw))
+        elif name == 'RFC822':
+            return name, message.raw
+        elif name == 'RFC822.HEADER':
+            return name, message.header
+        elif name == 'RFC822.TEXT':
+            return name, message.text
+        elif name == 'ENVELOPE':
+            return name, envelope(email.message_from_bytes(message.raw))
+        elif name == 'BODYSTRUCTURE':
+            return name, bodystructure(
+                email.message_from_bytes(message.raw))
+        elif name in ('BODY', 'BODY.PEEK') and section is not None:
+            section_name = section[0].upper() if section else ''
+            if section_name == '':
+                value = message.raw
+            elif section_name == 'HEADER':
+                value = message.header
+            elif section_name == 'TEXT':
+                value = message.text
+            elif re.match(r'^[\d.]+$', section_name):
+                value = get_part(email.message_from_bytes(message.raw),
+                    section_name)
+            elif section_name.startswith('HEADER.FIELDS'):
+                fields = {f.upper() for f in section[1]}
+                exclude = section_name.endswith('.NOT')
+                msg = email.message_from_bytes(message.header)
+                value = b''.join(('%s: %s\r\n' % (k, v)).encode()
+                    for k, v in msg.items()
+                    if (k.upper() in fields) != exclude) + b'\r\n'
+                section_name = '%s (%s)' % (section_name,
+                    ' '.join(section[1]))
+            else:
+                raise ValueError('Unsupported section %s' % section_name)
+            name = 'BODY[%s]' % section_name
+            if partial:
+                start, _, length = partial.strip('<>').partition('.')
+                value = value[int(start):int(start) + int(length or 0)]
+                name += '<%s>' % start
+            return name, value
+        raise ValueError('Unsupported data item %s' % item)
+
+    def do_fetch(self, tag, args, uid):
+        message_set, items = args[0], args[1]
+        if not isinstance(items, list):
+            items = [items]
+        # Group the sections and partial ranges with their data item
+        parsed = []
+        for item in items:
+            if isinstance(item, list):
+                parsed[-1][1] = item
+            elif item.startswith('<'):
+                parsed[-1][2] = item
+            else:
+                parsed.append([item, None, None])
+        if uid and 'UID' not in [i[0].upper() for i in parsed]:
+            parsed.insert(0, ['UID', None, None])
+        changed_since = None
+        if len(args) > 2 and args[2][0].upper() == 'CHANGEDSINCE':
+            changed_since = int(args[2][1])
+            if 'MODSEQ' not in [i[0].upper() for i in parsed]:
+                parsed.append(['MODSEQ', None, None])
+        for number, message in self.messages(message_set, uid):
+            if changed_since is not None and message.modseq <= changed_since:
+                continue
+            self.send('* %s FETCH (' % number)
+            for i, (item, section, partial) in enumerate(parsed):
+                name, value = self.fetch_item(message, item, section,
+                    partial)
+                if i:
+                    self.send(' ')
+                if isinstance(value, bytes):
+                    self.send('%s {%s}\r\n' % (name, len(value)))
+                    self.send(value)
+                else:
+                    self.send('%s %s' % (name, value))
+                if (item.upper() in ('RFC822', 'RFC822.TEXT', 'BODY')
+                        and not self.readonly
+                        and '\\Seen' not in message.flags):
+                    message.flags.add('\\Seen')
+                    self.mailbox.touch(message)
+            self.send(')\r\n')
+
+    def do_store(self, tag, args, uid):
+        message_set, action, flags = args
+        if not isinstance(flags, list):
+            flags = [flags]
+        silent = action.upper().endswith('.SILENT')
+        for number, message in self.messages(message_set, uid):
+            if action.startswith('+'):
+                message.flags.update(flags)
+            elif action.startswith('-'):
+                message.flags.difference_update(flags)
+            else:
+                message.flags = set(flags)
+            self.mailbox.touch(message)
+            if not silent:
+                self.send('* %s FETCH (FLAGS (%s)%s)\r\n' % (number,
+                        ' '.join(sorted(message.flags)),
+                        ' UID %s' % message.uid if uid else ''))
+
+    def do_copy(self, tag, args, uid):
+        message_set, name = args
+        if name not in self.server.mailboxes:
+            return 'NO [TRYCREATE] Mailbox does not exist'
+        destination = self.server.mailboxes[name]
+        for _, message in self.messages(message_set, uid):
+            destination.append(message.raw, message.flags,
+                message.internal_date)
+
+    def do_move(self, tag, args, uid):
+        result = self.do_copy(tag, args, uid)
+        if result:
+            return result
+        expunged = [m for _, m in self.messages(args[0], uid)]
+        self.expunge(expunged)
+
+    def expunge(self, messages):
+        for message in messages:
+            number = self.mailbox.messages.index(message) + 1
+            self.mailbox.remove(message)
+            if 'QRESYNC' in self.enabled:
+                self.send('* VANISHED %s\r\n' % message.uid)
+            else:
+                self.send('* %s EXPUNGE\r\n' % number)
+
+    def do_expunge(self, tag, args, uid):
+        messages = [m for m in self.mailbox.messages
+            if '\\Deleted' in m.flags]
+        if uid:
+            uids = {m.uid for _, m in self.messages(args[0], uid)}
+            messages = [m for m in messages if m.uid in uids]
+        self.expunge(messages)
+
+    def do_idle(self, tag, args, uid):
+        self.send('+ idling\r\n')
+        self.wfile.flush()
+        known = len(self.mailbox.messages) if self.mailbox else 0
+        while True:
+            # The client only sends DONE after the continuation response,
+            # so nothing is waiting on the read buffer
+            readable, _, _ = select.select([self.request], [], [], 0.05)
+            if readable:
+                break
+            if self.mailbox and len(self.mailbox.messages) != known:
+                known = len(self.mailbox.messages)
+                self.send('* %s EXISTS\r\n' % known)
+                self.wfile.flush()
+        self.readline()
+
+
+class IMAPStubServer(socketserver.ThreadingTCPServer):
+    '''
+    IMAP server listening on a random local port. The mailboxes, the
+    capabilities and a latency per command can be scripted by the tests.
+    '''
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, user='test@example.com', password='testpw',
+            capabilities=_CAPABILITIES, latency=0):
+        super().__init__(('127.0.0.1', 0), IMAPStubHandler)
+        self.user = user
+        self.password = password
+        self.capabilities = capabilities
+        self.latency = latency
+        self.mailboxes = {}
+        self.round_trips = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.add_mailbox('INBOX')
+        self._thread = None
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def add_mailbox(self, name, uid_validity=1):
+        mailbox = self.mailboxes[name] = StubMailbox(name, uid_validity)
+        return mailbox
+
+    def add_message(self, raw, folder='INBOX', flags=None,
+            internal_date=None):
+        if isinstance(raw, str):
+            raw = raw.encode()
+        return self.mailboxes[folder].append(raw, flags, internal_date)
+
+    def reset_counters(self):
+        self.round_trips = self.bytes_sent = self.bytes_received = 0
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever,
+            daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        if self._thread:
+            self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, type, value, traceback):
+        self.stop()
+
+
+def make_message(number, size=0, sender='sender@example.com'):
+    'Return a raw RFC822 message of at least size bytes'
+    body = 'Body of message %s\r\n' % number
+    if size > len(body):
+        line = 'x' * 76 + '\r\n'
+        body += line * ((size - len(body)) // len(line) + 1)
+    return ('From: Sender <%s>\r\n'
+        'To: test@example.com\r\n'
+        'Subject: Message %s\r\n'
+        'Message-ID: <%s@example.com>\r\n'
+        'Date: %s\r\n'
+        '\r\n'
+        '%s' % (sender, number, number,
+            email.utils.formatdate(localtime=True), body)).encode()
@@ -3,15 +3,44 @@
 
 try:
     # Python >= 3.3
-    from unittest.mock import MagicMock
+    from unittest.mock import MagicMock, call, patch
 except ImportError:
     # Python < 3.3
-    from mock import MagicMock
+    from mock import MagicMock, call, patch
 
+import asyncio
+import datetime
+import mmap
+import os
+import socket
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from email.mime.application import MIMEApplication
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
 from imaplib import IMAP4, IMAP4_SSL
+from queue import Queue
 
+from trytond.modules.imap.cache import MessageCache
+from trytond.modules.imap.compress import DeflateSocket
+from trytond.modules.imap.connection import ConnectionPool, connections
+from trytond.modules.imap.exceptions import IMAPConnectionError
+from trytond.modules.imap.idle import IdleListener, has_new_messages, idle
+from trytond.modules.imap.imap import sequence_set, split_fetch_response
+from trytond.modules.imap.message import RawMessage, get_literal
+from trytond.modules.imap.metrics import MemorySink, StatsdSink, metrics
+from trytond.modules.imap.oauth import TokenCache, tokens
+from trytond import backend
+from trytond.exceptions import UserError
+from trytond.model.exceptions import DomainValidationError
 from trytond.pool import Pool
 from trytond.tests.test_tryton import ModuleTestCase, with_transaction
+from trytond.transaction import Transaction
+
+from . import benchmark
+from .imap_stub import _CAPABILITIES, IMAPStubServer, make_message
 
 
 def create_imap_server(provider):
@@ -65,6 +94,7 @@ def create_mock_imap_conn(ssl, mails):
     else:
         mock_conn = MagicMock(spec=IMAP4)
 
+    mock_conn.tagnum = 0
     mock_conn.login.return_value = ('OK', [])
     mock_conn.capability.return_value = ('OK', ["A B C"])
     mock_conn.search = MagicMock(return_value=mail_list)
@@ -75,6 +105,24 @@ def create_mock_imap_conn(ssl, mails):
     return mock_conn
 
 
+def mock_batch_fetch(mails):
+    '''
+    Return a FETCH side effect that answers a sequence set with a single
+    multi-message response, like an IMAP server does.
+    '''
+    def fetch(message_set, parts):
+        data = []
+        for part in message_set.split(','):
+            start, _, end = part.partition(':')
+            for number in range(int(start), int(end or start) + 1):
+                content = mails[str(number)][1][0][1]
+                data.append(('%s (UID %s RFC822 {%s}' % (
+                            number, number, len(content)), content))
+                data.append(')')
+        return ('OK', data)
+    return fetch
+
+
 class ImapTestCase(ModuleTestCase):
     'Test Imap module'
     module = 'imap'
@@ -133,5 +181,1576 @@ class ImapTestCase(ModuleTestCase):
             expected.update({k: v[1]})
         self.assertEqual(result, expected)
 
+    def test_sequence_set(self):
+        self.assertEqual(sequence_set([b'5', b'1', b'2', b'3', b'7', b'8']),
+            '1:3,5,7:8')
+        self.assertEqual(sequence_set(['4']), '4')
+        self.assertEqual(sequence_set([]), '')
+
+    def test_split_fetch_response(self):
+        data = [
+            (b'1 (UID 10 RFC822 {3}', b'abc'), b')',
+            b'7 (FLAGS (\\Seen))',
+            (b'2 (UID 11 RFC822 {3}', b'def'), b' FLAGS (\\Seen))',
+            ]
+        self.assertEqual(split_fetch_response(data), [
+                (1, [(b'1 (UID 10 RFC822 {3}', b'abc'), b')']),
+                (7, [b'7 (FLAGS (\\Seen))']),
+                (2, [(b'2 (UID 11 RFC822 {3}', b'def'),
+                        b' FLAGS (\\Seen))']),
+                ])
+
+    @with_transaction()
+    def test_fetch_batch(self):
+        pool = Pool()
+        IMAPServer = pool.get('imap.server')
+        server = create_imap_server(pool)
+        server.fetch_batch_size = 10
+        server.save()
+        mails = create_mock_mails()
+        mock_conn = create_mock_imap_conn(ssl=server.ssl, mails=mails)
+        mock_conn.fetch = MagicMock(side_effect=mock_batch_fetch(mails))
+        IMAPServer.get_server = MagicMock(return_value=mock_conn)
+        imapper = IMAPServer.connect(server)
+        result = server.fetch(imapper)
+        mock_conn.fetch.assert_called_once_with('1:2', '(UID RFC822)')
+        self.assertEqual(list(result.keys()), list(mails.keys()))
+        for k, v in mails.items():
+            self.assertEqual(result[k][0][1], v[1][0][1])
+
+    @with_transaction()
+    def test_iter_fetch(self):
+        pool = Pool()
+        IMAPServer = pool.get('imap.server')
+        server = create_imap_server(pool)
+        server.save()
+        mails = create_mock_mails()
+        mock_conn = create_mock_imap_conn(ssl=server.ssl, mails=mails)
+        IMAPServer.get_server = MagicMock(return_value=mock_conn)
+        imapper = IMAPServer.connect(server)
+        messages = server.iter_fetch(imapper)
+        emailid, data = next(messages)
+        self.assertEqual(emailid, '1')
+        self.assertEqual(data, mails['1'][1])
+        mock_conn.fetch.assert_called_once_with('1', '(UID RFC822)')
+        self.assertEqual([e for e, _ in messages], ['2'])
+
+    @with_transaction()
+    def test_fetch_incremental(self):
+        pool = Pool()
+        IMAPServer = pool.get('imap.server')
+        server = create_imap_server(pool)
+        server.search_mode = 'incremental'
+        server.fetch_batch_size = 10
+        server.save()
+        mails = create_mock_mails()
+        mock_conn = create_mock_imap_conn(ssl=server.ssl, mails=mails)
+        mock_conn.response.return_value = ('UIDVALIDITY', [b'42'])
+        batch_fetch = mock_batch_fetch(mails)
+
+        def uid(command, *args):
+            if command == 'SEARCH':
+                return ('OK', [b'1 2'])
+            return batch_fetch(*args)
+        mock_conn.uid = MagicMock(side_effect=uid)
+        IMAPServer.get_server = MagicMock(return_value=mock_conn)
+        imapper = IMAPServer.connect(server)
+
+        self.assertEqual(server.criterion_used, 'UID 1:*')
+        result = server.fetch(imapper)
+        self.assertEqual(list(result.keys()), [b'1', b'2'])
+        self.assertEqual(server.uid_validity, 42)
+        self.assertEqual(server.last_uid, 2)
+        self.assertEqual(server.criterion_used, 'UID 3:*')
+
+        # The last message is always returned by "n:*"
+        mock_conn.uid.side_effect = lambda *args: ('OK', [b'2'])
+        self.assertEqual(server.fetch_ids(imapper), [])
+
+        # Fetch all the messages again when UIDVALIDITY changes
+        mock_conn.response.return_value = ('UIDVALIDITY', [b'43'])
+        mock_conn.uid.side_effect = uid
+        result = server.fetch(imapper)
+        self.assertEqual(list(result.keys()), [b'1', b'2'])
+        self.assertEqual(server.uid_validity, 43)
+
+    @with_transaction()
+    def test_action_after_move(self):
+        pool = Pool()
+        IMAPServer = pool.get('imap.server')
+        server = create_imap_server(pool)
+        server.action_after_read = 'move'
+        server.destination_folder = 'Archive'
+        server.save()
+        mails = create_mock_mails()
+        mock_conn = create_mock_imap_conn(ssl=server.ssl, mails=mails)
+        mock_conn.capability.return_value = ('OK', [b'IMAP4rev1 MOVE'])
+        mock_conn._simple_command.return_value = ('OK', [])
+        IMAPServer.get_server = MagicMock(return_value=mock_conn)
+        imapper = IMAPServer.connect(server)
+        server.action_after(imapper, ['1', '2', '3', '5'])
+        mock_conn._simple_command.assert_called_once_with(
+            'MOVE', '1:3,5', 'Archive')
+        mock_conn.copy.assert_not_called()
+        mock_conn.store.assert_not_called()
+        mock_conn.expunge.assert_not_called()
+
+    @with_transaction()
+    def test_action_after_copy(self):
+        pool = Pool()
+        IMAPServer = pool.get('imap.server')
+        server = create_imap_server(pool)
+        server.action_after_read = 'move'
+        server.destination_folder = 'Archive'
+        server.save()
+        mails = create_mock_mails()
+        mock_conn = create_mock_imap_conn(ssl=server.ssl, mails=mails)
+        mock_conn.copy.return_value = ('OK', [])
+        mock_conn.store.return_value = ('OK', [])
+        mock_conn.expunge.return_value = ('OK', [])
+        IMAPServer.get_server = MagicMock(return_value=mock_conn)
+        imapper = IMAPServer.connect(server)
+        server.action_after(imapper, ['1', '2', '3', '5'])
+        mock_conn.copy.assert_called_once_with('1:3,5', 'Archive')
+        mock_conn.store.assert_called_once_with(
+            '1:3,5', '+FLAGS', '\\Deleted')
+        mock_conn.expunge.assert_called_once_with()
+
+    @with_transaction()
+    def test_action_after_uid_expunge(self):
+        pool = Pool()
+        IMAPServer = pool.get('imap.server')
+        server = create_imap_server(pool)
+        server.search_mode = 'incremental'
+        server.action_after_read = 'delete'
+        server.save()
+        mails = create_mock_mails()
+        mock_conn = create_mock_imap_conn(ssl=server.ssl, mails=mails)
+        mock_conn.capability.return_value = ('OK', [b'IMAP4rev1 UIDPLUS'])
+        mock_conn.response.return_value = ('UIDVALIDITY', [b'42'])
+        mock_conn.uid.return_value = ('OK', [])
+        IMAPServer.get_server = MagicMock(return_value=mock_conn)
+        imapper = IMAPServer.connect(server)
+        server.action_after(imapper, [b'10', b'11'])
+        mock_conn.uid.assert_any_call(
+            'STORE', '10:11', '+FLAGS', '\\Deleted')
+        mock_conn.uid.assert_any_call('EXPUNGE', '10:11')
+        mock_conn.expunge.assert_not_called()
+
+    @with_transaction()
+    def test_action_after_move_chunks(self):
+        pool = Pool()
+        IMAPServer = pool.get('imap.server')
+        for backend in ['imaplib', 'asyncio']:
+            with IMAPStubServer() as stub, \
+                    patch('trytond.modules.imap.imap._MAX_SET_IDS', 10):
+                raws = [make_message(i) for i in range(1, 31)]
+                for raw in raws:
+                    stub.add_message(raw)
+                stub.add_mailbox('Archive')
+                server = create_imap_server(pool)
+                server.host = '127.0.0.1'
+                server.port = stub.port
+                server.ssl = False
+                server.backend = backend
+                server.search_mode = 'custom'
+                server.criterion = 'ALL'
+                server.action_after_read = 'move'
+                server.destination_folder = 'Archive'
+                server.save()
+                # Each MOVE renumbers the following sequence numbers
+                emailids = [str(i).encode() for i in range(1, 26)]
+                if backend == 'asyncio':
+                    async def action_after():
+                        imapper = await IMAPServer.async_connect(server)
+                        await server.async_action_after(imapper, emailids)
+                        await IMAPServer.async_logout(imapper)
+                    asyncio.run(action_after())
+                else:
+                    imapper = IMAP4('127.0.0.1', stub.port)
+                    IMAPServer.login(server, imapper, server.user,
+                        server.password)
+                    server.action_after(imapper, emailids)
+                    IMAPServer.logout(imapper)
+                self.assertEqual(
+                    [m.raw for m in stub.mailboxes['INBOX'].messages],
+                    raws[25:], backend)
+                self.assertEqual(
+                    sorted(m.raw for m in stub.mailboxes['Archive'].messages),
+                    sorted(raws[:25]), backend)
+
+    @with_transaction()
+    def test_action_after_incremental(self):
+        pool = Pool()
+        IMAPServer = pool.get('imap.server')
+        with IMAPStubServer() as stub:
+            for i in range(1, 4):
+                stub.add_message(make_message(i))
+            server = create_imap_server(pool)
+            server.search_mode = 'incremental'
+            server.action_after_read = 'delete'
+            server.save()
+            imapper = IMAP4('127.0.0.1', stub.port)
+            IMAPServer.login(server, imapper, server.user, server.password)
+            result = server.fetch(imapper)
+            # The last UID is already stored so the search finds nothing
+            with self.assertRaises(UserError):
+                server.action_after(imapper)
+            self.assertEqual(len(stub.mailboxes['INBOX'].messages), 3)
+            server.action_after(imapper, list(result))
+            self.assertEqual(stub.mailboxes['INBOX'].messages, [])
+            IMAPServer.logout(imapper)
+
+    @with_transaction()
+    def test_fetch_checkpoint(self):
+        pool = Pool()
+        IMAPServer = pool.get('imap.server')
+        with IMAPStubServer() as stub:
+            stub.add_message(make_message(1))
+            server = create_imap_server(pool)
+            server.search_mode = 'incremental'
+            server.fetch_batch_size = 1
+            server.save()
+            imapper = IMAP4('127.0.0.1', stub.port)
+            IMAPServer.login(server, imapper, server.user, server.password)
+            server.fetch(imapper)
+            for i in range(2, 5):
+                stub.add_message(make_message(i))
+            # The last UID is written once and not for each batch
+            with patch.object(IMAPServer, 'flush_checkpoint', autospec=True,
+                    side_effect=IMAPServer.flush_checkpoint) as flush:
+                self.assertEqual(list(server.fetch(imapper)),
+                    [b'2', b'3', b'4'])
+                self.assertEqual(
+                    list(server.fetch_headers(imapper)), [])
+            flush.assert_called_once_with(server)
+            stored, = IMAPServer.read([server.id], ['last_uid'])
+            self.assertEqual(stored['last_uid'], 4)
+            IMAPServer.logout(imapper)
+
+    @with_transaction()
+    def test_fetch_mark_seen(self):
+        pool = Pool()
+        IMAPServer = pool.get('imap.server')
+        server = create_imap_server(pool)
+        server.mark_seen = True
+        server.fetch_batch_size = 10
+        server.save()
+        mails = create_mock_mails()
+        mock_conn = create_mock_imap_conn(ssl=server.ssl, mails=mails)
+        mock_conn.fetch = MagicMock(side_effect=mock_batch_fetch(mails))
+        mock_conn.store.return_value = ('OK', [])
+        IMAPServer.get_server = MagicMock(return_value=mock_conn)
+        imapper = IMAPServer.connect(server)
+
+        # RFC822 already sets the \\Seen flag
+        server.fetch(imapper)
+        mock_conn.store.assert_not_called()
+
+        server.fetch(imapper, parts='(UID BODY.PEEK[])')
+        mock_conn.store.assert_called_once_with('1:2', '+FLAGS', '\\Seen')
+
+    @with_transaction()
+    def test_connection_pool(self):
+        pool = Pool()
+        IMAPServer = pool.get('imap.server')
+        server = create_imap_server(pool)
+        server.save()
+        mails = create_mock_mails()
+        mock_conn = create_mock_imap_conn(ssl=server.ssl, mails=mails)
+        mock_conn.noop.return_value = ('OK', [])
+        IMAPServer.get_server = MagicMock(return_value=mock_conn)
+
+        with IMAPServer.connection(server) as imapper:
+            self.assertEqual(imapper, mock_conn)
+        with IMAPServer.connection(server) as imapper:
+            self.assertEqual(imapper, mock_conn)
+        self.assertEqual(IMAPServer.get_server.call_count, 1)
+        mock_conn.noop.assert_called_once_with()
+
+        # Changing the credentials opens a new connection
+        server.password = 'newpw'
+        server.save()
+        with IMAPServer.connection(server):
+            pass
+        self.assertEqual(IMAPServer.get_server.call_count, 2)
+
+        # Connections that fail the health check are discarded
+        mock_conn.noop.return_value = ('NO', [])
+        with IMAPServer.connection(server):
+            pass
+        self.assertEqual(IMAPServer.get_server.call_count, 3)
+        connections.clear()
+
+    def test_idle(self):
+        local, remote = socket.socketpair()
+        self.addCleanup(local.close)
+        self.addCleanup(remote.close)
+        # Make the socket readable as a server would when sending data
+        remote.sendall(b'*')
+        mock_conn = MagicMock(spec=IMAP4)
+        mock_conn.sock = local
+        mock_conn.tagged_commands = {}
+        mock_conn._new_tag.return_value = b'A001'
+        mock_conn.readline.side_effect = [
+            b'+ idling\r\n',
+            b'* 1 EXPUNGE\r\n',
+            b'* 4 EXISTS\r\n',
+            b'A001 OK IDLE terminated\r\n',
+            ]
+        responses = idle(mock_conn, 5)
+        self.assertEqual(responses, [b'* 1 EXPUNGE', b'* 4 EXISTS'])
+        self.assertTrue(has_new_messages(responses))
+        self.assertEqual(mock_conn.send.call_args_list,
+            [call(b'A001 IDLE\r\n'), call(b'DONE\r\n')])
+
+    @with_transaction()
+    def test_listen(self):
+        pool = Pool()
+        IMAPServer = pool.get('imap.server')
+        server = create_imap_server(pool)
+        server.search_mode = 'unseen'
+        server.save()
+        # The e-mails would be handed over on each wake-up
+        with self.assertRaises(UserError):
+            IMAPServer.listen([server], MagicMock())
+
+        server.search_mode = 'incremental'
+        server.save()
+        imapper = MagicMock(capabilities=())
+        imapper.noop.return_value = ('OK', [])
+        processed = []
+        woken = threading.Event()
+
+        def process(listener, connection):
+            processed.append(connection)
+            if connection is not None:
+                woken.set()
+            return imapper
+
+        # The server has no IDLE capability so it is polled with NOOP
+        with patch.object(IdleListener, 'process', autospec=True,
+                    side_effect=process), \
+                patch('trytond.modules.imap.idle.POLL_INTERVAL', 0):
+            listener, = IMAPServer.listen([server], MagicMock())
+            self.assertTrue(woken.wait(5))
+            listener.stop()
+            listener.join(5)
+        self.assertFalse(listener.is_alive())
+        self.assertEqual(listener.server_id, server.id)
+        self.assertEqual(processed[:2], [None, imapper])
+        imapper.noop.assert_called_with()
+        imapper.logout.assert_called_once_with()
+
+    @with_transaction()
+    def test_listener_process(self):
+        pool = Pool()
+        IMAPServer = pool.get('imap.server')
+        transaction = Transaction()
+        with IMAPStubServer() as stub:
+            stub.add_message(make_message(1))
+            stub.add_message(make_message(2))
+            server = create_imap_server(pool)
+            server.search_mode = 'incremental'
+            server.save()
+            imapper = IMAP4('127.0.0.1', stub.port)
+            IMAPServer.login(server, imapper, server.user, server.password)
+            handed = []
+            listener = IdleListener(transaction.database.name, server.id,
+                lambda server, emailids: handed.append(emailids),
+                user=transaction.user, context=transaction.context)
+            self.assertIs(listener.process(imapper), imapper)
+            # The e-mails already handed over are not searched again
+            listener.process(imapper)
+            self.assertEqual(handed, [[b'1', b'2']])
+
+            stub.add_message(make_message(3))
+            queue = listener.callback = Queue()
+            listener.process(imapper)
+            self.assertEqual(queue.get_nowait(), (server.id, [b'3']))
+            self.assertTrue(queue.empty())
+
+            IMAPServer.write([server], {'search_mode': 'unseen'})
+            with self.assertRaises(UserError):
+                listener.process(imapper)
+            IMAPServer.logout(imapper)
+
+    def test_listener_run(self):
+        listener = IdleListener('db', 1, MagicMock())
+        first, second = MagicMock(), MagicMock()
+        connections = iter([first, second])
+
+        def lost(imapper):
+            raise IMAP4.abort('socket error: EOF')
+
+        def stop(imapper):
+            listener.stop()
+            return False
+
+        # IDLE times out and is sent again, new e-mails are announced then
+        # the connection is lost
+        waits = iter([lambda i: False, lambda i: True, lost, stop])
+        with patch.object(listener, 'process',
+                    side_effect=lambda i: i or next(connections)) \
+                    as process, \
+                patch.object(listener, 'wait',
+                    side_effect=lambda i: next(waits)(i)) as wait, \
+                patch('trytond.modules.imap.idle.RETRY_INTERVAL', 0):
+            listener.run()
+        self.assertEqual(process.call_args_list,
+            [call(None), call(first), call(None)])
+        self.assertEqual(wait.call_args_list,
+            [call(first), call(first), call(first), call(second)])
+        first.logout.assert_called_once_with()
+        second.logout.assert_called_once_with()
+
+        # The errors of the callback are retried too
+        listener = IdleListener('db', 1, MagicMock())
+        imapper = MagicMock()
+        processes = iter([ValueError('callback'), imapper])
+
+        def process(connection):
+            result = next(processes)
+            if isinstance(result, Exception):
+                raise result
+            return result
+
+        with patch.object(listener, 'process', side_effect=process) \
+                    as process_, \
+                patch.object(listener, 'wait', side_effect=stop), \
+                patch('trytond.modules.imap.idle.RETRY_INTERVAL', 0):
+            listener.run()
+        self.assertEqual(process_.call_args_list, [call(None), call(None)])
+        imapper.logout.assert_called_once_with()
+
+    @with_transaction()
+    def test_sync_emails(self):
+        pool = Pool()
+        IMAPServer = pool.get('imap.server')
+        server = create_imap_server(pool)
+        server.action_after_read = 'delete'
+        server.save()
+        mails = create_mock_mails()
+        mock_conn = create_mock_imap_conn(ssl=server.ssl, mails=mails)
+        mock_conn.noop.return_value = ('OK', [])
+        mock_conn.store.return_value = ('OK', [])
+        mock_conn.expunge.return_value = ('OK', [])
+        IMAPServer.get_server = MagicMock(return_value=mock_conn)
+        with patch.object(IMAPServer, 'process_email') as process_email:
+            self.assertEqual(server.sync_emails(), 2)
+        self.assertEqual(process_email.call_args_list, [
+                call(k, v[1]) for k, v in mails.items()])
+        mock_conn.store.assert_called_once_with('1:2', '+FLAGS', '\\Deleted')
+        connections.clear()
+
+    @with_transaction()
+    def test_async_backend(self):
+        pool = Pool()
+        IMAPServer = pool.get('imap.server')
+        Folder = pool.get('imap.server.folder')
+        with IMAPStubServer() as stub:
+            for i in range(1, 6):
+                stub.add_message(make_message(i))
+            stub.add_mailbox('Archive')
+            server = create_imap_server(pool)
+            server.host = '127.0.0.1'
+            server.port = stub.port
+            server.ssl = False
+            server.backend = 'asyncio'
+            server.search_mode = 'incremental'
+            server.fetch_batch_size = 2
+            server.action_after_read = 'move'
+            server.destination_folder = 'Archive'
+            server.save()
+
+            async def sync():
+                imapper = await IMAPServer.async_connect(server)
+                result = await server.async_fetch(imapper)
+                await server.async_action_after(imapper, list(result))
+                await IMAPServer.async_logout(imapper)
+                return result
+            result = asyncio.run(sync())
+
+            self.assertEqual(list(result), [b'1', b'2', b'3', b'4', b'5'])
+            self.assertIn(b'Body of message 3', result[b'3'][0][1])
+            self.assertEqual(server.last_uid, 5)
+            self.assertEqual(len(stub.mailboxes['INBOX'].messages), 0)
+            self.assertEqual(len(stub.mailboxes['Archive'].messages), 5)
+
+            stub.add_message(make_message(6))
+            self.assertEqual(asyncio.run(server.async_sync_emails()), 1)
+
+            # A folder cut by max_messages is selected again
+            stub.add_mailbox('Spam')
+            for i in range(1, 4):
+                stub.add_message(make_message(i), folder='Spam')
+            server.folders = [Folder(name='Spam')]
+            server.max_messages = 2
+            server.save()
+            self.assertEqual(
+                [asyncio.run(server.async_sync_emails()) for _ in range(3)],
+                [2, 1, 0])
+
+            server.password = 'wrong'
+            with self.assertRaises(UserError):
+                asyncio.run(IMAPServer.async_connect(server))
+
+    @with_transaction()
+    def test_sync_threads(self):
+        pool = Pool()
+        IMAPServer = pool.get('imap.server')
+        servers = []
+        for name, host in [
+                ('a1', 'a.example.com'),
+                ('a2', 'a.example.com'),
+                ('a3', 'a.example.com'),
+                ('b1', 'b.example.com'),
+                ('broken', 'b.example.com'),
+                ('c1', 'c.example.com'),
+                ]:
+            server = create_imap_server(pool)
+            server.name = name
+            server.host = host
+            server.save()
+            servers.append(server)
+        broken = servers[4]
+        hosts = {s.id: s.host for s in servers}
+        transactions = {}
+        running = defaultdict(int)
+        peaks = defaultdict(int)
+        lock = threading.Lock()
+
+        def sync_emails(server):
+            transaction = transactions[server.id] = Transaction()
+            host = hosts[server.id]
+            with lock:
+                running[host] += 1
+                running[None] += 1
+                for key in [host, None]:
+                    peaks[key] = max(peaks[key], running[key])
+            try:
+                time.sleep(0.05)
+                self.assertIs(Transaction(), transaction)
+                if server.id == broken.id:
+                    raise IMAPConnectionError('broken')
+                return server.id
+            finally:
+                with lock:
+                    running[host] -= 1
+                    running[None] -= 1
+
+        with patch.object(IMAPServer, 'sync_emails', autospec=True,
+                    side_effect=sync_emails), \
+                patch.object(Transaction, 'stop', autospec=True,
+                    side_effect=Transaction.stop) as stop:
+            results = IMAPServer.sync(servers, max_workers=4,
+                max_host_workers=2)
+        for server in servers:
+            if server == broken:
+                self.assertIsInstance(results[server.id],
+                    IMAPConnectionError)
+            else:
+                self.assertEqual(results[server.id], server.id)
+        self.assertEqual(peaks[None], 4)
+        self.assertEqual(peaks['a.example.com'], 2)
+        self.assertEqual(
+            len(set(map(id, transactions.values()))), len(servers))
+        committed = {c.args[0]: c.args[1] for c in stop.call_args_list}
+        for server in servers:
+            self.assertIs(committed[transactions[server.id]],
+                server != broken)
+
+    @with_transaction()
+    def test_sync_async_transactions(self):
+        pool = Pool()
+        IMAPServer = pool.get('imap.server')
+        servers = []
+        for name in ['good', 'broken']:
+            server = create_imap_server(pool)
+            server.name = name
+            server.backend = 'asyncio'
+            server.save()
+            servers.append(server)
+        good, broken = servers
+        transactions = {}
+
+        async def async_sync_emails(server):
+            transaction = transactions[server.id] = Transaction()
+            # The other server runs meanwhile
+            await asyncio.sleep(0.05)
+            self.assertIs(Transaction(), transaction)
+            if server.id == broken.id:
+                raise IMAPConnectionError('broken')
+            return 1
+
+        with patch.object(IMAPServer, 'async_sync_emails', autospec=True,
+                    side_effect=async_sync_emails), \
+                patch.object(Transaction, 'stop', autospec=True,
+                    side_effect=Transaction.stop) as stop:
+            results = IMAPServer.sync(servers)
+        self.assertEqual(results[good.id], 1)
+        self.assertIsInstance(results[broken.id], IMAPConnectionError)
+        self.assertIsNot(transactions[good.id], transactions[broken.id])
+        # The work of the broken server is rolled back
+        committed = {c.args[0]: c.args[1] for c in stop.call_args_list}
+        self.assertIs(committed[transactions[good.id]], True)
+        self.assertIs(committed[transactions[broken.id]], False)
+
+    @with_transaction()
+    def test_fetch_headers(self):
+        pool = Pool()
+        IMAPServer = pool.get('imap.server')
+        attachment = MIMEApplication(b'x' * 1000, Name='big.bin')
+        attachment['Content-Disposition'] = (
+            'attachment; filename="big.bin"')
+        message = MIMEMultipart()
+        message['From'] = 'Sender <sender@example.com>'
+        message['Subject'] = 'Routing'
+        message['Message-ID'] = '<routing@example.com>'
+        message.attach(MIMEText('Hello'))
+        message.attach(attachment)
+        with IMAPStubServer() as stub:
+            stub.add_message(message.as_bytes())
+            server = create_imap_server(pool)
+            server.save()
+            imapper = IMAP4('127.0.0.1', stub.port)
+            IMAPServer.login(server, imapper, server.user, server.password)
+
+            stub.reset_counters()
+            lazy, = server.fetch_headers(imapper, max_part_size=500)
+            # SELECT, SEARCH and a single FETCH
+            self.assertEqual(stub.round_trips, 3)
+            self.assertEqual(lazy.envelope['subject'], 'Routing')
+            self.assertEqual(lazy.envelope['from'][0].mailbox, 'sender')
+            self.assertEqual(lazy.headers['Message-ID'],
+                '<routing@example.com>')
+            self.assertEqual([(p.number, p.content_type, p.filename)
+                    for p in lazy.parts], [
+                    ('1', 'text/plain', None),
+                    ('2', 'application/octet-stream', 'big.bin')])
+
+            self.assertEqual(lazy.get_part('1'), b'Hello')
+            self.assertEqual(stub.round_trips, 4)
+            self.assertIsNone(lazy.get_part('2'))
+            self.assertEqual(stub.round_trips, 4)
+            lazy.max_part_size = None
+            self.assertEqual(lazy.get_part('2'), b'x' * 1000)
+            self.assertNotIn('\\Seen',
+                stub.mailboxes['INBOX'].messages[0].flags)
+            IMAPServer.logout(imapper)
+
+    @with_transaction()
+    def test_skip_duplicates(self):
+        pool = Pool()
+        IMAPServer = pool.get('imap.server')
+        ProcessedMessage = pool.get('imap.server.message')
+        with IMAPStubServer() as stub:
+            stub.add_message(make_message(1))
+            stub.add_message(make_message(2))
+            without_id = b'From: sender@example.com\r\n\r\nNo Message-ID'
+            stub.add_message(without_id)
+            server = create_imap_server(pool)
+            server.search_mode = 'custom'
+            server.criterion = 'ALL'
+            server.skip_duplicates = True
+            server.fetch_batch_size = 10
+            server.save()
+            imapper = IMAP4('127.0.0.1', stub.port)
+            IMAPServer.login(server, imapper, server.user, server.password)
+
+            self.assertEqual(list(server.fetch(imapper)), [b'1', b'2', b'3'])
+            self.assertEqual(ProcessedMessage.search([], count=True), 3)
+
+            # The same Message-ID or content in another message is skipped
+            stub.add_message(make_message(1))
+            stub.add_message(without_id)
+            stub.add_message(make_message(3))
+            stub.reset_counters()
+            self.assertEqual(list(server.fetch(imapper)), [b'6'])
+            # SELECT, SEARCH, FETCH of the Message-IDs and FETCH of 4:6
+            self.assertEqual(stub.round_trips, 4)
+            IMAPServer.logout(imapper)
+
+        ProcessedMessage.prune(days=0)
+        self.assertEqual(ProcessedMessage.search([], count=True), 0)
+
+    @with_transaction()
+    def test_sync_duplicates(self):
+        pool = Pool()
+        IMAPServer = pool.get('imap.server')
+        ProcessedMessage = pool.get('imap.server.message')
+        for action, mark_seen in [('delete', False), ('nothing', True)]:
+            with IMAPStubServer() as stub:
+                stub.add_message(make_message(1))
+                stub.add_message(make_message(2))
+                server = create_imap_server(pool)
+                server.search_mode = 'unseen'
+                server.skip_duplicates = True
+                server.fetch_batch_size = 10
+                server.action_after_read = action
+                server.mark_seen = mark_seen
+                server.save()
+                # The last run failed after processing the first e-mail
+                ProcessedMessage.create([{
+                            'server': server.id,
+                            'message_id': '<1@example.com>',
+                            }])
+                imapper = IMAP4('127.0.0.1', stub.port)
+                IMAPServer.login(server, imapper, server.user,
+                    server.password)
+                with patch.object(IMAPServer, 'acquire',
+                            return_value=imapper), \
+                        patch.object(IMAPServer, 'release'), \
+                        patch.object(IMAPServer,
+                            'process_email') as process_email:
+                    self.assertEqual(server.sync_emails(), 1)
+                    process_email.assert_called_once()
+                    self.assertEqual(server.fetch_ids(imapper), [])
+                messages = stub.mailboxes['INBOX'].messages
+                if action == 'delete':
+                    self.assertEqual(messages, [])
+                else:
+                    self.assertTrue(
+                        all('\\Seen' in m.flags for m in messages))
+                IMAPServer.logout(imapper)
+
+    def test_message_cache(self):
+        with tempfile.TemporaryDirectory() as path:
+            cache = MessageCache(path, max_size=250)
+            self.assertIsNone(cache.get(('db', 1, 1, 1)))
+            cache.put(('db', 1, 1, 1), b'1' * 100)
+            cache.put(('db', 1, 1, 2), b'2' * 100)
+            self.assertTrue(os.path.exists(
+                    os.path.join(path, 'db', '1', '1', '1.eml')))
+            self.assertEqual(cache.get(('db', 1, 1, 1)), b'1' * 100)
+            os.utime(os.path.join(path, 'db', '1', '1', '2.eml'), (0, 0))
+
+            # The least recently used message is evicted
+            cache.put(('db', 1, 1, 3), b'3' * 100)
+            self.assertIsNone(cache.get(('db', 1, 1, 2)))
+            self.assertEqual(cache.get(('db', 1, 1, 1)), b'1' * 100)
+            self.assertEqual(cache.get(('db', 1, 1, 3)), b'3' * 100)
+
+            cache.clear('db', 1)
+            self.assertIsNone(cache.get(('db', 1, 1, 1)))
+
+    @with_transaction()
+    def test_fetch_cache(self):
+        pool = Pool()
+        IMAPServer = pool.get('imap.server')
+        Folder = pool.get('imap.server.folder')
+        with IMAPStubServer() as stub, \
+                tempfile.TemporaryDirectory() as path, \
+                patch('trytond.modules.imap.imap.cache', MessageCache(path)):
+            stub.add_message(make_message(1))
+            stub.add_message(make_message(2))
+            server = create_imap_server(pool)
+            server.search_mode = 'incremental'
+            server.use_cache = True
+            server.fetch_batch_size = 10
+            server.save()
+            imapper = IMAP4('127.0.0.1', stub.port)
+            IMAPServer.login(server, imapper, server.user, server.password)
+            fetched = server.fetch(imapper)
+            self.assertEqual(list(fetched), [b'1', b'2'])
+
+            # Fetch the same messages again from the local cache
+            server.last_uid = None
+            server.save()
+            server = IMAPServer(server.id)
+            stub.reset_counters()
+            cached = server.fetch(imapper)
+            self.assertEqual(cached, fetched)
+            self.assertIsInstance(cached[b'1'][0][1], bytes)
+            # SELECT and SEARCH
+            self.assertEqual(stub.round_trips, 2)
+
+            # The messages are not copied from the memory map
+            server.last_uid = None
+            server.save()
+            server = IMAPServer(server.id)
+            messages = list(server.iter_messages(imapper))
+            self.assertEqual([bytes(m) for m in messages],
+                [get_literal(d) for d in fetched.values()])
+            self.assertIsInstance(messages[0].raw.obj, mmap.mmap)
+
+            # Other folders may have the same UIDVALIDITY
+            stub.add_mailbox('Archive')
+            archived = make_message(3)
+            stub.add_message(archived, folder='Archive')
+            server.folders = [Folder(name='Archive')]
+            server.save()
+            archive = server.get_folder_server(server.folders[0])
+            result = archive.fetch(imapper)
+            self.assertEqual(bytes(result[b'1'][0][1]), archived)
+
+            # A new UIDVALIDITY only clears the cache of its folder
+            stub.mailboxes['Archive'].uid_validity = 2
+            archive.fetch(imapper)
+            server.last_uid = None
+            server.save()
+            server = IMAPServer(server.id)
+            stub.reset_counters()
+            self.assertEqual(server.fetch(imapper), fetched)
+            self.assertEqual(stub.round_trips, 2)
+            IMAPServer.logout(imapper)
+
+    @with_transaction()
+    def test_fetch_changes(self):
+        pool = Pool()
+        IMAPServer = pool.get('imap.server')
+        capabilities = ('IMAP4rev1', 'AUTH=PLAIN', 'UIDPLUS', 'ENABLE',
+            'CONDSTORE', 'QRESYNC')
+        for capabilities, round_trips in [
+                (capabilities, 1),
+                (capabilities[:-1], 3),
+                (capabilities[:3], 3),
+                ]:
+            with IMAPStubServer(capabilities=capabilities) as stub:
+                for number in range(1, 4):
+                    stub.add_message(make_message(number))
+                server = create_imap_server(pool)
+                server.search_mode = 'incremental'
+                server.action_after_read = 'delete'
+                server.save()
+                imapper = IMAP4('127.0.0.1', stub.port)
+                IMAPServer.login(server, imapper, server.user,
+                    server.password)
+                flags, vanished = server.fetch_changes(imapper)
+                self.assertEqual(flags, {1: [], 2: [], 3: []})
+                self.assertEqual(vanished, [])
+
+                imapper.uid('STORE', '2', '+FLAGS', '\\Seen')
+                imapper.uid('STORE', '3', '+FLAGS', '\\Deleted')
+                imapper.uid('EXPUNGE', '3')
+                stub.reset_counters()
+                flags, vanished = server.fetch_changes(imapper, [1, 2, 3])
+                if 'CONDSTORE' in capabilities:
+                    self.assertEqual(flags, {2: ['\\Seen']})
+                else:
+                    self.assertEqual(flags, {1: [], 2: ['\\Seen']})
+                self.assertEqual(vanished, [3])
+                self.assertEqual(stub.round_trips, round_trips)
+                IMAPServer.logout(imapper)
+
+    @with_transaction()
+    def test_sync_folders(self):
+        pool = Pool()
+        IMAPServer = pool.get('imap.server')
+        Folder = pool.get('imap.server.folder')
+        with IMAPStubServer() as stub:
+            stub.add_mailbox('Archive')
+            stub.add_mailbox('Spam')
+            stub.add_message(make_message(1))
+            stub.add_message(make_message(2), folder='Archive')
+            stub.add_message(make_message(3), folder='Spam')
+            stub.add_message(make_message(4), folder='Spam')
+            server = create_imap_server(pool)
+            server.search_mode = 'incremental'
+            server.fetch_batch_size = 10
+            server.folders = [
+                Folder(name='Archive'),
+                Folder(name='Spam', action_after_read='delete'),
+                ]
+            server.save()
+            archive, spam = server.folders
+            imapper = IMAP4('127.0.0.1', stub.port)
+            IMAPServer.login(server, imapper, server.user, server.password)
+            with patch.object(IMAPServer, 'acquire', return_value=imapper), \
+                    patch.object(IMAPServer, 'release'), \
+                    patch.object(IMAPServer, 'process_email'):
+                self.assertEqual(server.sync_emails(), 4)
+                archive, spam = Folder.browse([archive, spam])
+                self.assertEqual(IMAPServer(server.id).last_uid, 1)
+                self.assertEqual(archive.last_uid, 1)
+                self.assertEqual(spam.last_uid, 2)
+                self.assertEqual(stub.mailboxes['Spam'].messages, [])
+                self.assertEqual(
+                    (archive.uid_next, archive.messages, archive.unseen),
+                    (2, 1, 1))
+
+                # The folders without changes are not selected
+                stub.reset_counters()
+                self.assertEqual(server.sync_emails(), 0)
+                # SELECT and SEARCH of INBOX and STATUS of each folder
+                self.assertEqual(stub.round_trips, 4)
+
+                stub.add_message(make_message(5), folder='Archive')
+                self.assertEqual(server.sync_emails(), 1)
+                archive = Folder(archive.id)
+                self.assertEqual(archive.last_uid, 2)
+
+                # A folder cut by max_messages is selected again
+                server.max_messages = 2
+                server.save()
+                for number in range(6, 11):
+                    stub.add_message(make_message(number), folder='Archive')
+                self.assertEqual(
+                    [server.sync_emails() for _ in range(4)], [2, 2, 1, 0])
+                archive = Folder(archive.id)
+                self.assertEqual(archive.last_uid, 7)
+                self.assertFalse(archive.has_changed(
+                        archive.get_status(imapper)))
+            IMAPServer.logout(imapper)
+
+    def test_connection_pool_ttl(self):
+        pool = ConnectionPool(size=2, ttl=60)
+        old, new = MagicMock(), MagicMock()
+        new.noop.return_value = ('OK', [])
+        with patch('trytond.modules.imap.connection.time.monotonic',
+                    return_value=1000):
+            pool.put('old', 'fingerprint', old)
+        # The connections of a server not used again expire too
+        with patch('trytond.modules.imap.connection.time.monotonic',
+                    return_value=1100):
+            pool.put('new', 'fingerprint', new)
+            old.logout.assert_called_once_with()
+            self.assertIs(pool.get('new', 'fingerprint'), new)
+            self.assertIsNone(pool.get('old', 'fingerprint'))
+        new.logout.assert_not_called()
+
+    def test_token_cache(self):
+        cache = TokenCache(margin=60)
+        refreshed = []
+
+        def refresh(credentials):
+            time.sleep(0.05)
+            refreshed.append(credentials['token'])
+            expiry = datetime.datetime.utcnow() + datetime.timedelta(
+                seconds=90)
+            return {'token': 'token%s' % len(refreshed)}, expiry
+
+        stored = {'token': 'token0'}
+        self.assertEqual(cache.get('key', stored, refresh), stored)
+
+        # Concurrent workers refresh the rejected token only once
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(
+                    cache.get('key', stored, refresh, force=True)))
+            for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(refreshed, ['token0'])
+        self.assertEqual(results, [{'token': 'token1'}] * 4)
+
+        # The token is refreshed in the background before it expires
+        cache.margin = 120
+        self.assertEqual(cache.get('key', stored, refresh),
+            {'token': 'token1'})
+        for _ in range(50):
+            if len(refreshed) > 1:
+                break
+            time.sleep(0.01)
+        self.assertEqual(refreshed, ['token0', 'token1'])
+        self.assertEqual(cache.get('key', stored, refresh, force=True),
+            {'token': 'token2'})
+
+    @with_transaction()
+    def test_oauth_credentials(self):
+        pool = Pool()
+        IMAPServer = pool.get('imap.server')
+        server = create_imap_server(pool)
+        server.types = 'google'
+        server.oauth_credentials = {
+            'token': 'old', 'refresh_token': 'refresh'}
+        server.save()
+
+        def refresh(credentials):
+            return dict(credentials, token='new'), None
+
+        with patch('trytond.modules.imap.imap.refresh_google_credentials',
+                    side_effect=refresh) as refresh_google_credentials:
+            user, password, auth = server.get_credentials()
+            self.assertIn('Bearer old', password)
+            self.assertEqual(server.google_refresh_token(),
+                {'token': 'new', 'refresh_token': 'refresh'})
+            user, password, auth = server.get_credentials()
+            self.assertIn('Bearer new', password)
+            self.assertEqual(refresh_google_credentials.call_count, 1)
+        tokens.clear()
+
+        # A fresh process refreshes the stored token once it expires
+        expiry = datetime.datetime.utcnow() + datetime.timedelta(hours=1)
+        server.oauth_credentials = {
+            'token': 'old', 'refresh_token': 'refresh',
+            'expiry': datetime.datetime.utcnow() - datetime.timedelta(
+                minutes=1),
+            }
+        server.save()
+
+        def refresh(credentials):
+            return dict(credentials, token='new', expiry=expiry), expiry
+
+        with patch('trytond.modules.imap.imap.refresh_google_credentials',
+                    side_effect=refresh):
+            user, password, auth = IMAPServer(server.id).get_credentials()
+            self.assertIn('Bearer new', password)
+        stored, = IMAPServer.read([server.id], ['oauth_credentials'])
+        self.assertEqual(stored['oauth_credentials'], {
+                'token': 'new', 'refresh_token': 'refresh',
+                'expiry': expiry,
+                })
+        tokens.clear()
+
+        # The credentials are not stored while another process locks them
+        database = Transaction().database
+        with patch('trytond.modules.imap.imap.refresh_google_credentials',
+                    side_effect=lambda c: (dict(c, token='newer'), None)), \
+                patch.object(type(database), 'lock_records',
+                    side_effect=backend.DatabaseOperationalError), \
+                patch('trytond.transaction._retry', 0):
+            self.assertEqual(
+                IMAPServer(server.id).google_refresh_token()['token'],
+                'newer')
+        stored, = IMAPServer.read([server.id], ['oauth_credentials'])
+        self.assertEqual(stored['oauth_credentials']['token'], 'new')
+        tokens.clear()
+
+    @with_transaction()
+    def test_sync_checkpoint(self):
+        pool = Pool()
+        IMAPServer = pool.get('imap.server')
+        with IMAPStubServer() as stub:
+            stub.add_message(make_message(1))
+            stub.add_message(make_message(2))
+            server = create_imap_server(pool)
+            server.search_mode = 'unseen'
+            server.mark_seen = True
+            server.save()
+            imapper = IMAP4('127.0.0.1', stub.port)
+            IMAPServer.login(server, imapper, server.user, server.password)
+            with patch.object(IMAPServer, 'acquire', return_value=imapper), \
+                    patch.object(IMAPServer, 'release'), \
+                    patch.object(IMAPServer, 'process_email'), \
+                    patch.object(IMAPServer, 'write',
+                        wraps=IMAPServer.write) as write:
+                # The unseen mode does not store any checkpoint
+                self.assertEqual(server.sync_emails(), 2)
+                write.assert_not_called()
+
+                server.search_mode = 'interval'
+                server.save()
+                write.reset_mock()
+                stub.add_message(make_message(3))
+                self.assertEqual(server.sync_emails(), 3)
+                self.assertEqual(write.call_count, 1)
+                self.assertIsInstance(
+                    IMAPServer(server.id).last_retrieve_date,
+                    datetime.datetime)
+
+            # The checkpoint is not stored if the run fails
+            server = IMAPServer(server.id)
+            last_retrieve_date = server.last_retrieve_date
+            with patch.object(IMAPServer, 'acquire', return_value=imapper), \
+                    patch.object(IMAPServer, 'release'), \
+                    patch.object(IMAPServer, 'process_email',
+                        side_effect=ValueError):
+                with self.assertRaises(ValueError):
+                    server.sync_emails()
+            self.assertEqual(IMAPServer(server.id).last_retrieve_date,
+                last_retrieve_date)
+
+    @with_transaction()
+    def test_fetch_ids_esearch(self):
+        pool = Pool()
+        IMAPServer = pool.get('imap.server')
+        capabilities = ('IMAP4rev1', 'AUTH=PLAIN', 'ESEARCH')
+        for capabilities in [capabilities, capabilities[:-1]]:
+            with IMAPStubServer(capabilities=capabilities) as stub:
+                for number in range(1, 8):
+                    stub.add_message(make_message(number),
+                        flags=['\\Seen'] if number == 4 else [])
+                server = create_imap_server(pool)
+                server.save()
+                imapper = IMAP4('127.0.0.1', stub.port)
+                IMAPServer.login(server, imapper, server.user,
+                    server.password)
+                self.assertEqual(server.fetch_ids(imapper),
+                    [b'1', b'2', b'3', b'5', b'6', b'7'])
+
+                # The oldest messages are fetched first
+                server.max_messages = 2
+                server.search_mode = 'incremental'
+                server.save()
+                self.assertEqual(list(server.fetch(imapper)), [b'1', b'2'])
+                self.assertEqual(list(server.fetch(imapper)), [b'3', b'4'])
+                server.max_messages = None
+                server.save()
+                self.assertEqual(list(server.fetch(imapper)),
+                    [b'5', b'6', b'7'])
+                IMAPServer.logout(imapper)
+
+                # Nothing would resume after the e-mails left out
+                server.max_messages = 2
+                server.search_mode = 'interval'
+                with self.assertRaises(DomainValidationError):
+                    server.save()
+
+    @with_transaction()
+    def test_compression(self):
+        pool = Pool()
+        IMAPServer = pool.get('imap.server')
+        capabilities = ('IMAP4rev1', 'AUTH=PLAIN', 'IDLE',
+            'COMPRESS=DEFLATE')
+        with IMAPStubServer(capabilities=capabilities) as stub:
+            raw = make_message(1, size=100000)
+            stub.add_message(raw)
+            server = create_imap_server(pool)
+            server.compression = True
+            server.search_mode = 'custom'
+            server.criterion = 'ALL'
+            server.save()
+            imapper = IMAP4('127.0.0.1', stub.port)
+            IMAPServer.login(server, imapper, server.user, server.password)
+            self.assertIsInstance(imapper.sock, DeflateSocket)
+
+            stub.reset_counters()
+            result = server.fetch(imapper)
+            self.assertEqual(result[b'1'][0][1], raw)
+            self.assertLess(stub.bytes_sent, len(raw) / 10)
+
+            # IDLE reads the inflated data
+            threading.Timer(0.2, stub.add_message,
+                args=(make_message(2),)).start()
+            responses = idle(imapper, 5)
+            self.assertTrue(has_new_messages(responses))
+            self.assertEqual(imapper.noop()[0], 'OK')
+            IMAPServer.logout(imapper)
+
+    @with_transaction()
+    def test_metrics(self):
+        pool = Pool()
+        IMAPServer = pool.get('imap.server')
+        with IMAPStubServer() as stub:
+            raws = [make_message(i, size=1000) for i in range(1, 3)]
+            for raw in raws:
+                stub.add_message(raw)
+            server = create_imap_server(pool)
+            server.search_mode = 'custom'
+            server.criterion = 'ALL'
+            server.save()
+            imapper = IMAP4('127.0.0.1', stub.port)
+
+            sink = MemorySink()
+            metrics.sink = sink
+            try:
+                IMAPServer.login(server, imapper, server.user,
+                    server.password)
+                server.fetch(imapper)
+                server.folder = 'Missing'
+                with self.assertRaises(UserError):
+                    server.select_folder(imapper)
+            finally:
+                metrics.sink = None
+
+            self.assertEqual(
+                sink.get_counter('login.calls', server=server.id), 1)
+            self.assertEqual(
+                sink.get_counter('fetch_ids.messages', server=server.id), 2)
+            fetched = sum(
+                sink.get_counter('%s.%s' % (operation, name),
+                    server=server.id)
+                for operation in ['fetch_one', 'fetch_batch']
+                for name in ['messages', 'bytes'])
+            self.assertEqual(fetched, 2 + sum(map(len, raws)))
+            self.assertEqual(
+                sink.get_counter('select_folder.errors', server=server.id),
+                1)
+            histogram = sink.get_histogram('select_folder.duration',
+                server=server.id)
+            self.assertEqual(histogram.count, 2)
+            self.assertEqual(sum(histogram.counts), 2)
+
+            # Nothing is recorded when disabled
+            sink.clear()
+            server.folder = 'INBOX'
+            imapper = IMAP4('127.0.0.1', stub.port)
+            IMAPServer.login(server, imapper, server.user, server.password)
+            server.fetch_ids(imapper)
+            self.assertFalse(sink.counters)
+            IMAPServer.logout(imapper)
+
+    @with_transaction()
+    def test_sync_log(self):
+        pool = Pool()
+        IMAPServer = pool.get('imap.server')
+        SyncLog = pool.get('imap.server.sync_log')
+        Statistics = pool.get('imap.server.sync_statistics')
+        # The runs are logged in a new transaction which does not see the
+        # uncommitted server, so the values are checked instead
+        logged = []
+        with IMAPStubServer() as stub, \
+                patch.object(SyncLog, 'create', side_effect=logged.extend):
+            raws = [make_message(i, size=1000) for i in range(1, 3)]
+            for raw in raws:
+                stub.add_message(raw)
+            server = create_imap_server(pool)
+            server.search_mode = 'incremental'
+            server.fetch_batch_size = 10
+            server.action_after_read = 'delete'
+            server.save()
+            imapper = IMAP4('127.0.0.1', stub.port)
+            IMAPServer.login(server, imapper, server.user, server.password)
+            with patch.object(IMAPServer, 'acquire', return_value=imapper), \
+                    patch.object(IMAPServer, 'release'):
+                with patch.object(IMAPServer, 'process_email'):
+                    self.assertEqual(server.sync_emails(), 2)
+                fetch, = [v for v in logged if v['operation'] == 'fetch']
+                self.assertEqual(fetch['server'], server.id)
+                self.assertEqual(fetch['folder'], 'INBOX')
+                self.assertEqual(fetch['ids_searched'], 2)
+                self.assertEqual(fetch['messages'], 2)
+                self.assertEqual(fetch['bytes'], sum(map(len, raws)))
+                # SELECT, UID SEARCH and UID FETCH
+                self.assertEqual(fetch['round_trips'], 3)
+                self.assertEqual(fetch['retries'], 0)
+                self.assertIsNone(fetch['error'])
+                self.assertGreaterEqual(fetch['end'], fetch['start'])
+                action, = [v for v in logged
+                    if v['operation'] == 'action_after']
+                self.assertEqual(action['messages'], 0)
+                self.assertGreater(action['round_trips'], 0)
+
+                # The failed runs are logged
+                stub.add_message(make_message(3))
+                with patch.object(IMAPServer, 'process_email',
+                        side_effect=ValueError('broken')):
+                    with self.assertRaises(ValueError):
+                        server.sync_emails()
+            IMAPServer.logout(imapper)
+
+        SyncLog.create(logged)
+        failed, = SyncLog.search([
+                ('server', '=', server.id),
+                ('error', '!=', None),
+                ])
+        self.assertEqual(failed.error, 'broken')
+        statistics = Statistics(server.id)
+        self.assertEqual(statistics.server, server)
+        self.assertEqual(statistics.runs, 3)
+        self.assertEqual(statistics.errors, 1)
+        self.assertEqual(statistics.ids_searched, 3)
+
+        SyncLog.write([failed], {
+                'start': datetime.datetime.now() - datetime.timedelta(
+                    days=40),
+                })
+        SyncLog.prune(days=30)
+        self.assertEqual(
+            SyncLog.search_count([('server', '=', server.id)]), 2)
+
+    @with_transaction()
+    def test_benchmark(self):
+        sizes = benchmark.message_sizes(100, 1000, seed=1)
+        self.assertEqual(len(sizes), 100)
+        self.assertAlmostEqual(sum(sizes) / len(sizes), 1000, delta=300)
+
+        results = {r.strategy: r for r in benchmark.run(messages=20,
+                size=2000)}
+        self.assertEqual(set(results), set(benchmark.STRATEGIES))
+        for name, result in results.items():
+            if name != 'connect':
+                self.assertEqual(result.messages, 20, name)
+            self.assertGreater(result.peak_memory, 0)
+        # SELECT, SEARCH and FETCH of each batch
+        self.assertEqual(results['fetch-one'].round_trips, 22)
+        self.assertEqual(results['fetch-batch'].round_trips, 3)
+        # SELECT and UID SEARCH
+        self.assertEqual(results['fetch-cached'].round_trips, 2)
+        self.assertLess(results['fetch-compressed'].bytes_sent,
+            results['fetch-uid'].bytes_sent)
+        self.assertLess(results['action-move'].round_trips,
+            results['action-copy'].round_trips)
+        self.assertIn('fetch-batch', benchmark.format_results(
+                results.values()))
+
+        # The memory of each strategy does not include the previous ones
+        fetch, connect = benchmark.run(['fetch-batch', 'connect'],
+            messages=20, size=20000)
+        self.assertGreater(fetch.peak_memory, 20 * 20000 / 2)
+        self.assertLess(connect.peak_memory, fetch.peak_memory)
+
+    @with_transaction()
+    def test_iter_messages(self):
+        pool = Pool()
+        IMAPServer = pool.get('imap.server')
+        attachment = MIMEApplication(b'x' * 200000, Name='big.bin')
+        message = MIMEMultipart()
+        message['From'] = 'Sender <sender@example.com>'
+        message['Subject'] = 'Raw'
+        message.attach(MIMEText('Hello'))
+        message.attach(attachment)
+        raw = message.as_bytes()
+        with IMAPStubServer() as stub:
+            stub.add_message(raw, flags=['\\Flagged'])
+            server = create_imap_server(pool)
+            server.save()
+            imapper = IMAP4('127.0.0.1', stub.port)
+            IMAPServer.login(server, imapper, server.user, server.password)
+            msg, = server.iter_messages(imapper,
+                '(UID FLAGS INTERNALDATE RFC822.SIZE BODY.PEEK[])')
+            IMAPServer.logout(imapper)
+
+        self.assertIsInstance(msg, RawMessage)
+        self.assertEqual(msg.emailid, b'1')
+        self.assertEqual(msg.uid, 1)
+        self.assertEqual(msg.flags, ['\\Flagged'])
+        self.assertEqual(msg.size, len(raw))
+        self.assertIsNotNone(msg.internal_date.tzinfo)
+        self.assertEqual(bytes(msg), raw)
+        self.assertIsInstance(msg.raw, memoryview)
+        self.assertEqual(b''.join(msg.iter_chunks(1000)), raw)
+
+        # Only the header is parsed to read a header
+        self.assertEqual(msg.get('Subject'), 'Raw')
+        self.assertIsNone(msg._message)
+        self.assertEqual(bytes(msg.header) + bytes(msg.body), raw)
+
+        attachment, = msg.message.iter_attachments()
+        self.assertEqual(attachment.get_content(), b'x' * 200000)
+        self.assertIs(msg.headers, msg.message)
+        with self.assertRaises(AttributeError):
+            msg.other = True
+
+    @with_transaction()
+    def test_fetch_spooled(self):
+        pool = Pool()
+        IMAPServer = pool.get('imap.server')
+        small, big = make_message(1), make_message(2, size=300000)
+        with IMAPStubServer() as stub, \
+                patch('trytond.modules.imap.imap.SPOOL_CHUNK_SIZE', 65536):
+            stub.add_message(small)
+            stub.add_message(big)
+            server = create_imap_server(pool)
+            server.search_mode = 'incremental'
+            server.fetch_batch_size = 10
+            server.spool_threshold = 100000
+            server.save()
+            imapper = IMAP4('127.0.0.1', stub.port)
+            IMAPServer.login(server, imapper, server.user, server.password)
+            stub.reset_counters()
+            result = server.fetch(imapper)
+            # SELECT, SEARCH, the sizes, 5 chunks and the small e-mail
+            self.assertEqual(stub.round_trips, 9)
+            self.assertEqual(result[b'1'][0][1], small)
+            spool = result[b'2'][0][1]
+            self.assertEqual(spool.read(), big)
+            self.assertNotIn('\\Seen',
+                stub.mailboxes['INBOX'].messages[1].flags)
+            self.assertEqual(server.last_uid, 2)
+
+            msg = RawMessage.from_response(b'2', result[b'2'])
+            self.assertEqual(msg.uid, 2)
+            self.assertEqual(bytes(msg), big)
+            self.assertEqual(msg.get('Subject'), 'Message 2')
+            IMAPServer.logout(imapper)
+
+    @with_transaction()
+    def test_oversized(self):
+        pool = Pool()
+        IMAPServer = pool.get('imap.server')
+        Oversized = pool.get('imap.server.oversized')
+        big = make_message(2, size=100000)
+        for action in ['skip', 'quarantine', 'defer']:
+            with IMAPStubServer() as stub:
+                stub.add_mailbox('Quarantine')
+                stub.add_message(make_message(1))
+                stub.add_message(big)
+                stub.add_message(make_message(3))
+                server = create_imap_server(pool)
+                server.search_mode = 'incremental'
+                server.fetch_batch_size = 10
+                server.max_size = 50000
+                server.oversize_action = action
+                server.quarantine_folder = 'Quarantine'
+                server.save()
+                imapper = IMAP4('127.0.0.1', stub.port)
+                IMAPServer.login(server, imapper, server.user,
+                    server.password)
+                stub.reset_counters()
+                result = server.fetch(imapper)
+                self.assertEqual(list(result), [b'1', b'3'], action)
+                self.assertEqual(server.last_uid, 3)
+                oversized, = Oversized.search([('server', '=', server.id)])
+                self.assertEqual(
+                    (oversized.folder, oversized.uid, oversized.size),
+                    ('INBOX', 2, len(big)))
+                self.assertEqual(oversized.state, {
+                        'skip': 'skipped',
+                        'quarantine': 'quarantined',
+                        'defer': 'deferred',
+                        }[action])
+                quarantined = stub.mailboxes['Quarantine'].messages
+                if action == 'quarantine':
+                    # SELECT, SEARCH, the sizes, MOVE and FETCH
+                    self.assertEqual(stub.round_trips, 5)
+                    self.assertEqual([m.raw for m in quarantined], [big])
+                    self.assertEqual(
+                        len(stub.mailboxes['INBOX'].messages), 2)
+                else:
+                    self.assertEqual(stub.round_trips, 4)
+                    self.assertEqual(quarantined, [])
+
+                if action == 'defer':
+                    IMAPServer.write([server], {
+                            'action_after_read': 'delete',
+                            })
+                    with patch.object(IMAPServer, 'acquire',
+                                return_value=imapper), \
+                            patch.object(IMAPServer, 'release'), \
+                            patch.object(IMAPServer,
+                                'process_email') as process_email:
+                        IMAPServer.fetch_deferred()
+                    (emailid, data), _ = process_email.call_args
+                    self.assertEqual(emailid, b'2')
+                    self.assertEqual(data[0][1].read(), big)
+                    self.assertEqual(Oversized(oversized.id).state,
+                        'fetched')
+                    self.assertNotIn(big,
+                        [m.raw for m in stub.mailboxes['INBOX'].messages])
+                    self.assertEqual(
+                        len(stub.mailboxes['INBOX'].messages), 2)
+                IMAPServer.logout(imapper)
+
+        # The unseen oversized e-mails are found again on each run
+        with IMAPStubServer() as stub:
+            stub.add_message(big)
+            server = create_imap_server(pool)
+            server.max_size = 50000
+            server.save()
+            imapper = IMAP4('127.0.0.1', stub.port)
+            IMAPServer.login(server, imapper, server.user, server.password)
+            for _ in range(3):
+                self.assertEqual(server.fetch(imapper), {})
+            oversized, = Oversized.search([('server', '=', server.id)])
+            self.assertEqual(oversized.state, 'skipped')
+            IMAPServer.logout(imapper)
+
+        # The asynchronous backend does not filter the e-mails
+        server.backend = 'asyncio'
+        with self.assertRaises(DomainValidationError):
+            server.save()
+
+    @with_transaction()
+    def test_sync_resume(self):
+        pool = Pool()
+        IMAPServer = pool.get('imap.server')
+        SyncLog = pool.get('imap.server.sync_log')
+        for search_mode, drops, retries in [
+                ('incremental', [2], 1),
+                ('incremental', [1, 2, 3, 4, 5], None),
+                ('custom', [1], None),
+                ]:
+            with IMAPStubServer() as stub:
+                for i in range(1, 6):
+                    stub.add_message(make_message(i))
+                server = create_imap_server(pool)
+                server.search_mode = search_mode
+                server.criterion = 'ALL'
+                server.action_after_read = 'delete'
+                server.save()
+                imappers = []
+                processed = []
+                logged = []
+
+                def acquire(server):
+                    imapper = IMAP4('127.0.0.1', stub.port)
+                    imappers.append(imapper)
+                    return IMAPServer.login(server, imapper, server.user,
+                        server.password)
+
+                def process_email(emailid, data):
+                    processed.append(emailid)
+                    if len(processed) in drops:
+                        imappers[-1].shutdown()
+
+                with patch.object(IMAPServer, 'acquire', acquire), \
+                        patch.object(IMAPServer, 'release'), \
+                        patch.object(IMAPServer, 'process_email',
+                            side_effect=process_email), \
+                        patch('trytond.modules.imap.imap.time.sleep') \
+                        as sleep, \
+                        patch.object(SyncLog, 'create',
+                            side_effect=logged.extend):
+                    if retries is None:
+                        with self.assertRaises(IMAPConnectionError):
+                            server.sync_emails()
+                        if search_mode == 'custom':
+                            # The processed e-mail would be processed again
+                            sleep.assert_not_called()
+                        else:
+                            self.assertEqual(sleep.call_count, 3)
+                        continue
+                    self.assertEqual(server.sync_emails(), 5)
+                self.assertEqual(processed,
+                    [b'1', b'2', b'3', b'4', b'5'])
+                self.assertEqual(len(imappers), 2)
+                (delay,), _ = sleep.call_args
+                self.assertTrue(0.5 <= delay <= 1)
+                self.assertEqual(IMAPServer(server.id).last_uid, 5)
+                self.assertEqual(stub.mailboxes['INBOX'].messages, [])
+                self.assertEqual(
+                    sum(values['retries'] for values in logged), retries)
+                IMAPServer.logout(imappers[-1])
+
+    @with_transaction()
+    def test_sync_resume_action_after(self):
+        pool = Pool()
+        IMAPServer = pool.get('imap.server')
+        for capabilities in [_CAPABILITIES, ('IMAP4rev1', 'AUTH=PLAIN')]:
+            with IMAPStubServer(capabilities=capabilities) as stub:
+                for i in range(1, 4):
+                    stub.add_message(make_message(i))
+                server = create_imap_server(pool)
+                server.search_mode = 'incremental'
+                server.action_after_read = 'delete'
+                server.save()
+                imappers = []
+                expunge_email = IMAPServer.expunge_email
+
+                def acquire(server):
+                    imapper = IMAP4('127.0.0.1', stub.port)
+                    imappers.append(imapper)
+                    return IMAPServer.login(server, imapper, server.user,
+                        server.password)
+
+                def expunge(server, imapper, emailid=None):
+                    if len(imappers) == 1:
+                        # The connection is lost during the EXPUNGE
+                        imapper.shutdown()
+                    return expunge_email(server, imapper, emailid)
+
+                with patch.object(IMAPServer, 'acquire', acquire), \
+                        patch.object(IMAPServer, 'release'), \
+                        patch.object(IMAPServer, 'process_email') \
+                        as process_email, \
+                        patch.object(IMAPServer, 'expunge_email',
+                            autospec=True, side_effect=expunge), \
+                        patch('trytond.modules.imap.imap.time.sleep'):
+                    self.assertEqual(server.sync_emails(), 3)
+                self.assertEqual(process_email.call_count, 3)
+                self.assertEqual(len(imappers), 2)
+                self.assertEqual(stub.mailboxes['INBOX'].messages, [])
+                self.assertEqual(IMAPServer(server.id).last_uid, 3)
+                IMAPServer.logout(imappers[-1])
+
+    def test_statsd_sink(self):
+        receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        receiver.bind(('127.0.0.1', 0))
+        receiver.settimeout(5)
+        try:
+            sink = StatsdSink('127.0.0.1', receiver.getsockname()[1],
+                'trytond')
+            sink.increment('fetch_one.bytes', 10, {'server': 1})
+            self.assertEqual(receiver.recv(1024),
+                b'trytond.imap.server.1.fetch_one.bytes:10|c')
+            sink.timing('login.duration', 0.25, {'server': 1})
+            self.assertEqual(receiver.recv(1024),
+                b'trytond.imap.server.1.login.duration:250.000|ms')
+        finally:
+            receiver.close()
+
 
 del ModuleTestCase
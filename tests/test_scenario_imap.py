@@ -37,7 +37,8 @@ class Test(unittest.TestCase):
         server.save()
         test.assertEqual(server.last_retrieve_date, None, True)
         test.assertEqual(server.criterion_used, 'ALL', True)
-        server.last_retrieve_date = today
+        server.last_retrieve_date = datetime.datetime.combine(today,
+            datetime.time())
         server.save()
         test.assertEqual(
             server.criterion_used == '(SINCE "%s")' %